@@ -0,0 +1,197 @@
+"""Inverted-file (IVF-flat) approximate nearest-neighbour index.
+
+Vectors are partitioned with spherical k-means; a query scores only the rows
+of the `nprobe` partitions whose centroids are closest to it. The index holds
+global slot numbers of the store's vector segments, not vectors, and is
+persisted beside the SQLite file as `<db>.ivf.npz` together with the segment
+layout the slots refer to.
+"""
+import os
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from segments import normalize_rows
+
+# Bounds of the k-means training sample (see training_sample_size)
+TRAIN_ROWS_PER_LIST = 32
+TRAIN_MAX_ROWS = 25000
+
+
+def assign_lists(vecs: np.ndarray, centroids: np.ndarray, rows: Optional[np.ndarray] = None, batch: int = 4096) -> np.ndarray:
+    """Nearest centroid (by inner product) for every row, or only for `rows`, in bounded batches."""
+    n = len(vecs) if rows is None else len(rows)
+    out = np.empty(n, dtype=np.int32)
+    for i in range(0, n, batch):
+        block = vecs[i : i + batch] if rows is None else vecs[rows[i : i + batch]]
+        out[i : i + batch] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def train_centroids(sample: np.ndarray, nlist: int, iters: int = 8, seed: int = 0, batch: int = 4096) -> np.ndarray:
+    """Spherical k-means over `sample`. Partition sums are accumulated one batch of rows
+    at a time, so training needs no memory beyond the sample and the centroids."""
+    rng = np.random.default_rng(seed)
+    nlist = max(1, min(nlist, len(sample)))
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iters):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(nlist, dtype=np.int64)
+        for i in range(0, len(sample), batch):
+            block = sample[i : i + batch]
+            labels = np.argmax(block @ centroids.T, axis=1)
+            np.add.at(sums, labels, block)
+            counts += np.bincount(labels, minlength=nlist)
+        # Re-seed empty partitions from random sample rows
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def training_sample_size(n: int, nlist: int) -> int:
+    """Rows to train `nlist` partitions on: enough per partition for k-means, capped so the
+    sample stays small next to the mapped segments (25k rows is ~150 MB at 1536 dims)."""
+    return min(n, TRAIN_ROWS_PER_LIST * nlist, TRAIN_MAX_ROWS)
+
+
+def default_nlist(n: int) -> int:
+    return int(min(4096, max(16, 4 * np.sqrt(max(n, 1)))))
+
+
+class IVFIndex:
+    def __init__(self, path: str, nprobe: int = 8):
+        self.path = path
+        self.nprobe = nprobe
+        self.centroids: Optional[np.ndarray] = None
+        self.assign = np.zeros(0, dtype=np.int32)  # slot -> partition, -1 when not indexed
+        self.trained_size = 0
+        self.dirty = False
+        self._lists: List[np.ndarray] = []
+        self._pending: List[List[int]] = []
+
+    @property
+    def ready(self) -> bool:
+        return self.centroids is not None
+
+    def install(self, centroids: np.ndarray, assign: np.ndarray, trained_size: int):
+        self.centroids = centroids
+        self.assign = assign.astype(np.int32, copy=True)
+        self.trained_size = trained_size
+        self._rebuild_lists()
+        self.dirty = True
+
+    def reset(self):
+        self.centroids = None
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.trained_size = 0
+        self._lists, self._pending = [], []
+
+    def _rebuild_lists(self):
+        nlist = len(self.centroids)
+        valid = np.flatnonzero(self.assign >= 0)
+        labels = self.assign[valid]
+        order = np.argsort(labels, kind="stable")
+        bounds = np.searchsorted(labels[order], np.arange(nlist + 1))
+        slots = valid[order]
+        self._lists = [slots[bounds[i] : bounds[i + 1]] for i in range(nlist)]
+        self._pending = [[] for _ in range(nlist)]
+
+    def _list(self, i: int) -> np.ndarray:
+        if self._pending[i]:
+            self._lists[i] = np.concatenate([self._lists[i], np.asarray(self._pending[i], dtype=np.int64)])
+            self._pending[i] = []
+        return self._lists[i]
+
+    def add(self, slots: np.ndarray, vecs: np.ndarray):
+        """Assign freshly written (normalized) rows to their nearest partition."""
+        if not self.ready or not len(slots):
+            return
+        labels = assign_lists(vecs, self.centroids)
+        top = int(slots.max()) + 1
+        if top > len(self.assign):
+            grown = np.full(max(top, 2 * len(self.assign)), -1, dtype=np.int32)
+            grown[: len(self.assign)] = self.assign
+            self.assign = grown
+        self.assign[slots] = labels
+        for slot, label in zip(slots.tolist(), labels.tolist()):
+            self._pending[label].append(slot)
+        self.dirty = True
+
+    def discard(self, slots: Sequence[int]):
+        """Tombstone slots; their stale list entries are skipped at search time."""
+        slots = np.asarray([s for s in slots if s < len(self.assign)], dtype=np.int64)
+        if len(slots):
+            self.assign[slots] = -1
+            self.dirty = True
+
+    def remap(self, remap: np.ndarray):
+        """Follow a matrix compaction: remap[old_slot] is the new slot or -1."""
+        if not self.ready:
+            return
+        n = min(len(remap), len(self.assign))
+        keep = np.flatnonzero(remap[:n] >= 0)
+        assign = np.full(int(remap.max()) + 1 if len(remap) else 0, -1, dtype=np.int32)
+        assign[remap[keep]] = self.assign[keep]
+        self.assign = assign
+        self._rebuild_lists()
+        self.dirty = True
+
+    def candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """Slots stored in the partitions nearest to a normalized query."""
+        nlist = len(self.centroids)
+        p = max(1, min(nlist, nprobe or self.nprobe))
+        probe = np.argpartition(-(self.centroids @ query), p - 1)[:p]
+        cands = np.unique(np.concatenate([self._list(int(i)) for i in probe]))
+        # Drop tombstones and entries left behind when a row moved partition
+        return cands[np.isin(self.assign[cands], probe)]
+
+    def save(self, layout: np.ndarray):
+        """Persist centroids and assignments; `layout` is the (seq, count) list the slots refer to."""
+        if not self.ready:
+            return
+        total = int(layout[:, 1].sum()) if len(layout) else 0
+        assign = np.full(total, -1, dtype=np.int32)
+        n = min(total, len(self.assign))
+        assign[:n] = self.assign[:n]
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, centroids=self.centroids, assign=assign, layout=layout, trained_size=self.trained_size)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def load(self, layout: np.ndarray, dim: int) -> Optional[np.ndarray]:
+        """Read persisted centroids and map saved assignments onto the current slots
+        through the (seq, row) each slot stood for. Returns the slots that still need
+        assigning, or None if nothing usable is on disk.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path) as data:
+                centroids = data["centroids"]
+                saved_assign = data["assign"]
+                saved_layout = data["layout"].reshape(-1, 2)
+                trained_size = int(data["trained_size"])
+        except Exception:
+            return None
+        if centroids.ndim != 2 or centroids.shape[1] != dim:
+            return None
+        total = int(layout[:, 1].sum()) if len(layout) else 0
+        if np.array_equal(saved_layout, layout):
+            assign = saved_assign.astype(np.int32)
+        else:
+            assign = np.full(total, -1, dtype=np.int32)
+            saved_bases = np.concatenate(([0], np.cumsum(saved_layout[:, 1])))
+            bases = np.concatenate(([0], np.cumsum(layout[:, 1])))
+            old = np.arange(min(len(saved_assign), int(saved_bases[-1])))
+            if len(old) and len(layout):
+                seg = np.searchsorted(saved_bases, old, side="right") - 1
+                seqs, rows = saved_layout[seg, 0], old - saved_bases[seg]
+                cur = np.clip(np.searchsorted(layout[:, 0], seqs), 0, len(layout) - 1)
+                ok = layout[cur, 0] == seqs
+                assign[bases[cur[ok]] + rows[ok]] = saved_assign[old[ok]]
+        self.install(centroids, assign, trained_size)
+        self.dirty = False
+        return np.flatnonzero(assign < 0)
@@ -0,0 +1,162 @@
+"""In-process cache of /ask responses.
+
+Two tiers share one LRU of entries:
+  exact     (scope, normalized question) -> entry
+  semantic  the query embedding of a miss is compared with the cached
+            questions of the same scope; a cosine similarity at or above
+            `similarity` counts as a hit.
+The scope holds everything besides the question that shapes the answer
+(tenant and other retrieval filters, top_k, ...). Entries expire after `ttl`
+seconds and are dropped as soon as one of the documents they drew on is
+re-indexed or unindexed.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    return " ".join((question or "").lower().split())
+
+
+class _Entry:
+    __slots__ = ("value", "doc_ids", "expires", "vector", "scope")
+
+    def __init__(self, value, doc_ids, expires, vector, scope):
+        self.value = value
+        self.doc_ids = doc_ids
+        self.expires = expires
+        self.vector = vector
+        self.scope = scope
+
+
+class AnswerCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 600.0, similarity: float = 0.97):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._by_doc: Dict[str, Set[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+        # Invalidation clock: answers computed before a document changed must not be stored.
+        # _doc_epoch is kept in epoch order and trimmed to max_doc_epochs; trimming raises
+        # _cleared_epoch past the dropped entries, so answers older than them are refused.
+        self._epoch = 0
+        self._doc_epoch: Dict[str, int] = {}
+        self._cleared_epoch = 0
+        self.max_doc_epochs = 4 * self.max_entries
+        self.hits = {"exact": 0, "semantic": 0}
+        self.misses = 0
+
+    def epoch(self) -> int:
+        """Take before computing an answer and pass to put()."""
+        with self._lock:
+            return self._epoch
+
+    def _drop(self, key: Tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for d in entry.doc_ids:
+            keys = self._by_doc.get(d)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_doc[d]
+
+    def get(self, scope: str, question: str) -> Optional[Dict[str, Any]]:
+        key = (scope, normalize_question(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            self.hits["exact"] += 1
+            return copy.deepcopy(entry.value)
+
+    def get_similar(self, scope: str, embedding: Iterable[float]) -> Optional[Dict[str, Any]]:
+        q = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        with self._lock:
+            now = time.monotonic()
+            best_key, best = None, self.similarity
+            for key, entry in list(self._entries.items()):
+                if entry.scope != scope or entry.vector is None or entry.vector.shape != q.shape:
+                    continue
+                if entry.expires <= now:
+                    self._drop(key)
+                    continue
+                score = float(entry.vector @ q) / (norm or 1.0)
+                if score >= best:
+                    best_key, best = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits["semantic"] += 1
+            return copy.deepcopy(self._entries[best_key].value)
+
+    def put(
+        self,
+        scope: str,
+        question: str,
+        embedding: Optional[Iterable[float]],
+        value: Dict[str, Any],
+        doc_ids: Iterable[str],
+        epoch: int,
+    ):
+        doc_ids = {str(d) for d in doc_ids if d is not None}
+        vector = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            vector = vector / (float(np.linalg.norm(vector)) or 1.0)
+        key = (scope, normalize_question(question))
+        with self._lock:
+            if epoch < self._cleared_epoch or any(self._doc_epoch.get(d, -1) >= epoch for d in doc_ids):
+                return
+            self._drop(key)
+            self._entries[key] = _Entry(copy.deepcopy(value), doc_ids, time.monotonic() + self.ttl, vector, scope)
+            for d in doc_ids:
+                self._by_doc.setdefault(d, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_documents(self, doc_ids: Iterable[str]) -> int:
+        """Drop every answer that drew on one of these documents. Returns entries removed."""
+        removed = 0
+        with self._lock:
+            for d in {str(d) for d in doc_ids}:
+                self._doc_epoch.pop(d, None)
+                self._doc_epoch[d] = self._epoch
+                for key in list(self._by_doc.get(d, ())):
+                    self._drop(key)
+                    removed += 1
+            self._epoch += 1
+            if len(self._doc_epoch) > self.max_doc_epochs:
+                self._trim_doc_epochs()
+        return removed
+
+    def _trim_doc_epochs(self):
+        """Forget the older half of the per-document epochs (callers hold the lock)."""
+        drop = len(self._doc_epoch) - self.max_doc_epochs // 2
+        for d in list(self._doc_epoch)[:drop]:
+            self._cleared_epoch = max(self._cleared_epoch, self._doc_epoch.pop(d) + 1)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_doc.clear()
+            self._doc_epoch.clear()
+            self._cleared_epoch = self._epoch + 1
+            self._epoch += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": dict(self.hits), "misses": self.misses}
@@ -0,0 +1,115 @@
+"""Helpers for streaming /ask answers as they are generated.
+
+The model is asked for a JSON object whose first key is "answer". While the
+completion streams in, AnswerFieldDecoder pulls the decoded text of that
+string value out of the partial JSON, so answer tokens can be forwarded
+before the object is complete. MarkerTracker reports citation markers ([S1])
+the first time they appear in the streamed text.
+"""
+import json
+import re
+from typing import Any, Dict, List
+
+_ANSWER_KEY = re.compile(r'"answer"\s*:\s*"')
+_MARKER = re.compile(r"\[S(\d+)]")
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", '"': '"', "\\": "\\", "/": "/"}
+
+
+class AnswerFieldDecoder:
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self.mode = None  # "json" once a JSON object (or fence) starts, "plain" for bare text
+        self.phase = "seek"  # seek -> in -> done
+
+    def feed(self, chunk: str) -> str:
+        """Add raw completion text; returns the newly decoded part of the answer."""
+        self._buf += chunk or ""
+        if self.mode is None:
+            head = self._buf.lstrip()
+            if not head:
+                return ""
+            self.mode = "json" if head[0] in "{`" else "plain"
+        if self.mode == "plain":
+            out, self._pos = self._buf[self._pos :], len(self._buf)
+            return out
+        if self.phase == "seek":
+            m = _ANSWER_KEY.search(self._buf)
+            if not m:
+                return ""
+            self.phase, self._pos = "in", m.end()
+        if self.phase == "in":
+            return self._decode()
+        return ""
+
+    def _decode(self) -> str:
+        buf, i, out = self._buf, self._pos, []
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.phase = "done"
+                i += 1
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            # Escapes may be split across chunks; wait for the rest
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc != "u":
+                out.append(_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            try:
+                code = int(buf[i + 2 : i + 6], 16)
+            except ValueError:
+                out.append(buf[i : i + 6])
+                i += 6
+                continue
+            if 0xD800 <= code < 0xDC00:
+                if i + 12 > len(buf):
+                    break
+                try:
+                    low = int(buf[i + 8 : i + 12], 16) if buf[i + 6 : i + 8] == "\\u" else -1
+                except ValueError:
+                    low = -1
+                if 0xDC00 <= low < 0xE000:
+                    out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                    i += 12
+                    continue
+            out.append(chr(code))
+            i += 6
+        self._pos = i
+        return "".join(out)
+
+
+class MarkerTracker:
+    def __init__(self):
+        self.text = ""
+        self.seen: List[str] = []
+        self._from = 0
+
+    def feed(self, delta: str) -> List[str]:
+        """Citation ids that appear for the first time once delta is appended."""
+        self.text += delta or ""
+        new = []
+        for m in _MARKER.finditer(self.text, self._from):
+            cid = f"S{m.group(1)}"
+            if cid not in self.seen:
+                self.seen.append(cid)
+                new.append(cid)
+        # Re-scan a short tail next time so a marker split across deltas is still found
+        self._from = max(self._from, len(self.text) - 8)
+        return new
+
+
+def sse_frame(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def ndjson_frame(event: str, data: Dict[str, Any]) -> str:
+    return json.dumps({"type": event, **data}, ensure_ascii=False) + "\n"
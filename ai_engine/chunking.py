@@ -0,0 +1,185 @@
+"""Structure-aware chunking with token budgets.
+
+Text is read line by line (a str is scanned in place, an iterable of pieces
+such as a file is consumed as it goes) and grouped into blocks:
+  heading    markdown "#" lines, setext underlines, dotted numbering ("2.1 Scope")
+  table      consecutive "|"-delimited or tab-separated rows
+  paragraph  everything else, up to a blank line
+Blocks are packed into chunks of about `target_tokens`. A chunk ends before a
+heading once it holds at least `min_tokens`, so sections are not mixed without
+need. Blocks above `max_tokens` are split at sentence boundaries (tables at
+rows, repeating the header row); consecutive pieces of one split paragraph
+share up to `overlap_tokens` of trailing sentences. Every chunk carries the
+heading path it starts under.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from tokens import count_tokens, split_tokens
+
+_LINE = re.compile(r"[^\n]*\n|[^\n]+$")
+_MD_HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_NUMBERED_HEADING = re.compile(r"^(\d+(?:\.\d+)+)\.?\s+([A-Z][^.!?:;]{0,78})$")
+_SETEXT = re.compile(r"^(=+|-+)\s*$")
+_TABLE_ROW = re.compile(r"^\s*\|.*\|\s*$|^[^\t]*\t[^\t]*\t")
+_SENTENCE = re.compile(r"(?<=[.!?])[\"')\]]?\s+(?=[\"'(\[]?[A-Z0-9])")
+
+
+@dataclass
+class Block:
+    kind: str  # heading | table | paragraph
+    text: str
+    level: int = 0
+
+
+@dataclass
+class Chunk:
+    text: str
+    heading_path: List[str] = field(default_factory=list)
+    tokens: int = 0
+
+
+def iter_lines(source: Union[str, Iterable[str]]) -> Iterator[str]:
+    """Lines without their line ending."""
+    if isinstance(source, str):
+        for m in _LINE.finditer(source):
+            yield m.group(0).rstrip("\r\n")
+        return
+    buf = ""
+    for piece in source:
+        buf += piece
+        if "\n" not in buf:
+            continue
+        *lines, buf = buf.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    if buf:
+        yield buf.rstrip("\r")
+
+
+def iter_blocks(lines: Iterable[str]) -> Iterator[Block]:
+    para: List[str] = []
+    table: List[str] = []
+
+    def flush():
+        if para:
+            yield Block("paragraph", "\n".join(para))
+            para.clear()
+        if table:
+            yield Block("table", "\n".join(table))
+            table.clear()
+
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            yield from flush()
+            continue
+        if _TABLE_ROW.match(line):
+            if para:
+                yield from flush()
+            table.append(stripped)
+            continue
+        if table:
+            yield from flush()
+        if len(para) == 1 and _SETEXT.match(stripped) and len(stripped) >= 3:
+            title = para.pop()
+            yield Block("heading", title.strip(), 1 if stripped[0] == "=" else 2)
+            continue
+        m = _MD_HEADING.match(stripped)
+        if m:
+            yield from flush()
+            yield Block("heading", m.group(2), len(m.group(1)))
+            continue
+        m = _NUMBERED_HEADING.match(stripped) if not para else None
+        if m:
+            # Numbered headings nest below markdown ones, deeper with every dot
+            yield Block("heading", stripped, 6 + m.group(1).count("."))
+            continue
+        para.append(stripped)
+    yield from flush()
+
+
+def _pieces(block: Block, max_tokens: int) -> Iterator[Tuple[str, str]]:
+    """(separator to the previous piece of the block, text) small enough to pack."""
+    if count_tokens(block.text) <= max_tokens:
+        yield "", block.text
+        return
+    if block.kind == "table":
+        for row in block.text.split("\n"):
+            yield "\n", row
+        return
+    for sentence in _SENTENCE.split(block.text):
+        for part in split_tokens(sentence.strip(), max_tokens):
+            yield " ", part
+
+
+def chunk_document(
+    source: Union[str, Iterable[str]],
+    target_tokens: int = 300,
+    max_tokens: Optional[int] = None,
+    min_tokens: Optional[int] = None,
+    overlap_tokens: int = 40,
+    headings: Optional[List[Tuple[int, str]]] = None,
+) -> Iterator[Chunk]:
+    """Stream Chunks of `source` (see the module docstring).
+    `headings` is the open (level, title) heading stack, updated in place; pass the same
+    list for consecutive parts of one document (e.g. its pages) to carry sections over.
+    """
+    max_tokens = max(target_tokens, max_tokens or int(target_tokens * 1.3))
+    min_tokens = target_tokens // 4 if min_tokens is None else min_tokens
+    headings = [] if headings is None else headings
+    parts: List[str] = []
+    used = 0
+    has_body = False
+    path: List[str] = [h[1] for h in headings]
+
+    def emit() -> Chunk:
+        return Chunk("".join(parts).strip(), list(path), used)
+
+    for block in iter_blocks(iter_lines(source)):
+        if block.kind == "heading":
+            if has_body and used >= min_tokens:
+                yield emit()
+                parts, used, has_body = [], 0, False
+            while headings and headings[-1][0] >= block.level:
+                headings.pop()
+            headings.append((block.level, block.text))
+            if not has_body:
+                path = [h[1] for h in headings]
+            parts.append(("\n\n" if parts else "") + block.text)
+            used += count_tokens(block.text)
+            continue
+        if not has_body:
+            path = [h[1] for h in headings]
+        header = block.text.split("\n", 1)[0] if block.kind == "table" else None
+        recent: List[Tuple[str, int]] = []  # pieces of this block in the current chunk
+        first = True
+        for sep, text in _pieces(block, max_tokens):
+            n = count_tokens(text)
+            if has_body and used + n > target_tokens:
+                yield emit()
+                parts, used = [], 0
+                path = [h[1] for h in headings]
+                carry: List[Tuple[str, int]] = []
+                if header is not None and not first and text != header:
+                    carry = [(header, count_tokens(header))]
+                elif not first:
+                    # Repeat the tail of the split paragraph for continuity
+                    room = overlap_tokens
+                    for prev, m in reversed(recent):
+                        if m > room:
+                            break
+                        carry.insert(0, (prev, m))
+                        room -= m
+                for prev, m in carry:
+                    parts.append((sep if parts else "") + prev)
+                    used += m
+                recent = list(carry)
+            parts.append((("\n\n" if first else sep) if parts else "") + text)
+            used += n
+            has_body = True
+            recent.append((text, n))
+            first = False
+    if has_body:
+        yield emit()
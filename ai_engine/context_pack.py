@@ -0,0 +1,133 @@
+"""Token-budgeted packing of retrieved chunks into the /ask prompt context.
+
+Candidates arrive best first. Packing
+  1. drops near-duplicates of a chunk already taken (word-shingle containment),
+  2. takes chunks in that order until the token budget is spent, cutting the
+     last one down to the remaining room at a sentence boundary,
+  3. merges taken chunks that are neighbours on the same page (consecutive
+     chunk numbers) into one source; text shared by overlapping windows is
+     sent once.
+Tokens are counted as in tokens.py.
+"""
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from tokens import count_tokens, truncate_tokens
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def shingles(text: str, n: int = 3) -> Set[Tuple[str, ...]]:
+    words = _WORD.findall((text or "").lower())
+    if len(words) < n:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i : i + n]) for i in range(len(words) - n + 1)}
+
+
+def containment(a: Set, b: Set) -> float:
+    """Share of the smaller shingle set found in the other one."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def join_overlapping(a: str, b: str, min_overlap: int = 16) -> Optional[str]:
+    """a + b with the longest suffix of a that prefixes b written once; None if they do not overlap."""
+    for k in range(min(len(a), len(b)), min_overlap - 1, -1):
+        if a.endswith(b[:k]):
+            return a + b[k:]
+    return None
+
+
+@dataclass
+class PackStats:
+    candidates: int = 0
+    packed: int = 0
+    tokens: int = 0
+    duplicates: int = 0
+    merged: int = 0
+    truncated: int = 0
+
+
+def pack_context(
+    matches: List[Dict[str, Any]],
+    budget: int,
+    position: Callable[[Dict[str, Any]], Optional[Tuple[Hashable, int]]],
+    per_source_tokens: int = 24,
+    duplicate_threshold: float = 0.85,
+    min_tokens: int = 48,
+) -> Tuple[List[Dict[str, Any]], PackStats]:
+    """Choose and merge matches (best first, each with "content") to fit `budget` prompt tokens.
+    `position(match)` returns (group, chunk number) for chunks that may be merged with their
+    neighbours, or None. `per_source_tokens` covers the header rendered for every source.
+    Returns the packed matches, best first, with merged ids in match["merged_ids"].
+    """
+    stats = PackStats(candidates=len(matches))
+    taken: List[Dict[str, Any]] = []
+    taken_shingles: List[Set] = []
+    used = 0
+    for match in matches:
+        text = (match.get("content") or "").strip()
+        if not text:
+            continue
+        sh = shingles(text)
+        if any(containment(sh, other) >= duplicate_threshold for other in taken_shingles):
+            stats.duplicates += 1
+            continue
+        room = budget - used - per_source_tokens
+        n = count_tokens(text)
+        if n > room:
+            # Keep looking: a shorter chunk further down may still fit
+            if room < min_tokens:
+                continue
+            text = truncate_tokens(text, room)
+            n = count_tokens(text)
+            stats.truncated += 1
+        taken.append({**match, "content": text})
+        taken_shingles.append(sh)
+        used += n + per_source_tokens
+        if budget - used - per_source_tokens < min_tokens:
+            break
+
+    packed = _merge_neighbours(taken, position, stats)
+    stats.packed = len(packed)
+    stats.tokens = sum(count_tokens(m["content"]) + per_source_tokens for m in packed)
+    return packed, stats
+
+
+def _merge_neighbours(taken: List[Dict[str, Any]], position, stats: PackStats) -> List[Dict[str, Any]]:
+    # Runs of consecutive chunk numbers per group, in page order
+    groups: Dict[Hashable, List[Tuple[int, int]]] = {}
+    for rank, match in enumerate(taken):
+        pos = position(match)
+        if pos is not None:
+            groups.setdefault(pos[0], []).append((pos[1], rank))
+    merged_into: Dict[int, int] = {}
+    texts = {rank: m["content"] for rank, m in enumerate(taken)}
+    members = {rank: [rank] for rank in range(len(taken))}
+    for entries in groups.values():
+        entries.sort()
+        head = None
+        for (num, rank), prev in zip(entries, [None] + entries[:-1]):
+            if head is not None and prev is not None and num == prev[0] + 1:
+                nxt = taken[rank]["content"]
+                texts[head] = join_overlapping(texts[head], nxt) or f"{texts[head]}\n\n{nxt}"
+                members[head].append(rank)
+                merged_into[rank] = head
+                continue
+            head = rank
+    out = []
+    for rank, match in enumerate(taken):
+        if rank in merged_into:
+            continue
+        group = members[rank]
+        # A merged source ranks where its best member ranked, and keeps that member's identity
+        best = min(group)
+        entry = {**taken[best], "content": texts[rank], "score": max(float(taken[r].get("score") or 0.0) for r in group)}
+        if len(group) > 1:
+            entry["merged_ids"] = [taken[r].get("id") for r in group]
+            stats.merged += len(group) - 1
+        out.append((best, entry))
+    out.sort(key=lambda t: t[0])
+    return [entry for _, entry in out]
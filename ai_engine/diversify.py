@@ -0,0 +1,47 @@
+"""Diversification of ranked retrieval candidates.
+
+Chunks overlap (chunk_document carries trailing sentences over), so the
+nearest chunks of a query are frequently neighbours on one page. Maximal
+marginal relevance reorders the candidates so that each pick trades relevance
+against its highest cosine similarity to the picks before it:
+    mmr(i) = lambda * relevance(i) - (1 - lambda) * max_j sim(i, picked_j)
+A per-document cap additionally limits how many chunks one document supplies.
+"""
+from typing import Hashable, List, Optional, Sequence
+
+import numpy as np
+
+
+def mmr_order(relevance: Sequence[float], vectors: np.ndarray, lambda_: float = 0.7, k: Optional[int] = None) -> List[int]:
+    """Candidate positions in MMR order (the first k). `vectors` are unit rows aligned with relevance;
+    a zero row (unknown vector) is similar to nothing."""
+    rel = np.asarray(relevance, dtype=np.float64)
+    n = len(rel)
+    k = n if k is None else max(0, min(k, n))
+    if not n or not k:
+        return []
+    vecs = np.asarray(vectors, dtype=np.float32).reshape(n, -1)
+    lo, hi = float(rel.min()), float(rel.max())
+    # Relevance on the same [0, 1] scale as the similarities it is weighed against
+    rel = (rel - lo) / (hi - lo) if hi - lo > 1e-12 else np.ones(n)
+    max_sim = np.zeros(n, dtype=np.float64)
+    available = np.ones(n, dtype=bool)
+    order: List[int] = []
+    for _ in range(k):
+        score = np.where(available, lambda_ * rel - (1.0 - lambda_) * max_sim, -np.inf)
+        pick = int(np.argmax(score))
+        order.append(pick)
+        available[pick] = False
+        np.maximum(max_sim, vecs @ vecs[pick], out=max_sim)
+    return order
+
+
+def cap_per_group(groups: Sequence[Hashable], cap: int) -> List[int]:
+    """Positions kept when at most `cap` candidates (in the given order) are taken per group."""
+    counts: dict = {}
+    kept = []
+    for i, g in enumerate(groups):
+        counts[g] = counts.get(g, 0) + 1
+        if counts[g] <= cap:
+            kept.append(i)
+    return kept
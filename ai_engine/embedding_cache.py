@@ -0,0 +1,164 @@
+"""Content-addressed cache of embeddings, persisted in SQLite beside the vector store.
+
+Entries are keyed by sha256(model, normalized text), so re-indexing unchanged
+chunks costs a lookup instead of an API call. Space is bounded by max_bytes;
+when it is exceeded the least recently used entries are evicted.
+QueryEmbeddingCache is an in-memory LRU/TTL tier for query-time texts.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """NFC with whitespace runs collapsed; only used to build keys."""
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+def cache_key(model: str, text: str) -> str:
+    h = hashlib.sha256()
+    h.update((model or "").encode("utf-8"))
+    h.update(b"\0")
+    h.update(normalize_text(text).encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vec BLOB NOT NULL, -- float32 little-endian
+                used REAL NOT NULL -- last hit or write, unix time
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_used ON embeddings (used)")
+        self.conn.commit()
+        self._lock = threading.Lock()
+        self._bytes = int(self.conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0])
+        self.hits = 0
+        self.misses = 0
+        self._last = 0.0
+
+    def _now(self) -> float:
+        # Strictly increasing so LRU order is well defined within one write
+        self._last = max(self._last + 1e-6, time.time())
+        return self._last
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Cached vectors in input order, None where missing."""
+        keys = [cache_key(model, t) for t in texts]
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i : i + 500]
+                marks = ",".join("?" * len(part))
+                found.update(self.conn.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part))
+            if found:
+                with self.conn:
+                    self.conn.executemany("UPDATE embeddings SET used = ? WHERE key = ?", [(self._now(), k) for k in found])
+            out = [np.frombuffer(found[k], dtype="<f4").tolist() if k in found else None for k in keys]
+            hit = sum(1 for v in out if v is not None)
+            self.hits += hit
+            self.misses += len(out) - hit
+        return out
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Optional[List[float]]]):
+        pairs = list({cache_key(model, t): np.asarray(v, dtype="<f4").tobytes() for t, v in zip(texts, vectors) if v}.items())
+        if not pairs:
+            return
+        with self._lock:
+            rows = [(k, blob, self._now()) for k, blob in pairs]
+            with self.conn:
+                keys = [r[0] for r in rows]
+                replaced = 0
+                for i in range(0, len(keys), 500):
+                    part = keys[i : i + 500]
+                    marks = ",".join("?" * len(part))
+                    sql = f"SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings WHERE key IN ({marks})"
+                    replaced += int(self.conn.execute(sql, part).fetchone()[0])
+                self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, vec, used) VALUES (?,?,?)", rows)
+                self._bytes += sum(len(r[1]) for r in rows) - replaced
+                if self._bytes > self.max_bytes:
+                    self._evict()
+
+    def _evict(self):
+        # Drop the oldest entries down to 90% of the budget so eviction is not run on every write
+        target = int(self.max_bytes * 0.9)
+        cur = self.conn.execute("SELECT key, LENGTH(vec) FROM embeddings ORDER BY used")
+        doomed = []
+        while self._bytes > target:
+            row = cur.fetchone()
+            if row is None:
+                break
+            doomed.append((row[0],))
+            self._bytes -= int(row[1])
+        cur.close()
+        self.conn.executemany("DELETE FROM embeddings WHERE key = ?", doomed)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            n = int(self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0])
+            return {"entries": n, "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+class QueryEmbeddingCache:
+    """Small in-memory LRU with TTL for embeddings of questions and other short,
+    frequently repeated texts; same keys as EmbeddingCache.
+    """
+
+    def __init__(self, max_entries: int = 2048, ttl: float = 3600.0):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        out: List[Optional[List[float]]] = []
+        now = time.monotonic()
+        with self._lock:
+            for text in texts:
+                key = cache_key(model, text)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] <= now:
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    out.append(None)
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                out.append(list(entry[1]))
+        return out
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Optional[List[float]]]):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for text, vec in zip(texts, vectors):
+                if not vec:
+                    continue
+                key = cache_key(model, text)
+                self._entries[key] = (expires, list(vec))
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,139 @@
+"""Batched calls to an embeddings endpoint.
+
+Inputs are split into batches bounded by item count and by an estimated token
+count, and the batches are sent concurrently with at most `concurrency`
+requests in flight per call. Rate limits and transient upstream errors
+are retried per batch with exponential backoff and full jitter; a batch that
+still fails leaves None in its slots instead of failing the whole call.
+"""
+import asyncio
+import logging
+import random
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+logger = logging.getLogger("ai_engine")
+
+# Status codes worth retrying; anything else (bad input, auth) fails the batch at once
+_RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap upper-ish estimate (~4 bytes per token for English, more for other scripts)."""
+    return max(1, (len((text or "").encode("utf-8")) + 3) // 4)
+
+
+def plan_batches(texts: Sequence[str], max_items: int, max_tokens: int) -> List[List[int]]:
+    """Group input positions into consecutive batches within both limits.
+    A single text above max_tokens gets a batch of its own.
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    tokens = 0
+    for i, text in enumerate(texts):
+        n = estimate_tokens(text)
+        if current and (len(current) >= max_items or tokens + n > max_tokens):
+            batches.append(current)
+            current, tokens = [], 0
+        current.append(i)
+        tokens += n
+    if current:
+        batches.append(current)
+    return batches
+
+
+def is_retryable(exc: Exception) -> bool:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return int(status) in _RETRY_STATUS
+    # Connection errors and timeouts carry no status code
+    name = type(exc).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        value = headers.get("retry-after")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class EmbedResult:
+    vectors: List[Optional[List[float]]]
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for v in self.vectors if v is None)
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        create: Callable[..., Awaitable[List[List[float]]]],
+        max_items: int = 256,
+        max_tokens: int = 100000,
+        concurrency: int = 4,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+    ):
+        self.create = create
+        self.max_items = max(1, max_items)
+        self.max_tokens = max(1, max_tokens)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+    def _backoff(self, attempt: int, exc: Exception) -> float:
+        hinted = _retry_after(exc)
+        if hinted is not None:
+            return min(self.max_delay, hinted)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _send(self, texts: List[str], **kwargs) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                vectors = await self.create(texts, **kwargs)
+                if len(vectors) != len(texts):
+                    raise RuntimeError(f"expected {len(texts)} embeddings, got {len(vectors)}")
+                return vectors
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning("embed retry attempt=%s batch=%s delay=%.2fs error=%s", attempt + 1, len(texts), delay, e)
+                await self.sleep(delay)
+                attempt += 1
+
+    async def embed(self, texts: Sequence[str], **kwargs) -> EmbedResult:
+        """Embed texts in order; extra keyword arguments are passed to every create() call."""
+        texts = list(texts)
+        result = EmbedResult(vectors=[None] * len(texts))
+        window = asyncio.Semaphore(self.concurrency)
+
+        async def run(idx: List[int]):
+            async with window:
+                try:
+                    return idx, await self._send([texts[i] for i in idx], **kwargs), None
+                except Exception as e:
+                    return idx, None, e
+
+        batches = plan_batches(texts, self.max_items, self.max_tokens)
+        for idx, vectors, exc in await asyncio.gather(*(run(b) for b in batches)):
+            if exc is not None:
+                logger.error("embed batch_failed batch=%s first=%s error=%s", len(idx), idx[0], exc)
+                result.errors.append(str(exc))
+                continue
+            for i, vec in zip(idx, vectors):
+                result.vectors[i] = vec
+        return result
@@ -0,0 +1,34 @@
+"""Concurrency limits for calls to upstream services (OpenAI endpoints, ...).
+
+Each named upstream gets its own semaphore, so a burst of document indexing
+cannot starve /ask of chat completions and no upstream sees more in-flight
+requests than it is configured for. Semaphores are created per event loop.
+"""
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+from typing import Dict
+
+
+class UpstreamLimiter:
+    def __init__(self, limits: Dict[str, int], default: int = 16):
+        self.limits = {k: max(1, int(v)) for k, v in limits.items()}
+        self.default = max(1, default)
+        self.in_flight: Dict[str, int] = {}
+        self._sems: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+
+    def _semaphore(self, name: str) -> asyncio.Semaphore:
+        per_loop = self._sems.setdefault(asyncio.get_running_loop(), {})
+        sem = per_loop.get(name)
+        if sem is None:
+            sem = per_loop[name] = asyncio.Semaphore(self.limits.get(name, self.default))
+        return sem
+
+    @asynccontextmanager
+    async def __call__(self, name: str):
+        async with self._semaphore(name):
+            self.in_flight[name] = self.in_flight.get(name, 0) + 1
+            try:
+                yield
+            finally:
+                self.in_flight[name] -= 1
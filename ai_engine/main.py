@@ -1,17 +1,41 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional, Set
-from openai import OpenAI
-import os, json, hashlib, re
-from fastapi.responses import JSONResponse
+from typing import AsyncIterator, Callable, List, Dict, Any, Literal, Optional, Set, Tuple
+from openai import AsyncOpenAI
+import os, json, hashlib, re, asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
+from contextlib import asynccontextmanager
 import logging
 from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
 
 # Import sibling module directly since this service runs as a top-level module (uvicorn main:app)
-from vector_store import VectorStore, chunk_text
+from vector_store import VectorStore, content_hash
+from chunking import chunk_document
+from embeddings import EmbeddingBatcher, EmbedResult
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache
+from limits import UpstreamLimiter
+from answer_cache import AnswerCache
+from rerank import Reranker
+from context_pack import pack_context
+from diversify import cap_per_group, mmr_order
+from answer_stream import AnswerFieldDecoder, MarkerTracker, ndjson_frame, sse_frame
 
-app = FastAPI(title="AI Engine")
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    yield
+    # Stop background index work and persist in-memory index state (e.g. IVF partitions)
+    # so restarts skip the rebuild
+    store.close()
+    query_executor.shutdown(wait=False)
+
+
+app = FastAPI(title="AI Engine", lifespan=lifespan)
 
 # ----- Logging -----
 AI_LOG_DIR = os.getenv("AI_LOG_DIR") or os.getenv("VECTOR_DB_DIR") or "/data/logs"
@@ -46,16 +70,87 @@ app.add_middleware(
 )
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-client = OpenAI(api_key=OPENAI_API_KEY or None)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY or None)
+# Max in-flight requests per upstream, shared by all handlers of this worker
+upstream = UpstreamLimiter(
+    {
+        "embeddings": int(os.getenv("OPENAI_EMBED_MAX_INFLIGHT", 16)),
+        "chat": int(os.getenv("OPENAI_CHAT_MAX_INFLIGHT", 64)),
+    }
+)
 
 DB_PATH = os.getenv("VECTOR_DB_PATH", os.path.join(os.path.dirname(__file__), "vector_store.sqlite3"))
 store = VectorStore(DB_PATH)
+# Embeddings of recent questions; QUERY_EMBED_CACHE_SIZE=0 disables it
+_query_cache_size = int(os.getenv("QUERY_EMBED_CACHE_SIZE", 2048))
+query_embed_cache = (
+    QueryEmbeddingCache(max_entries=_query_cache_size, ttl=float(os.getenv("QUERY_EMBED_CACHE_TTL", 3600)))
+    if _query_cache_size > 0
+    else None
+)
+# Answers to repeated / near-duplicate questions; ANSWER_CACHE_SIZE=0 disables it
+_answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", 1024))
+answer_cache = (
+    AnswerCache(
+        max_entries=_answer_cache_size,
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", 600)),
+        similarity=float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.97)),
+    )
+    if _answer_cache_size > 0
+    else None
+)
+# Chunk size for indexing, in tokens (see chunking.chunk_document)
+CHUNK_TARGET_TOKENS = int(os.getenv("CHUNK_TARGET_TOKENS", 300))
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", 400))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 40))
+# Default /ask retrieval: "hybrid" (vector + FTS5 BM25, fused by reciprocal rank) or "vector"
+RETRIEVAL_MODE = (os.getenv("RETRIEVAL_MODE") or "hybrid").strip().lower()
+# Rescoring of the retrieved candidates before the context is chosen; RERANK_ENABLED=0 keeps vector order.
+# RERANK_CROSS_ENCODER names an optional sentence-transformers cross-encoder (e.g. cross-encoder/ms-marco-MiniLM-L-6-v2)
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+reranker = Reranker(
+    vector_weight=float(os.getenv("RERANK_VECTOR_WEIGHT", 0.5)),
+    bm25_weight=float(os.getenv("RERANK_BM25_WEIGHT", 0.3)),
+    coverage_weight=float(os.getenv("RERANK_COVERAGE_WEIGHT", 0.2)),
+    cross_encoder=os.getenv("RERANK_CROSS_ENCODER") or None,
+    cross_encoder_weight=float(os.getenv("RERANK_CROSS_ENCODER_WEIGHT", 0.6)),
+)
+# Candidate diversification before packing: DIVERSITY_MODE=mmr|none, MAX_CHUNKS_PER_DOCUMENT=0 disables the cap
+DIVERSITY_MODE = (os.getenv("DIVERSITY_MODE") or "mmr").strip().lower()
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7))
+MAX_CHUNKS_PER_DOCUMENT = int(os.getenv("MAX_CHUNKS_PER_DOCUMENT", 0))
+# Prompt tokens for the retrieved sources of one /ask; the best chunks are packed until it is spent
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# Scoring is CPU-bound (NumPy releases the GIL); keep it off the event loop and the default threadpool
+query_executor = ThreadPoolExecutor(max_workers=int(os.getenv("VECTOR_QUERY_WORKERS", os.cpu_count() or 4)), thread_name_prefix="vector-query")
+# Embeddings of already-seen chunk text; EMBED_CACHE_MAX_MB=0 disables it
+_embed_cache_mb = int(os.getenv("EMBED_CACHE_MAX_MB", 512))
+embed_cache = EmbeddingCache(os.getenv("EMBED_CACHE_PATH") or f"{DB_PATH}.embcache", max_bytes=_embed_cache_mb * 1024 * 1024) if _embed_cache_mb > 0 else None
+
+
+class RetrievalFilters(BaseModel):
+    organization: Optional[str] = Field(None, description="Tenant (organization id) that owns the chunks")
+    uploader: Optional[str] = Field(None, description="User id that uploaded the document")
+    document_ids: Optional[List[str]] = Field(None, description="Restrict retrieval to these documents")
+    source_type: Optional[str] = Field(None, description="Source kind (pdf, web, email, ...)")
+    date_from: Optional[str] = Field(None, description="ISO date/datetime (naive means UTC); documents ingested on or after")
+    date_to: Optional[str] = Field(None, description="ISO date/datetime (naive means UTC); documents ingested on or before")
 
 
 class AskRequest(BaseModel):
     question: str
     top_k: int = 5
     with_sources: bool = True
+    nprobe: Optional[int] = Field(None, ge=1, description="ANN partitions to scan (VECTOR_INDEX=ivf); higher = better recall, slower")
+    filters: Optional[RetrievalFilters] = Field(None, description="Applied inside the vector store before scoring")
+    retrieval: Optional[Literal["vector", "hybrid"]] = Field(
+        None, description="hybrid fuses BM25 (exact terms, codes, names) with vector similarity; defaults to RETRIEVAL_MODE"
+    )
+    diversity: Optional[Literal["mmr", "none"]] = Field(
+        None, description="mmr reorders candidates to avoid near-identical neighbouring chunks; defaults to DIVERSITY_MODE"
+    )
+    mmr_lambda: Optional[float] = Field(None, ge=0.0, le=1.0, description="MMR relevance weight; 1.0 = pure relevance (default MMR_LAMBDA)")
+    max_per_document: Optional[int] = Field(None, ge=1, description="At most this many chunks per document (default MAX_CHUNKS_PER_DOCUMENT, 0 = no cap)")
 
 
 class PageChunk(BaseModel):
@@ -90,6 +185,9 @@ class IndexDocumentRequest(BaseModel):
     metadata: Optional[Dict[str, Any]] = Field(None, description="Base metadata to attach to every chunk (location, provider, etc.)")
     source_type: Optional[str] = Field(None, description="Source kind (pdf, web, drive, etc.)")
     origin_url: Optional[str] = Field(None, description="Original URL if available for citation deep links")
+    incremental: bool = Field(
+        True, description="Re-embed only new or changed chunks; false re-embeds every chunk, bypassing the embedding cache"
+    )
 
 
 class Citation(BaseModel):
@@ -115,6 +213,8 @@ class Citation(BaseModel):
     chunk_id: Optional[str] = None
     chunk_index: Optional[int] = None
     extra: Optional[Dict[str, Any]] = None
+    # Packed text rendered into the prompt; the response only carries the snippet
+    context: Optional[str] = Field(None, exclude=True)
 
 
 def _clean_snippet(text: str, limit: int = 420) -> str:
@@ -187,12 +287,17 @@ def _serialize_citation(c: Citation) -> Dict[str, Any]:
     return data
 
 
-def _build_citations(matches: List[Dict[str, Any]], limit: int) -> List[Citation]:
+def _match_doc_id(match: Dict[str, Any]) -> str:
+    meta = match.get("metadata") or {}
+    return str(meta.get("document_id") or meta.get("documentId") or meta.get("doc_id") or "").strip()
+
+
+def _build_citations(matches: List[Dict[str, Any]], limit: int, with_context: bool = False) -> List[Citation]:
     citations: List[Citation] = []
     seen_chunks: Set[str] = set()
     for match in matches:
         meta = match.get("metadata") or {}
-        doc_id = str(meta.get("document_id") or meta.get("documentId") or meta.get("doc_id") or "").strip()
+        doc_id = _match_doc_id(match)
         if not doc_id:
             continue
         chunk_idx = _coerce_chunk_index(meta)
@@ -230,6 +335,9 @@ def _build_citations(matches: List[Dict[str, Any]], limit: int) -> List[Citation
             "rowId",
             "column",
             "extra",
+            "organization",
+            "uploader",
+            "created_at",
         }
         extra_from_meta = {}
         if isinstance(meta.get("extra"), dict):
@@ -260,6 +368,7 @@ def _build_citations(matches: List[Dict[str, Any]], limit: int) -> List[Citation
             score=float(match.get("score") or 0.0),
             snippet=snippet,
             extra=extra_from_meta or None,
+            context=(match.get("content") or "") if with_context else None,
         )
         citations.append(citation)
         if len(citations) >= limit:
@@ -311,7 +420,10 @@ def _render_sources_for_prompt(citations: List[Citation]) -> str:
     for c in citations:
         title = c.doc_title or c.doc_id
         loc = _location_label(c)
-        snippet = c.snippet or ""
+        snippet = c.context or c.snippet or ""
+        section = (c.extra or {}).get("heading_path")
+        if isinstance(section, list) and section:
+            loc = f"{loc}; section {' > '.join(str(h) for h in section)}"
         lines.append(f"[{c.id}] {c.source_type.upper()} – \"{title}\"\nLocation: {loc}\nSnippet: \"{snippet}\"")
     return "\n\n".join(lines)
 
@@ -352,25 +464,95 @@ def _extract_markers(answer: str) -> List[str]:
     return out
 
 
-def embed_texts(texts: List[str]) -> List[List[float]]:
-    if not OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY not set")
-    # simple retry on transient errors
-    last_exc = None
-    for _ in range(2):
-        try:
-            resp = client.embeddings.create(model=os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small"), input=texts)
-            return [d.embedding for d in resp.data]
-        except Exception as e:
-            last_exc = e
-    raise RuntimeError(f"embed_failed: {last_exc}")
+def _retrieval_filters(filters: Optional[RetrievalFilters]) -> Optional[Dict[str, Any]]:
+    if filters is None:
+        return None
+    out = filters.dict(exclude_none=True)
+    if out.get("source_type"):
+        out["source_type"] = _normalize_source_type({"source_type": out["source_type"]})
+    return out or None
 
 
-def answer_with_openai(question: str, citations: List[Citation]) -> Dict[str, Any]:
+async def _create_embeddings(texts: List[str], model: Optional[str] = None) -> List[List[float]]:
+    # Retries are handled per batch by the batcher, not by the client
+    async with upstream("embeddings"):
+        resp = await client.with_options(max_retries=0).embeddings.create(
+            model=model or os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small"), input=texts
+        )
+    return [d.embedding for d in resp.data]
+
+
+embedder = EmbeddingBatcher(
+    _create_embeddings,
+    max_items=int(os.getenv("EMBED_BATCH_SIZE", 256)),
+    max_tokens=int(os.getenv("EMBED_BATCH_TOKENS", 100000)),
+    concurrency=int(os.getenv("EMBED_CONCURRENCY", 4)),
+    max_retries=int(os.getenv("EMBED_MAX_RETRIES", 5)),
+)
+
+
+async def embed_texts_partial(texts: List[str], model: Optional[str] = None) -> EmbedResult:
+    """Embed in batches; texts of a batch that kept failing come back as None."""
     if not OPENAI_API_KEY:
         raise RuntimeError("OPENAI_API_KEY not set")
-    if not citations:
-        return {"answer": "", "citations_used": []}
+    return await embedder.embed(texts, model=model)
+
+
+async def embed_texts_cached(texts: List[str], model: Optional[str] = None, refresh: bool = False) -> EmbedResult:
+    """embed_texts_partial that only sends texts missing from the embedding cache. With
+    `refresh` every text is sent and the new vectors replace the cached ones.
+    """
+    model = model or os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+    if embed_cache is None:
+        return await embed_texts_partial(texts, model=model)
+    vectors: List[Optional[List[float]]] = [None] * len(texts)
+    if not refresh:
+        try:
+            vectors = await run_in_threadpool(embed_cache.get_many, model, texts)
+        except Exception as e:
+            logger.warning("embed_cache read_failed error=%s", e)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    res = EmbedResult(vectors=vectors)
+    if missing:
+        fresh = await embed_texts_partial([texts[i] for i in missing], model=model)
+        for i, vec in zip(missing, fresh.vectors):
+            vectors[i] = vec
+        res.errors = fresh.errors
+        try:
+            await run_in_threadpool(embed_cache.put_many, model, [texts[i] for i in missing], fresh.vectors)
+        except Exception as e:
+            logger.warning("embed_cache write_failed error=%s", e)
+    logger.info("embed_cache hits=%s misses=%s", len(texts) - len(missing), len(missing))
+    return res
+
+
+async def embed_queries(texts: List[str], model: Optional[str] = None, persistent: bool = False) -> EmbedResult:
+    """Embed query-time texts through the in-memory query cache. Misses go to the provider,
+    via the persistent embedding cache as well when `persistent`.
+    """
+    model = model or os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+    vectors = query_embed_cache.get_many(model, texts) if query_embed_cache is not None else [None] * len(texts)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    res = EmbedResult(vectors=vectors)
+    if missing:
+        embed_fn = embed_texts_cached if persistent else embed_texts_partial
+        fresh = await embed_fn([texts[i] for i in missing], model=model)
+        for i, vec in zip(missing, fresh.vectors):
+            vectors[i] = vec
+        res.errors = fresh.errors
+        if query_embed_cache is not None:
+            query_embed_cache.put_many(model, [texts[i] for i in missing], fresh.vectors)
+    return res
+
+
+async def embed_texts(texts: List[str]) -> List[List[float]]:
+    res = await embed_queries(texts)
+    if res.failed:
+        raise RuntimeError(f"embed_failed: {res.errors[0] if res.errors else 'missing embeddings'}")
+    return res.vectors
+
+
+def _answer_messages(question: str, citations: List[Citation]) -> List[Dict[str, str]]:
     ctx = _render_sources_for_prompt(citations)
     sys = (
         "You are DocuIQ's enterprise research assistant. "
@@ -390,15 +572,14 @@ def answer_with_openai(question: str, citations: List[Citation]) -> Dict[str, An
         "Do not invent citation IDs or pages. Omit bullets/table if not needed but keep the keys."
     )
     user = f"Question: {question}\n\nSources:\n{ctx}\n\n{format_hint}"
-    resp = client.chat.completions.create(
-        model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
-        messages=[
-            {"role": "system", "content": sys},
-            {"role": "user", "content": user},
-        ],
-        temperature=0.1,
-    )
-    raw = resp.choices[0].message.content.strip()
+    return [
+        {"role": "system", "content": sys},
+        {"role": "user", "content": user},
+    ]
+
+
+def _parse_answer(raw: str) -> Dict[str, Any]:
+    raw = (raw or "").strip()
     parsed = _extract_json_block(raw) or {}
     if "answer" not in parsed:
         parsed["answer"] = raw
@@ -407,110 +588,496 @@ def answer_with_openai(question: str, citations: List[Citation]) -> Dict[str, An
     return parsed
 
 
-@app.post("/index_document")
-def index_document(req: IndexDocumentRequest):
-    try:
-        logger.info(
-            "index_document doc_id=%s title=%s pages=%s fragments=%s text_len=%s",
-            req.document_id,
-            (req.doc_title or req.title or "")[:80],
-            len(req.pages or []),
-            len(req.fragments or []),
-            len(req.text or ""),
+async def answer_with_openai(question: str, citations: List[Citation]) -> Dict[str, Any]:
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY not set")
+    if not citations:
+        return {"answer": "", "citations_used": []}
+    async with upstream("chat"):
+        resp = await client.chat.completions.create(
+            model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+            messages=_answer_messages(question, citations),
+            temperature=0.1,
         )
-    except Exception:
-        pass
-    items: List[Dict[str, Any]] = []
-    texts_to_embed: List[str] = []
-    metas: List[Dict[str, Any]] = []
-
-    base_title = (req.doc_title or req.title or "").strip() or None
-    source_type = _normalize_source_type({"source_type": req.source_type}) or None
-    origin_url = (req.origin_url or "").strip() or None
-    base_meta = dict(req.metadata or {})
-    chunk_counter = 0
-
-    def _append_chunk(text: str, meta_patch: Dict[str, Any], chunk_override: Optional[int] = None):
-        nonlocal chunk_counter
+    return _parse_answer(resp.choices[0].message.content)
+
+
+async def stream_answer_with_openai(question: str, citations: List[Citation]) -> AsyncIterator[str]:
+    """Raw completion text of answer_with_openai, yielded as it is generated."""
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY not set")
+    async with upstream("chat"):
+        stream = await client.chat.completions.create(
+            model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+            messages=_answer_messages(question, citations),
+            temperature=0.1,
+            stream=True,
+        )
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+
+async def query_store(embedding: List[float], **kwargs) -> List[Dict[str, Any]]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(query_executor, lambda: store.query(embedding, **kwargs))
+
+
+async def rerank_matches(question: str, matches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Reorder vector matches by the fused rerank score (kept as match["rerank_score"])."""
+    if len(matches) < 2:
+        return matches
+    passages = [m.get("content") or "" for m in matches]
+    scores = [float(m.get("score") or 0.0) for m in matches]
+    loop = asyncio.get_running_loop()
+    ranked = await loop.run_in_executor(query_executor, lambda: reranker.rerank(question, passages, scores))
+    out = []
+    for i, score in ranked:
+        m = dict(matches[i])
+        m["rerank_score"] = score
+        out.append(m)
+    return out
+
+
+class _DocumentChunks:
+    """Chunk texts and metadata of one document, built from its text, pages or fragments.
+    Records may be fed one at a time (see /index_document/stream); the chunk counter and
+    the open sections carry over from one page or text record to the next.
+    """
+
+    def __init__(
+        self,
+        document_id: str,
+        title: Optional[str] = None,
+        doc_title: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        source_type: Optional[str] = None,
+        origin_url: Optional[str] = None,
+    ):
+        self.document_id = document_id
+        self.base_title = (doc_title or title or "").strip() or None
+        self.source_type = _normalize_source_type({"source_type": source_type}) or None
+        self.origin_url = (origin_url or "").strip() or None
+        self.base_meta = dict(metadata or {})
+        self.counter = 0
+        self.text_chunks = 0
+        self.headings: List[Tuple[int, str]] = []
+
+    @classmethod
+    def for_request(cls, req: IndexDocumentRequest) -> "_DocumentChunks":
+        return cls(req.document_id, req.title, req.doc_title, req.metadata, req.source_type, req.origin_url)
+
+    def _split(self, text: str, headings: Optional[List[Tuple[int, str]]] = None):
+        for c in chunk_document(
+            text or "",
+            target_tokens=CHUNK_TARGET_TOKENS,
+            max_tokens=CHUNK_MAX_TOKENS,
+            overlap_tokens=CHUNK_OVERLAP_TOKENS,
+            headings=headings,
+        ):
+            yield c.text, ({"heading_path": c.heading_path} if c.heading_path else {})
+
+    def _chunk(self, text: str, meta_patch: Dict[str, Any], chunk_override: Optional[int] = None) -> Optional[Dict[str, Any]]:
         if not text:
-            return
+            return None
         meta = {}
-        meta.update({k: v for k, v in base_meta.items() if v is not None})
+        meta.update({k: v for k, v in self.base_meta.items() if v is not None})
         meta.update({k: v for k, v in (meta_patch or {}).items() if v is not None})
-        meta["document_id"] = req.document_id
-        meta["doc_id"] = req.document_id
-        if base_title and not meta.get("title"):
-            meta["title"] = base_title
-        if base_title and not meta.get("doc_title"):
-            meta["doc_title"] = base_title
-        resolved_type = _normalize_source_type(meta, fallback=source_type) or "document"
-        meta["source_type"] = resolved_type
-        if origin_url and not meta.get("origin_url"):
-            meta["origin_url"] = origin_url
+        meta["document_id"] = self.document_id
+        meta["doc_id"] = self.document_id
+        if self.base_title and not meta.get("title"):
+            meta["title"] = self.base_title
+        if self.base_title and not meta.get("doc_title"):
+            meta["doc_title"] = self.base_title
+        meta["source_type"] = _normalize_source_type(meta, fallback=self.source_type) or "document"
+        if self.origin_url and not meta.get("origin_url"):
+            meta["origin_url"] = self.origin_url
         # Preserve explicit page numbers only; never derive from chunk offsets
         if "page" in meta and meta["page"] is not None:
             try:
                 meta["page"] = int(meta["page"])
             except Exception:
                 meta["page"] = None
-        current_counter = chunk_counter
-        chunk_idx = chunk_override if chunk_override is not None else current_counter
-        meta["chunk"] = chunk_idx
-        chunk_id = meta.get("chunk_id") or f"{req.document_id}:p{meta.get('page') or 0}:c{current_counter}"
+        meta["chunk"] = chunk_override if chunk_override is not None else self.counter
+        chunk_id = meta.get("chunk_id") or f"{self.document_id}:p{meta.get('page') or 0}:c{self.counter}"
         meta["chunk_id"] = chunk_id
-        metas.append({k: v for k, v in meta.items() if v is not None})
-        texts_to_embed.append(text)
-        chunk_counter += 1
+        self.counter += 1
+        # ensure unique id across doc
+        uid = hashlib.sha1(chunk_id.encode("utf-8")).hexdigest()
+        return {"id": uid, "content": text, "metadata": {k: v for k, v in meta.items() if v is not None}}
+
+    def fragment(self, frag: Fragment) -> List[Dict[str, Any]]:
+        meta_patch = {
+            "page": frag.page,
+            "url": frag.url,
+            "message_id": frag.message_id,
+            "thread_id": frag.thread_id,
+            "ts": frag.ts,
+            "table": frag.table,
+            "row_id": frag.row_id,
+            "column": frag.column,
+            "chunk_id": frag.chunk_id,
+            "source_type": frag.source_type,
+            "doc_title": frag.doc_title,
+            "extra": frag.extra,
+        }
+        out = []
+        # Respect fragment chunk_id by suffixing split parts to retain location fidelity
+        for j, (ch, structure) in enumerate(self._split(frag.text)):
+            derived_chunk_id = frag.chunk_id
+            if frag.chunk_id and j > 0:
+                derived_chunk_id = f"{frag.chunk_id}-c{j}"
+            out.append(self._chunk(
+                ch,
+                {**meta_patch, **structure, **({"chunk_id": derived_chunk_id} if derived_chunk_id else {})},
+                chunk_override=j if frag.chunk_id else None,
+            ))
+        return [c for c in out if c]
+
+    def page(self, p: PageChunk) -> List[Dict[str, Any]]:
+        # Preserve page number in metadata; sections carry over pages
+        page_meta = dict(p.meta or {})
+        page_meta["page"] = p.page
+        out = [
+            self._chunk(ch, {**page_meta, **structure, "chunk_id": f"{self.document_id}:p{p.page or 0}:c{j}"}, chunk_override=j)
+            for j, (ch, structure) in enumerate(self._split(p.text, self.headings))
+        ]
+        return [c for c in out if c]
+
+    def text(self, text: str) -> List[Dict[str, Any]]:
+        """Chunks of plain text; consecutive calls continue one text (chunk ids keep counting)."""
+        out = []
+        for ch, structure in self._split(text, self.headings):
+            j = self.text_chunks
+            self.text_chunks += 1
+            out.append(self._chunk(ch, {**structure, "chunk_id": f"{self.document_id}:c{j}"}, chunk_override=j))
+        return [c for c in out if c]
+
+
+class _EmbedFailed(Exception):
+    pass
+
+
+class _DocumentIndexer:
+    """Diff chunks of one document against what is stored, embed new or changed ones and
+    store them, one batch at a time; chunks that vanished are removed by finish().
+    """
+
+    def __init__(self, document_id: str, incremental: bool, existing: Dict[str, Tuple[str, str]]):
+        self.document_id = document_id
+        self.incremental = incremental
+        self.existing = existing
+        self.seen: Set[str] = set()
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.embedded = 0
+        self.failed = 0
+        self.errors: List[str] = []
+
+    @property
+    def chunks(self) -> int:
+        return self.added + self.updated + self.unchanged
+
+    async def add(self, chunks: List[Dict[str, Any]]) -> None:
+        """Store one batch. Raises _EmbedFailed when nothing could be embedded so far."""
+        batch: Dict[str, Dict[str, Any]] = {}
+        for item in chunks:
+            if item["id"] not in self.seen:
+                batch[item["id"]] = item
+        self.seen.update(batch)
+        to_embed: List[Dict[str, Any]] = []
+        meta_only: List[Dict[str, Any]] = []
+        for uid, item in batch.items():
+            old = self.existing.get(uid)
+            if not self.incremental or old is None or old[0] != content_hash(item["content"]):
+                to_embed.append(item)
+            elif old[1] != json.dumps(item["metadata"]):
+                meta_only.append(item)
+            else:
+                self.unchanged += 1
+        try:
+            embedded = (
+                await embed_texts_cached([it["content"] for it in to_embed], refresh=not self.incremental)
+                if to_embed
+                else EmbedResult(vectors=[])
+            )
+        except Exception as e:
+            raise _EmbedFailed(str(e)) from e
+        if to_embed and embedded.failed == len(to_embed) and not self.embedded:
+            raise _EmbedFailed(embedded.errors[0] if embedded.errors else "")
+
+        items = [{**it, "embedding": emb} for it, emb in zip(to_embed, embedded.vectors) if emb is not None]
+        await run_in_threadpool(store.add_many, items)
+        await run_in_threadpool(store.update_metadata, meta_only)
+        if answer_cache is not None and (items or meta_only):
+            answer_cache.invalidate_documents([self.document_id])
+        added = sum(1 for it in items if it["id"] not in self.existing)
+        self.added += added
+        self.updated += len(items) - added + len(meta_only)
+        self.embedded += len(items)
+        self.failed += embedded.failed
+        self.errors.extend(e for e in embedded.errors if e not in self.errors)
+
+    async def finish(self) -> None:
+        removed_ids = [uid for uid in self.existing if uid not in self.seen]
+        self.removed = await run_in_threadpool(store.delete_ids, removed_ids)
+        if answer_cache is not None and self.removed:
+            answer_cache.invalidate_documents([self.document_id])
+
+    def result(self) -> Dict[str, Any]:
+        total = self.chunks
+        logger.info(
+            "index_document stored doc_id=%s chunks=%s added=%s updated=%s removed=%s unchanged=%s failed=%s",
+            self.document_id, total, self.added, self.updated, self.removed, self.unchanged, self.failed,
+        )
+        out = {
+            "ok": True,
+            "chunks": total,
+            "added": self.added,
+            "updated": self.updated,
+            "removed": self.removed,
+            "unchanged": self.unchanged,
+        }
+        if self.failed:
+            # Partial success: the failed chunks can be filled in by indexing the document again
+            out["failed_chunks"] = self.failed
+            out["errors"] = self.errors
+        return out
+
 
+def _request_chunks(doc: _DocumentChunks, req: IndexDocumentRequest) -> List[Dict[str, Any]]:
     if req.fragments:
-        for frag in req.fragments:
-            meta_patch = {
-                "page": frag.page,
-                "url": frag.url,
-                "message_id": frag.message_id,
-                "thread_id": frag.thread_id,
-                "ts": frag.ts,
-                "table": frag.table,
-                "row_id": frag.row_id,
-                "column": frag.column,
-                "chunk_id": frag.chunk_id,
-                "source_type": frag.source_type,
-                "doc_title": frag.doc_title,
-                "extra": frag.extra,
-            }
-            # Respect fragment chunk_id by suffixing split parts to retain location fidelity
-            for j, ch in enumerate(chunk_text(frag.text or "", target_chars=1100)):
-                derived_chunk_id = frag.chunk_id
-                if frag.chunk_id and j > 0:
-                    derived_chunk_id = f"{frag.chunk_id}-c{j}"
-                _append_chunk(ch, {**meta_patch, **({"chunk_id": derived_chunk_id} if derived_chunk_id else {})}, chunk_override=j if frag.chunk_id else None)
-    elif req.pages:
-        # Build chunks per page and preserve page number in metadata
-        for p in req.pages:
-            page_meta = dict(p.meta or {})
-            page_meta["page"] = p.page
-            for j, ch in enumerate(chunk_text(p.text or "", target_chars=1100)):
-                _append_chunk(ch, {**page_meta, "chunk_id": f"{req.document_id}:p{p.page or 0}:c{j}"}, chunk_override=j)
-    elif req.text:
-        for j, ch in enumerate(chunk_text(req.text or "", target_chars=1200)):
-            _append_chunk(ch, {"chunk_id": f"{req.document_id}:c{j}"}, chunk_override=j)
-    else:
+        return [c for frag in req.fragments for c in doc.fragment(frag)]
+    if req.pages:
+        return [c for p in req.pages for c in doc.page(p)]
+    return doc.text(req.text or "")
+
+
+@app.post("/index_document")
+async def index_document(req: IndexDocumentRequest):
+    try:
+        logger.info(
+            "index_document doc_id=%s title=%s pages=%s fragments=%s text_len=%s",
+            req.document_id,
+            (req.doc_title or req.title or "")[:80],
+            len(req.pages or []),
+            len(req.fragments or []),
+            len(req.text or ""),
+        )
+    except Exception:
+        pass
+    if not (req.fragments or req.pages or req.text):
         return JSONResponse({"ok": False, "error": "no_content", "detail": "Provide text, pages, or fragments"}, status_code=400)
+    chunks = await run_in_threadpool(_request_chunks, _DocumentChunks.for_request(req), req)
 
+    # Diff against what is stored: only new or changed chunks are embedded, vanished ones removed
+    existing = await run_in_threadpool(store.document_chunks, req.document_id)
+    indexer = _DocumentIndexer(req.document_id, req.incremental, existing)
     try:
-        embeds = embed_texts(texts_to_embed)
-    except Exception as e:
+        await indexer.add(chunks)
+    except _EmbedFailed as e:
         logger.exception("index_document embed_failed doc_id=%s error=%s", req.document_id, e)
         return JSONResponse({"ok": False, "error": "embed_failed", "detail": str(e)}, status_code=502)
+    await indexer.finish()
+    return indexer.result()
 
-    for i, (text, emb, meta) in enumerate(zip(texts_to_embed, embeds, metas)):
-        # ensure unique id across doc
-        chunk_key = meta.get("chunk_id") or f"{req.document_id}:{meta.get('chunk') or i}"
-        uid = hashlib.sha1(chunk_key.encode("utf-8")).hexdigest()
-        items.append({"id": uid, "content": text, "metadata": meta, "embedding": emb})
-    store.add_many(items)
-    logger.info("index_document stored doc_id=%s chunks=%s", req.document_id, len(items))
-    return {"ok": True, "chunks": len(items)}
+
+INDEX_STREAM_BATCH = int(os.getenv("INDEX_STREAM_BATCH", 128))
+# Longest NDJSON record accepted by /index_document/stream, in bytes
+INDEX_STREAM_MAX_LINE = int(os.getenv("INDEX_STREAM_MAX_LINE", 16 * 1024 * 1024))
+
+
+class IndexStreamHeader(BaseModel):
+    type: Literal["document"] = "document"
+    document_id: str
+    title: Optional[str] = None
+    doc_title: Optional[str] = None
+    metadata: Optional[Dict[str, Any]] = None
+    source_type: Optional[str] = None
+    origin_url: Optional[str] = None
+    incremental: bool = True
+
+
+async def _ndjson_records(body: AsyncIterator[bytes]) -> AsyncIterator[Dict[str, Any]]:
+    """Records of an NDJSON body; each byte is scanned once. Raises ValueError on a
+    record longer than INDEX_STREAM_MAX_LINE.
+    """
+    buf = bytearray()
+    async for block in body:
+        # buf holds the start of one unfinished line: only the new block needs scanning
+        scan = len(buf)
+        buf += block
+        start = 0
+        while True:
+            end = buf.find(b"\n", max(start, scan))
+            if end < 0:
+                break
+            if end - start > INDEX_STREAM_MAX_LINE:
+                raise ValueError(f"record longer than {INDEX_STREAM_MAX_LINE} bytes")
+            line = buf[start:end]
+            if line.strip():
+                yield json.loads(line)
+            start = end + 1
+        del buf[:start]
+        if len(buf) > INDEX_STREAM_MAX_LINE:
+            raise ValueError(f"record longer than {INDEX_STREAM_MAX_LINE} bytes")
+    if buf.strip():
+        yield json.loads(buf)
+
+
+def _record_chunks(doc: _DocumentChunks, record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    kind = record.get("type")
+    fields = {k: v for k, v in record.items() if k != "type"}
+    if kind == "page":
+        return doc.page(PageChunk(**fields))
+    if kind == "fragment":
+        return doc.fragment(Fragment(**fields))
+    if kind == "text":
+        return doc.text(str(fields.get("text") or ""))
+    raise ValueError(f"unknown record type: {kind!r}")
+
+
+def _ndjson_line(payload: Dict[str, Any]) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def _index_stream(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    records = _ndjson_records(body)
+    try:
+        header = IndexStreamHeader(**await records.__anext__())
+    except StopAsyncIteration:
+        yield _ndjson_line({"type": "error", "ok": False, "error": "no_content", "detail": "Empty request body"})
+        return
+    except Exception as e:
+        yield _ndjson_line({"type": "error", "ok": False, "error": "bad_record", "detail": f"header: {e}"})
+        return
+    logger.info("index_document stream doc_id=%s title=%s", header.document_id, (header.doc_title or header.title or "")[:80])
+    doc = _DocumentChunks(header.document_id, header.title, header.doc_title, header.metadata, header.source_type, header.origin_url)
+    existing = await run_in_threadpool(store.document_chunks, header.document_id)
+    indexer = _DocumentIndexer(header.document_id, header.incremental, existing)
+    progress = {"records": 0, "chunked": 0}
+
+    # Records are read and chunked while the previous batch is embedded; the bounded
+    # queue pushes back on the sender when embedding falls behind.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+    async def produce():
+        pending: List[Dict[str, Any]] = []
+        try:
+            async for record in records:
+                pending.extend(await run_in_threadpool(_record_chunks, doc, record))
+                progress["records"] += 1
+                progress["chunked"] = doc.counter
+                if len(pending) >= INDEX_STREAM_BATCH:
+                    await queue.put(pending)
+                    pending = []
+            await queue.put(pending)
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    reader = asyncio.create_task(produce())
+    try:
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                logger.warning("index_document stream bad_record doc_id=%s error=%s", header.document_id, batch)
+                yield _ndjson_line({"type": "error", "ok": False, "error": "bad_record", "detail": str(batch)})
+                return
+            try:
+                await indexer.add(batch)
+            except _EmbedFailed as e:
+                logger.exception("index_document embed_failed doc_id=%s error=%s", header.document_id, e)
+                yield _ndjson_line({"type": "error", "ok": False, "error": "embed_failed", "detail": str(e)})
+                return
+            yield _ndjson_line({
+                "type": "progress",
+                "records": progress["records"],
+                "chunks": progress["chunked"],
+                "stored": indexer.chunks,
+                "failed_chunks": indexer.failed,
+            })
+        # Only a complete document tells which stored chunks vanished
+        await indexer.finish()
+        yield _ndjson_line({"type": "done", **indexer.result()})
+    finally:
+        reader.cancel()
+
+
+class _RequestBodyStreamingResponse(StreamingResponse):
+    """A streaming response computed from the request body while it is still arriving.
+
+    Under ASGI spec < 2.4 (uvicorn) StreamingResponse calls receive() to listen for a
+    client disconnect while it streams, so the endpoint cannot read the body with
+    request.stream() at the same time: the two steal each other's messages. Here one
+    task owns receive(); body blocks reach `handler` through a bounded queue (a slow
+    handler stops the reads, which pushes back on the sender) and only the disconnect
+    is passed on to StreamingResponse.
+    """
+
+    def __init__(self, handler: Callable[[AsyncIterator[bytes]], AsyncIterator[bytes]], **kwargs):
+        super().__init__((), **kwargs)
+        self._handler = handler
+
+    async def __call__(self, scope, receive, send) -> None:
+        blocks: asyncio.Queue = asyncio.Queue(maxsize=8)
+        disconnected = asyncio.Event()
+
+        async def pump():
+            complete = False
+            while not disconnected.is_set():
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    if not complete:
+                        await blocks.put(ClientDisconnect())
+                elif not complete:
+                    if message.get("body"):
+                        await blocks.put(message["body"])
+                    if not message.get("more_body", False):
+                        complete = True
+                        await blocks.put(None)
+
+        async def body() -> AsyncIterator[bytes]:
+            while True:
+                block = await blocks.get()
+                if block is None:
+                    return
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+
+        async def wait_disconnect():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        self.body_iterator = self._handler(body())
+        reader = asyncio.create_task(pump())
+        try:
+            await super().__call__(scope, wait_disconnect, send)
+        finally:
+            reader.cancel()
+
+
+@app.post("/index_document/stream")
+async def index_document_stream():
+    """Index a document sent as NDJSON records: a {"type": "document", "document_id": ...}
+    header (the IndexDocumentRequest fields besides content), then any number of
+    {"type": "page"|"fragment"|"text", ...} records. Chunks are embedded and committed in
+    batches of INDEX_STREAM_BATCH while the body is still arriving. The response is NDJSON
+    as well: a {"type": "progress"} line per committed batch, then one {"type": "done"}
+    line with the /index_document result, or {"type": "error"}.
+    """
+    return _RequestBodyStreamingResponse(
+        _index_stream,
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 class UnindexRequest(BaseModel):
@@ -520,6 +1087,8 @@ class UnindexRequest(BaseModel):
 def unindex_document(req: UnindexRequest):
     try:
         removed = store.delete_by_document_id(req.document_id)
+        if answer_cache is not None:
+            answer_cache.invalidate_documents([req.document_id])
         logger.info("unindex_document doc_id=%s removed=%s", req.document_id, removed)
         return {"ok": True, "removed": removed}
     except Exception as e:
@@ -527,6 +1096,22 @@ def unindex_document(req: UnindexRequest):
         return JSONResponse({"ok": False, "error": "unindex_failed", "detail": str(e)}, status_code=500)
 
 
+class UnindexManyRequest(BaseModel):
+    document_ids: List[str] = Field(..., max_length=10000)
+
+@app.post("/unindex_documents")
+def unindex_documents(req: UnindexManyRequest):
+    try:
+        removed = store.delete_by_document_ids(req.document_ids)
+        if answer_cache is not None:
+            answer_cache.invalidate_documents(req.document_ids)
+        logger.info("unindex_documents docs=%s removed=%s", len(req.document_ids), removed)
+        return {"ok": True, "documents": len(req.document_ids), "removed": removed}
+    except Exception as e:
+        logger.exception("unindex_documents failed docs=%s error=%s", len(req.document_ids), e)
+        return JSONResponse({"ok": False, "error": "unindex_failed", "detail": str(e)}, status_code=500)
+
+
 class ClearAllResponse(BaseModel):
     removed: int
 
@@ -534,6 +1119,8 @@ class ClearAllResponse(BaseModel):
 def clear_all_vectors() -> ClearAllResponse:
     try:
         removed = store.clear_all()
+        if answer_cache is not None:
+            answer_cache.clear()
         logger.info("admin.clear_all removed=%s", removed)
         return {"removed": int(removed)}
     except Exception as e:
@@ -553,24 +1140,114 @@ async def upload(file: UploadFile = File(...)):
         logger.info("upload name=%s size=%s", file.filename, len(content or b""))
     except Exception:
         pass
-    index_document(IndexDocumentRequest(document_id=doc_id, title=file.filename, text=text))
+    await index_document(IndexDocumentRequest(document_id=doc_id, title=file.filename, text=text))
     return {"message": "uploaded", "document_id": doc_id}
 
 
-@app.post("/ask")
-def ask(req: AskRequest):
-    q = (req.question or "").strip()
-    if not q:
-        return {"answer": "", "citations": [], "inline_refs": {}}
-    logger.info("ask len=%s top_k=%s", len(q), req.top_k)
-    q_emb = embed_texts([q])[0]
+def _answer_scope(req: AskRequest) -> str:
+    """Everything besides the question that shapes an /ask answer, as a cache key."""
+    scope = {
+        "filters": _retrieval_filters(req.filters),
+        "top_k": req.top_k,
+        "with_sources": req.with_sources,
+        "nprobe": req.nprobe,
+        "retrieval": req.retrieval or RETRIEVAL_MODE,
+        "diversity": [req.diversity or DIVERSITY_MODE, req.mmr_lambda, req.max_per_document],
+    }
+    return json.dumps(scope, sort_keys=True, default=str)
+
+
+async def _cached_answer(req: AskRequest, q: str, scope: str) -> Tuple[Optional[Dict[str, Any]], Optional[List[float]]]:
+    """(cached answer, query embedding); the exact tier answers before anything is embedded."""
+    logger.info("ask len=%s top_k=%s filters=%s", len(q), req.top_k, sorted((req.filters.dict(exclude_none=True) if req.filters else {}).keys()))
+    if answer_cache is not None:
+        hit = answer_cache.get(scope, q)
+        if hit is not None:
+            logger.info("ask cache_hit tier=exact")
+            return hit, None
+    q_emb = (await embed_texts([q]))[0]
+    if answer_cache is not None:
+        hit = answer_cache.get_similar(scope, q_emb)
+        if hit is not None:
+            logger.info("ask cache_hit tier=semantic")
+            return hit, q_emb
+    return None, q_emb
+
+
+def _remember_answer(scope: str, q: str, q_emb: List[float], out: Dict[str, Any], citations: List[Citation], epoch: int):
+    if answer_cache is not None and out.get("answer"):
+        answer_cache.put(scope, q, q_emb, out, doc_ids=[c.doc_id for c in citations], epoch=epoch)
+
+
+def _diversify_sync(req: AskRequest, matches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    if (req.diversity or DIVERSITY_MODE) == "mmr" and len(matches) > 2:
+        found = store.vectors(m["id"] for m in matches)
+        dim = next((len(v) for v in found.values()), 0)
+        if dim:
+            zero = np.zeros(dim, dtype=np.float32)
+            vecs = np.stack([found.get(m["id"], zero) for m in matches])
+            relevance = [float(m.get("rerank_score", m.get("score")) or 0.0) for m in matches]
+            lambda_ = MMR_LAMBDA if req.mmr_lambda is None else req.mmr_lambda
+            matches = [matches[i] for i in mmr_order(relevance, vecs, lambda_)]
+    cap = req.max_per_document or MAX_CHUNKS_PER_DOCUMENT
+    if cap > 0:
+        matches = [matches[i] for i in cap_per_group([_match_doc_id(m) for m in matches], cap)]
+    return matches
+
+
+async def _diversify(req: AskRequest, matches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """MMR order and per-document cap over the ranked candidates (see diversify)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(query_executor, lambda: _diversify_sync(req, matches))
+
+
+_CHUNK_SUFFIX = re.compile(r"[:-]c\d+$")
+
+
+def _chunk_position(match: Dict[str, Any]) -> Optional[Tuple[Any, int]]:
+    """(document, page, source location) and chunk number, for merging neighbouring chunks."""
+    meta = match.get("metadata") or {}
+    chunk = _coerce_chunk_index(meta)
+    doc_id = _match_doc_id(match)
+    if chunk is None or not doc_id:
+        return None
+    where = tuple(str(meta.get(k) or "") for k in ("page", "url", "message_id", "thread_id", "table", "row_id"))
+    # Split parts of one fragment share the chunk_id stem ("...:p3:c2", "frag-c2")
+    stem = _CHUNK_SUFFIX.sub("", str(meta.get("chunk_id") or ""))
+    return (doc_id, where, stem), chunk
+
+
+async def _pack_matches(matches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Fit the ranked matches into CONTEXT_TOKEN_BUDGET (see context_pack)."""
+    # Chunks without a document never become citations; do not spend budget on them
+    matches = [m for m in matches if _match_doc_id(m)]
+    loop = asyncio.get_running_loop()
+    packed, stats = await loop.run_in_executor(query_executor, lambda: pack_context(matches, CONTEXT_TOKEN_BUDGET, _chunk_position))
+    logger.info(
+        "ask.context candidates=%s packed=%s tokens=%s duplicates=%s merged=%s truncated=%s",
+        stats.candidates,
+        stats.packed,
+        stats.tokens,
+        stats.duplicates,
+        stats.merged,
+        stats.truncated,
+    )
+    return packed
+
+
+async def _retrieve_citations(req: AskRequest, q_emb: List[float]) -> List[Citation]:
     max_matches = max(3, min(40, req.top_k * 4))
-    matches = store.query(q_emb, top_k=max_matches)
+    filters = _retrieval_filters(req.filters)
+    text = req.question if (req.retrieval or RETRIEVAL_MODE) == "hybrid" else None
+    matches = await query_store(q_emb, top_k=max_matches, nprobe=req.nprobe, filters=filters, text=text)
     if not matches:
-        return {"answer": "", "citations": [], "inline_refs": {}}
-    context_limit = max(1, min(len(matches), max(3, req.top_k * 2)))
-    context_matches = matches[:context_limit]
-    citations = _build_citations(context_matches, limit=context_limit)
+        return []
+    if RERANK_ENABLED:
+        # Rescore the whole candidate pool so the context window gets the best chunks, not just the nearest
+        matches = await rerank_matches(req.question, matches)
+    matches = await _diversify(req, matches)
+    context_matches = await _pack_matches(matches)
+    citations = _build_citations(context_matches, limit=len(context_matches), with_context=True)
     if not citations:
         citations = _build_citations(matches, limit=max(1, req.top_k))
     for c in citations:
@@ -578,11 +1255,10 @@ def ask(req: AskRequest):
             logger.info("ask.retrieval doc=%s page=%s score=%.3f chunk=%s", c.doc_id, c.page, c.score or 0.0, c.chunk_id)
         except Exception:
             pass
-    try:
-        llm = answer_with_openai(q, citations)
-    except Exception as e:
-        logger.exception("ask openai_failed error=%s", e)
-        return JSONResponse({"ok": False, "error": "openai_failed", "detail": str(e)}, status_code=502)
+    return citations
+
+
+def _assemble_answer(req: AskRequest, llm: Dict[str, Any], citations: List[Citation]) -> Dict[str, Any]:
     answer_text = (llm.get("answer") or "").strip()
     cited_ids = llm.get("citations_used") or _extract_markers(answer_text) or []
     cite_map = {c.id: _serialize_citation(c) for c in citations}
@@ -603,13 +1279,109 @@ def ask(req: AskRequest):
         "citations": used_citations if req.with_sources else [],
         "inline_refs": inline_refs,
         "blocks": blocks,
+        "citations_used": ordered_used,
     }
     if req.with_sources:
         out["all_citations"] = list(cite_map.values())
     return out
+
+
+@app.post("/ask")
+async def ask(req: AskRequest):
+    q = (req.question or "").strip()
+    if not q:
+        return {"answer": "", "citations": [], "inline_refs": {}}
+    scope = _answer_scope(req)
+    epoch = answer_cache.epoch() if answer_cache is not None else 0
+    cached, q_emb = await _cached_answer(req, q, scope)
+    if cached is not None:
+        return cached
+    citations = await _retrieve_citations(req, q_emb)
+    if not citations:
+        return {"answer": "", "citations": [], "inline_refs": {}}
+    try:
+        llm = await answer_with_openai(q, citations)
+    except Exception as e:
+        logger.exception("ask openai_failed error=%s", e)
+        return JSONResponse({"ok": False, "error": "openai_failed", "detail": str(e)}, status_code=502)
+    out = _assemble_answer(req, llm, citations)
+    _remember_answer(scope, q, q_emb, out, citations, epoch)
+    return out
+
+
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest, fmt: str = Query("sse", alias="format")):
+    """/ask as a stream of events, as SSE (default) or NDJSON (?format=ndjson):
+    citations (all retrieved sources, sent once retrieval is done), then token
+    (answer text deltas) interleaved with citation (a marker seen for the first
+    time, resolved against the sources; not sent when with_sources is false), then
+    done with the same body /ask returns plus citations_used, or error.
+    """
+    ndjson = fmt.lower() == "ndjson"
+    frame = ndjson_frame if ndjson else sse_frame
+    q = (req.question or "").strip()
+
+    async def events():
+        if not q:
+            yield frame("done", {"answer": "", "citations": [], "inline_refs": {}, "citations_used": []})
+            return
+        scope = _answer_scope(req)
+        epoch = answer_cache.epoch() if answer_cache is not None else 0
+        try:
+            cached, q_emb = await _cached_answer(req, q, scope)
+            if cached is not None:
+                yield frame("citations", {"citations": cached.get("all_citations") or cached.get("citations") or []})
+                yield frame("token", {"text": cached.get("answer") or ""})
+                yield frame("done", cached)
+                return
+            citations = await _retrieve_citations(req, q_emb)
+        except Exception as e:
+            logger.exception("ask.stream retrieval_failed error=%s", e)
+            yield frame("error", {"error": "retrieval_failed", "detail": str(e)})
+            return
+        cite_map = {c.id: _serialize_citation(c) for c in citations}
+        yield frame("citations", {"citations": list(cite_map.values()) if req.with_sources else []})
+        if not citations:
+            yield frame("done", {"answer": "", "citations": [], "inline_refs": {}, "citations_used": []})
+            return
+        decoder, markers, raw = AnswerFieldDecoder(), MarkerTracker(), []
+        try:
+            async for delta in stream_answer_with_openai(q, citations):
+                raw.append(delta)
+                text = decoder.feed(delta)
+                if not text:
+                    continue
+                yield frame("token", {"text": text})
+                if not req.with_sources:
+                    continue
+                for cid in markers.feed(text):
+                    if cid in cite_map:
+                        yield frame("citation", {"id": cid, "citation": cite_map[cid]})
+        except Exception as e:
+            logger.exception("ask.stream openai_failed error=%s", e)
+            yield frame("error", {"error": "openai_failed", "detail": str(e)})
+            return
+        out = _assemble_answer(req, _parse_answer("".join(raw)), citations)
+        _remember_answer(scope, q, q_emb, out, citations, epoch)
+        yield frame("done", out)
+
+    media_type = "application/x-ndjson" if ndjson else "text/event-stream"
+    # Ask reverse proxies (nginx) not to buffer the stream
+    return StreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/health")
 def health():
-    return {"ok": True}
+    return {"ok": True, "upstream_in_flight": dict(upstream.in_flight)}
+
+
+@app.get("/cache_stats")
+def cache_stats():
+    return {
+        "query_embeddings": query_embed_cache.stats() if query_embed_cache is not None else None,
+        "embeddings": embed_cache.stats() if embed_cache is not None else None,
+        "answers": answer_cache.stats() if answer_cache is not None else None,
+    }
 
 
 class EmbedRequest(BaseModel):
@@ -617,27 +1389,37 @@ class EmbedRequest(BaseModel):
     model: str | None = None
 
 @app.post("/embed")
-def embed(req: EmbedRequest):
+async def embed(req: EmbedRequest):
     model = req.model or os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
     if not req.texts:
         return {"vectors": []}
-    # Use our helper; override model via env for now
-    if not OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY not set")
     logger.info("embed count=%s model=%s", len(req.texts), model)
-    resp = client.embeddings.create(model=model, input=req.texts)
-    return {"vectors": [d.embedding for d in resp.data], "model": model}
+    res = await embed_queries(req.texts, model=model, persistent=True)
+    if res.failed == len(req.texts):
+        return JSONResponse({"ok": False, "error": "embed_failed", "detail": res.errors[0] if res.errors else ""}, status_code=502)
+    out = {"vectors": res.vectors, "model": model}
+    if res.failed:
+        # Vectors of failed batches are null
+        out["failed"] = res.failed
+        out["errors"] = res.errors
+    return out
 
 
 class RerankRequest(BaseModel):
     query: str
     passages: List[str]
+    scores: Optional[List[float]] = Field(None, description="Retrieval scores aligned with passages; fused with the lexical features")
+    top_k: Optional[int] = Field(None, ge=1, description="Return only the best top_k passages")
 
 @app.post("/rerank")
-def rerank(req: RerankRequest):
-    # Minimal stub: preserve order with trivial scores
+async def rerank(req: RerankRequest):
     try:
         logger.info("rerank passages=%s", len(req.passages or []))
     except Exception:
         pass
-    return {"results": [{"text": p, "score": 1.0 - (i * 0.01)} for i, p in enumerate(req.passages)]}
+    scores = req.scores if req.scores is not None and len(req.scores) == len(req.passages) else None
+    loop = asyncio.get_running_loop()
+    ranked = await loop.run_in_executor(query_executor, lambda: reranker.rerank(req.query, req.passages, scores))
+    if req.top_k:
+        ranked = ranked[: req.top_k]
+    return {"results": [{"index": i, "text": req.passages[i], "score": score} for i, score in ranked]}
@@ -0,0 +1,119 @@
+"""CPU reranking of retrieved passages.
+
+Candidates are rescored by fusing features in [0, 1]:
+  vector    the retrieval (cosine) score, when known, clipped to [0, 1]
+  bm25      Okapi BM25 of the query against the candidate set, min-max scaled
+  coverage  share of distinct query terms found in the passage
+and optionally the relevance logit of a small cross-encoder
+(sentence-transformers), loaded on first use when a model name is configured.
+"""
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("ai_engine")
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the this to was were what when where which who why will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall((text or "").lower()) if t not in _STOPWORDS]
+
+
+def bm25_scores(query: Sequence[str], docs: Sequence[Sequence[str]], k1: float = 1.2, b: float = 0.75) -> np.ndarray:
+    """BM25 with document frequencies taken from `docs` themselves."""
+    n = len(docs)
+    out = np.zeros(n, dtype=np.float64)
+    if not n or not query:
+        return out
+    lengths = np.asarray([len(d) for d in docs], dtype=np.float64)
+    avg = float(lengths.mean()) or 1.0
+    counts = [Counter(d) for d in docs]
+    for term in set(query):
+        tf = np.asarray([c.get(term, 0) for c in counts], dtype=np.float64)
+        df = int((tf > 0).sum())
+        if not df:
+            continue
+        idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+        out += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths / avg))
+    return out
+
+
+def _minmax(x: np.ndarray) -> np.ndarray:
+    if not len(x):
+        return x
+    lo, hi = float(x.min()), float(x.max())
+    if hi - lo < 1e-12:
+        return np.ones_like(x) if hi > 0 else np.zeros_like(x)
+    return (x - lo) / (hi - lo)
+
+
+class Reranker:
+    def __init__(
+        self,
+        vector_weight: float = 0.5,
+        bm25_weight: float = 0.3,
+        coverage_weight: float = 0.2,
+        cross_encoder: Optional[str] = None,
+        cross_encoder_weight: float = 0.6,
+    ):
+        self.weights = {"vector": vector_weight, "bm25": bm25_weight, "coverage": coverage_weight}
+        self.cross_encoder_name = cross_encoder or None
+        self.cross_encoder_weight = cross_encoder_weight
+        self._model = None
+        self._model_failed = False
+        self._model_lock = threading.Lock()
+
+    def _cross_encoder(self):
+        if not self.cross_encoder_name or self._model_failed:
+            return None
+        with self._model_lock:
+            if self._model is None and not self._model_failed:
+                try:
+                    from sentence_transformers import CrossEncoder  # optional dependency
+
+                    self._model = CrossEncoder(self.cross_encoder_name, device="cpu")
+                except Exception as e:
+                    logger.warning("rerank cross_encoder_unavailable model=%s error=%s", self.cross_encoder_name, e)
+                    self._model_failed = True
+        return self._model
+
+    def features(self, query: str, passages: Sequence[str], vector_scores: Optional[Sequence[float]] = None) -> Dict[str, np.ndarray]:
+        q = tokenize(query)
+        docs = [tokenize(p) for p in passages]
+        terms = set(q)
+        feats = {
+            "bm25": _minmax(bm25_scores(q, docs)),
+            "coverage": np.asarray([len(terms & set(d)) / len(terms) if terms else 0.0 for d in docs], dtype=np.float64),
+        }
+        if vector_scores is not None:
+            # Kept absolute: min-max would turn a 0.01 cosine gap into the full weight
+            feats["vector"] = np.clip(np.asarray(vector_scores, dtype=np.float64), 0.0, 1.0)
+        return feats
+
+    def rerank(self, query: str, passages: Sequence[str], vector_scores: Optional[Sequence[float]] = None) -> List[Tuple[int, float]]:
+        """(index into passages, fused score), best first. CPU-bound; call off the event loop."""
+        if not passages:
+            return []
+        feats = self.features(query, passages, vector_scores)
+        total = sum(self.weights[k] for k in feats)
+        fused = sum(self.weights[k] * v for k, v in feats.items()) / (total or 1.0)
+        model = self._cross_encoder()
+        if model is not None:
+            try:
+                logits = np.asarray(model.predict([(query, p) for p in passages]), dtype=np.float64).reshape(-1)
+                w = self.cross_encoder_weight
+                fused = (1 - w) * fused + w / (1.0 + np.exp(-logits))
+            except Exception as e:
+                logger.warning("rerank cross_encoder_failed error=%s", e)
+        # Stable: ties keep retrieval order
+        order = np.argsort(-fused, kind="stable")
+        return [(int(i), float(fused[i])) for i in order]
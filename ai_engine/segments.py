@@ -0,0 +1,416 @@
+"""Append-only, memory-mapped vector segment files.
+
+Layout of seg-<seq>.vec (little-endian):
+    header   64 bytes   magic, dim (u32), count (u32), ids offset (u64)
+    vectors  count x dim float32, rows normalized to unit length
+    offsets  count + 1 u64 byte offsets into the id blob
+    ids      utf-8 item ids, concatenated
+
+A .vec file is never rewritten. Deleted rows are recorded in a seg-<seq>.del
+sidecar (packed bits), and compaction merges segments into a new one. Every
+process maps the same files, so uvicorn workers share one page-cached copy of
+the vectors. Global slot numbers run over the segments in seq order.
+
+Writers hold the directory's .write.lock (see SegmentMatrix.write_lock) while
+they tombstone rows or swap segments, so a sidecar is never written for a
+segment another process is removing.
+"""
+import copy, os, glob, re, struct, tempfile
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX
+    fcntl = None
+
+MAGIC = b"DQVSEG01"
+HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+_NAME = re.compile(r"seg-(\d+)\.vec$")
+
+
+def normalize_rows(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (m / norms).astype(np.float32, copy=False)
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True) -> Iterator[bool]:
+    """Exclusive fcntl lock on `path`, shared by every process using the file.
+    Yields False without waiting when `blocking` is off and the lock is taken.
+    Not reentrant: a second acquire in the same process waits for the first.
+    """
+    with open(path, "a+") as f:
+        acquired = True
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                acquired = False
+        yield acquired
+
+
+def segment_path(directory: str, seq: int) -> str:
+    return os.path.join(directory, f"seg-{seq:08d}.vec")
+
+
+def claim_seq(directory: str, start: int) -> int:
+    """Reserve the next free segment number by creating an empty placeholder file.
+    Empty files are skipped by loaders until the finished segment replaces them.
+    """
+    seq = max(1, start)
+    while True:
+        try:
+            fd = os.open(segment_path(directory, seq), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            return seq
+        except FileExistsError:
+            seq += 1
+
+
+def write_segment(directory: str, seq: int, ids: Sequence[str], vectors: np.ndarray, publish: bool = True) -> str:
+    """Write a claimed segment to a temp file; with publish, move it into place."""
+    encoded = [i.encode("utf-8") for i in ids]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    vectors = np.ascontiguousarray(vectors, dtype="<f4")
+    count, dim = vectors.shape
+    ids_offset = HEADER_SIZE + vectors.nbytes
+    tmp = segment_path(directory, seq) + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, dim, count, ids_offset).ljust(HEADER_SIZE, b"\0"))
+        f.write(vectors.tobytes())
+        f.write(offsets.tobytes())
+        f.write(b"".join(encoded))
+        f.flush()
+        os.fsync(f.fileno())
+    if publish:
+        publish_segment(directory, seq)
+    return tmp
+
+
+def publish_segment(directory: str, seq: int):
+    os.replace(segment_path(directory, seq) + ".tmp", segment_path(directory, seq))
+
+
+class Segment:
+    def __init__(self, path: str, seq: int):
+        self.path = path
+        self.seq = seq
+        self._mm = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, dim, count, ids_offset = HEADER.unpack(bytes(self._mm[: HEADER.size]))
+        if magic != MAGIC:
+            raise ValueError(f"not a vector segment: {path}")
+        self.dim = dim
+        self.count = count
+        self.vecs = np.ndarray((count, dim), dtype="<f4", buffer=self._mm, offset=HEADER_SIZE)
+        self._offsets = np.ndarray((count + 1,), dtype="<u8", buffer=self._mm, offset=ids_offset)
+        self._ids_base = ids_offset + 8 * (count + 1)
+        self.alive = np.ones(count, dtype=bool)
+        self.live = count
+        self._del_mtime = None
+        self.load_tombstones()
+
+    @property
+    def del_path(self) -> str:
+        return self.path[: -len(".vec")] + ".del"
+
+    def id_at(self, row: int) -> str:
+        a, b = int(self._offsets[row]), int(self._offsets[row + 1])
+        return bytes(self._mm[self._ids_base + a : self._ids_base + b]).decode("utf-8")
+
+    def load_tombstones(self) -> bool:
+        """Re-read the .del sidecar if it changed on disk (e.g. written by another worker)."""
+        try:
+            mtime = os.stat(self.del_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._del_mtime:
+            return False
+        try:
+            with open(self.del_path, "rb") as f:
+                bits = np.frombuffer(f.read(), dtype=np.uint8)
+        except FileNotFoundError:
+            return False
+        dead = np.unpackbits(bits, count=self.count).astype(bool) if len(bits) else np.zeros(self.count, dtype=bool)
+        self.alive = ~dead
+        self.live = int(self.alive.sum())
+        self._del_mtime = mtime
+        return True
+
+    def save_tombstones(self):
+        """Write the .del sidecar; skipped once the segment file itself is gone (compacted away)."""
+        self.live = int(self.alive.sum())
+        if not os.path.exists(self.path):
+            return
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.del_path) + ".", suffix=".tmp", dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(np.packbits(~self.alive).tobytes())
+                f.flush()
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+            os.replace(tmp, self.del_path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self._del_mtime = mtime
+
+    def remove_files(self):
+        for p in (self.path, self.del_path):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+
+def _load_dir(directory: str) -> Dict[int, str]:
+    found = {}
+    for path in glob.glob(os.path.join(directory, "seg-*.vec")):
+        m = _NAME.search(path)
+        try:
+            if not m or os.path.getsize(path) < HEADER_SIZE:
+                continue
+        except FileNotFoundError:  # removed by a concurrent compaction
+            continue
+        found[int(m.group(1))] = path
+    return found
+
+
+def _open_segments(found: Dict[int, str]) -> List[Segment]:
+    """Map the listed segment files, skipping any removed since they were listed."""
+    out = []
+    for seq, path in sorted(found.items()):
+        try:
+            out.append(Segment(path, seq))
+        except FileNotFoundError:
+            continue
+    return out
+
+
+class SegmentMatrix:
+    """All segments of a store, addressed by global slot (segment base + row)."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.generation = 0  # bumped whenever existing slots are renumbered
+        self._set_segments(_open_segments(_load_dir(directory)))
+
+    def _set_segments(self, segments: List[Segment]):
+        segments = sorted(segments, key=lambda s: s.seq)
+        bases = np.zeros(len(segments) + 1, dtype=np.int64)
+        bases[1:] = np.cumsum([s.count for s in segments])
+        seqs = np.asarray([s.seq for s in segments], dtype=np.int64)
+        # Replaced as one tuple so readers outside the store lock see a consistent view
+        self._layout = (tuple(segments), bases, seqs)
+        dims = [s.dim for s in segments if s.count]
+        self.dim = max(set(dims), key=dims.count) if dims else 0
+
+    def snapshot(self) -> "SegmentMatrix":
+        """A view pinned to the current slot numbering, for scoring slots picked under the
+        store lock after releasing it. Later appends, compactions and refreshes replace the
+        layout of this matrix only; mappings stay valid after their files are removed.
+        """
+        return copy.copy(self)
+
+    def write_lock(self):
+        """Cross-process lock held around tombstone writes and segment swaps."""
+        return file_lock(os.path.join(self.directory, ".write.lock"))
+
+    @property
+    def segments(self) -> Tuple[Segment, ...]:
+        return self._layout[0]
+
+    @property
+    def size(self) -> int:
+        return int(self._layout[1][-1])
+
+    def __len__(self) -> int:
+        return sum(s.live for s in self.segments)
+
+    def layout(self) -> np.ndarray:
+        """(seq, count) per segment; identifies the slot numbering."""
+        return np.asarray([(s.seq, s.count) for s in self.segments], dtype=np.int64).reshape(-1, 2)
+
+    def alive_mask(self) -> np.ndarray:
+        segs = self.segments
+        return np.concatenate([s.alive for s in segs]) if segs else np.zeros(0, dtype=bool)
+
+    def slots_of(self, seqs: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Global slots for (segment seq, row) pairs; pairs in unknown segments are dropped."""
+        _, bases, known = self._layout
+        seqs = np.asarray(seqs, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(known) or not len(seqs):
+            return np.zeros(0, dtype=np.int64)
+        idx = np.clip(np.searchsorted(known, seqs), 0, len(known) - 1)
+        ok = known[idx] == seqs
+        return bases[idx[ok]] + rows[ok]
+
+    def locate(self, slots: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Segment index and row for global slots."""
+        _, bases, _ = self._layout
+        slots = np.asarray(slots, dtype=np.int64)
+        idx = np.searchsorted(bases, slots, side="right") - 1
+        return idx, slots - bases[idx]
+
+    def __getitem__(self, slots) -> np.ndarray:
+        """Gather rows by global slot (only the requested rows are read from the mapping)."""
+        segs, bases, _ = self._layout
+        slots = np.asarray(slots, dtype=np.int64)
+        out = np.zeros((len(slots), self.dim), dtype=np.float32)
+        idx = np.searchsorted(bases, slots, side="right") - 1
+        for i in np.unique(idx):
+            pick = idx == i
+            if segs[i].dim == out.shape[1]:
+                out[pick] = segs[i].vecs[slots[pick] - bases[i]]
+        return out
+
+    def append(self, ids: List[str], vectors: np.ndarray) -> Tuple[int, np.ndarray]:
+        """Persist rows as a new segment; returns (seq, global slots)."""
+        known = self._layout[2]
+        seq = claim_seq(self.directory, int(known[-1]) + 1 if len(known) else 1)
+        write_segment(self.directory, seq, ids, normalize_rows(vectors))
+        seg = Segment(segment_path(self.directory, seq), seq)
+        # seq is above every known segment, so existing slots keep their numbers
+        self._set_segments(list(self.segments) + [seg])
+        return seq, self.slots_of(np.full(seg.count, seq), np.arange(seg.count))
+
+    def tombstone(self, seqs: Sequence[int], rows: Sequence[int]) -> np.ndarray:
+        """Mark (seq, row) pairs dead and persist the sidecars; returns the slots freed."""
+        segs, bases, known = self._layout
+        seqs = np.asarray(seqs, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        freed = []
+        for seq in np.unique(seqs):
+            i = int(np.searchsorted(known, seq))
+            if i >= len(known) or known[i] != seq:
+                continue
+            r = rows[seqs == seq]
+            r = r[segs[i].alive[r]]
+            if len(r):
+                segs[i].alive[r] = False
+                segs[i].save_tombstones()
+                freed.append(bases[i] + r)
+        return np.concatenate(freed) if freed else np.zeros(0, dtype=np.int64)
+
+    def search(
+        self,
+        q: np.ndarray,
+        top_k: int,
+        candidates: Optional[np.ndarray] = None,
+        batch: Optional[int] = None,
+    ) -> List[Tuple[str, float, int, int]]:
+        """Top-k live rows for a normalized query as (id, score, seq, row).
+        `candidates` restricts scoring to those global slots; `batch` bounds the rows
+        scored at once (the mapping is only paged in, never copied wholesale).
+        """
+        segs, bases, _ = self._layout
+        found: List[Tuple[float, int, int]] = []
+        if candidates is not None:
+            candidates = np.sort(np.asarray(candidates, dtype=np.int64))
+            idx = np.searchsorted(bases, candidates, side="right") - 1
+        for i, seg in enumerate(segs):
+            if seg.dim != q.shape[0] or not seg.live:
+                continue
+            if candidates is None:
+                rows = None
+                n = seg.count
+            else:
+                lo, hi = np.searchsorted(idx, [i, i + 1])
+                rows = candidates[lo:hi] - bases[i]
+                rows = rows[seg.alive[rows]]
+                n = len(rows)
+            step = batch or max(n, 1)
+            for a in range(0, n, step):
+                if rows is None:
+                    r = np.arange(a, min(n, a + step))
+                    scores = seg.vecs[a : a + step] @ q
+                    scores[~seg.alive[a : a + step]] = -np.inf
+                else:
+                    r = rows[a : a + step]
+                    scores = seg.vecs[r] @ q
+                k = min(top_k, len(scores))
+                top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+                found.extend((float(scores[j]), i, int(r[j])) for j in top if scores[j] != -np.inf)
+        found.sort(key=lambda t: -t[0])
+        return [(segs[i].id_at(row), score, segs[i].seq, row) for score, i, row in found[:top_k]]
+
+    def refresh(self) -> Optional[np.ndarray]:
+        """Pick up segments and tombstones written by other processes.
+        Returns the slots of newly appended segments, or None when existing slots
+        were renumbered (segments removed or inserted in the middle).
+        """
+        on_disk = _load_dir(self.directory)
+        segs = [s for s in self.segments if s.seq in on_disk]
+        for s in segs:
+            s.load_tombstones()
+        have = {s.seq for s in segs}
+        new = _open_segments({seq: p for seq, p in on_disk.items() if seq not in have})
+        renumbered = len(segs) != len(self.segments) or bool(new and segs and new[0].seq < segs[-1].seq)
+        base = sum(s.count for s in segs)
+        self._set_segments(segs + new)
+        if renumbered:
+            self.generation += 1
+            return None
+        return np.arange(base, self.size, dtype=np.int64)
+
+    def compaction_candidates(self, small_rows: int = 4096, min_small: int = 8) -> List[int]:
+        """Segments worth merging: a quarter or more dead, or a pile of small ones."""
+        segs = self.segments
+        dead_heavy = [s.seq for s in segs if s.count and (s.count - s.live) * 4 >= s.count]
+        small = [s.seq for s in segs if s.count < small_rows]
+        picked = set(dead_heavy)
+        if len(small) >= min_small:
+            picked.update(small)
+        return sorted(picked)
+
+    def replace(self, old_seqs: Sequence[int], new_seg: Optional[Segment], moved_from: np.ndarray) -> np.ndarray:
+        """Swap merged segments for their replacement.
+        moved_from[j] is the old global slot of row j of new_seg. Returns the old -> new slot map.
+        """
+        old_segs, old_bases, _ = self._layout
+        drop = set(int(s) for s in old_seqs)
+        self._set_segments([s for s in old_segs if s.seq not in drop] + ([new_seg] if new_seg is not None else []))
+        remap = np.full(int(old_bases[-1]), -1, dtype=np.int64)
+        for i, s in enumerate(old_segs):
+            if s.seq not in drop and s.count:
+                new_base = int(self.slots_of([s.seq], [0])[0])
+                remap[old_bases[i] : old_bases[i] + s.count] = np.arange(new_base, new_base + s.count)
+        if new_seg is not None and len(moved_from):
+            new_base = int(self.slots_of([new_seg.seq], [0])[0])
+            remap[moved_from] = np.arange(new_base, new_base + len(moved_from))
+        for s in old_segs:
+            if s.seq in drop:
+                s.remove_files()
+        self.generation += 1
+        return remap
+
+    def remove_orphans(self):
+        """Delete .del sidecars whose segment is gone and temp sidecars left by crashed writers.
+        Call with write_lock held, so no sidecar write is in progress.
+        """
+        for p in glob.glob(os.path.join(self.directory, "seg-*.del*")):
+            if p.endswith(".tmp") or not os.path.exists(p[: -len(".del")] + ".vec"):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        for s in self.segments:
+            s.remove_files()
+        for p in glob.glob(os.path.join(self.directory, "seg-*")):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        self._set_segments([])
+        self.generation += 1
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
+from ai_engine import main
+from ai_engine.answer_cache import AnswerCache
+
+
+class AnswerCacheTest(unittest.TestCase):
+  def test_exact_and_semantic_tiers_are_scoped(self):
+    cache = AnswerCache(similarity=0.95)
+    cache.put("org1", "What is the revenue?", [1.0, 0.0], {"answer": "42"}, ["d1"], epoch=cache.epoch())
+    self.assertEqual(cache.get("org1", "  what is the REVENUE? ")["answer"], "42")
+    self.assertIsNone(cache.get("org2", "What is the revenue?"))
+    self.assertEqual(cache.get_similar("org1", [0.99, 0.05])["answer"], "42")
+    self.assertIsNone(cache.get_similar("org1", [0.5, 0.5]))
+    self.assertIsNone(cache.get_similar("org2", [1.0, 0.0]))
+
+  def test_invalidation_ttl_and_size_bound(self):
+    cache = AnswerCache(max_entries=2, ttl=60)
+    started = cache.epoch()
+    cache.put("s", "a", None, {"answer": "A"}, ["d1"], epoch=started)
+    cache.put("s", "b", None, {"answer": "B"}, ["d2"], epoch=started)
+    self.assertEqual(cache.invalidate_documents(["d1"]), 1)
+    self.assertIsNone(cache.get("s", "a"))
+    # An answer computed before d1 changed is not stored
+    cache.put("s", "c", None, {"answer": "C"}, ["d1"], epoch=started)
+    self.assertIsNone(cache.get("s", "c"))
+    cache.put("s", "c", None, {"answer": "C"}, ["d1"], epoch=cache.epoch())
+    cache.put("s", "d", None, {"answer": "D"}, ["d3"], epoch=cache.epoch())
+    self.assertIsNone(cache.get("s", "b"))
+    self.assertEqual(cache.stats()["entries"], 2)
+    with mock.patch("ai_engine.answer_cache.time.monotonic", return_value=time.monotonic() + 61):
+      self.assertIsNone(cache.get("s", "c"))
+
+  def test_document_epochs_stay_bounded(self):
+    cache = AnswerCache(max_entries=2)
+    started = cache.epoch()
+    for i in range(100):
+      cache.invalidate_documents([f"d{i}"])
+    self.assertLessEqual(len(cache._doc_epoch), cache.max_doc_epochs)
+    # d0's epoch was forgotten, but an answer computed before it changed is still refused
+    cache.put("s", "q", None, {"answer": "stale"}, ["d0"], epoch=started)
+    self.assertIsNone(cache.get("s", "q"))
+    cache.put("s", "q", None, {"answer": "fresh"}, ["d0"], epoch=cache.epoch())
+    self.assertEqual(cache.get("s", "q")["answer"], "fresh")
+
+
+class AskCacheTest(unittest.TestCase):
+  def test_repeated_question_skips_retrieval_and_llm_until_reindex(self):
+    calls = {"embed": 0, "llm": 0}
+    citations = main._build_citations([{"metadata": {"document_id": "d1", "title": "T"}, "content": "Revenue rose.", "score": 0.9}], limit=3)
+
+    async def embed(texts):
+      calls["embed"] += 1
+      return [[1.0, 0.0]]
+
+    async def retrieve(req, q_emb):
+      return citations
+
+    async def answer(q, cites):
+      calls["llm"] += 1
+      return {"answer": "Revenue rose [S1].", "citations_used": ["S1"]}
+
+    cache = AnswerCache()
+    req = main.AskRequest(question="How did revenue change?", filters={"organization": "3"})
+    with mock.patch.multiple(main, embed_texts=embed, _retrieve_citations=retrieve, answer_with_openai=answer, answer_cache=cache):
+      first = asyncio.run(main.ask(req))
+      second = asyncio.run(main.ask(main.AskRequest(question="how did revenue  change?", filters={"organization": "3"})))
+      self.assertEqual(first, second)
+      self.assertEqual(calls, {"embed": 1, "llm": 1})
+      asyncio.run(main.ask(main.AskRequest(question="How did revenue change?", filters={"organization": "4"})))
+      self.assertEqual(calls["llm"], 2)
+      cache.invalidate_documents(["d1"])
+      asyncio.run(main.ask(req))
+      self.assertEqual(calls["llm"], 3)
+
+
+if __name__ == "__main__":
+  unittest.main()
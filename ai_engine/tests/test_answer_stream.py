@@ -0,0 +1,86 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
+from ai_engine import main
+from ai_engine.answer_stream import AnswerFieldDecoder, MarkerTracker
+
+
+def _feed_all(decoder, chunks):
+  return "".join(decoder.feed(c) for c in chunks)
+
+
+class AnswerFieldDecoderTest(unittest.TestCase):
+  def test_decodes_answer_value_split_across_chunks(self):
+    raw = json.dumps({"answer": 'Growth was "strong" [S1]\nline two é \U0001F600', "bullets": ["x"]})
+    for size in (1, 3, 7):
+      chunks = [raw[i : i + size] for i in range(0, len(raw), size)]
+      decoder = AnswerFieldDecoder()
+      self.assertEqual(_feed_all(decoder, chunks), 'Growth was "strong" [S1]\nline two é \U0001F600')
+      self.assertEqual(decoder.phase, "done")
+
+  def test_fenced_json_and_plain_text(self):
+    self.assertEqual(_feed_all(AnswerFieldDecoder(), ["```json\n{\"ans", "wer\": \"hi\"}\n```"]), "hi")
+    self.assertEqual(_feed_all(AnswerFieldDecoder(), ["  Plain ", "answer [S2]"]), "  Plain answer [S2]")
+
+  def test_marker_tracker_reports_each_marker_once_even_when_split(self):
+    tracker = MarkerTracker()
+    self.assertEqual(tracker.feed("Revenue [S"), [])
+    self.assertEqual(tracker.feed("1] and costs [S2][S1"), ["S1", "S2"])
+    self.assertEqual(tracker.feed("] end [S12]"), ["S12"])
+
+
+class AskStreamTest(unittest.TestCase):
+  def _frames(self, req):
+    citations = main._build_citations(
+      [{"metadata": {"document_id": "d1", "title": "Report", "page": 2}, "content": "Revenue rose 18%.", "score": 0.9}],
+      limit=3,
+    )
+    raw = json.dumps({"answer": "Revenue rose 18% [S1].", "bullets": ["18% growth"], "citations_used": ["S1"]})
+
+    async def retrieve(req, q_emb):
+      return citations
+
+    async def embed(texts):
+      return [[1.0, 0.0] for _ in texts]
+
+    async def fake_stream(question, cites):
+      for i in range(0, len(raw), 5):
+        yield raw[i : i + 5]
+
+    async def collect():
+      resp = await main.ask_stream(req, fmt="ndjson")
+      return [json.loads(line) async for line in resp.body_iterator]
+
+    with mock.patch.multiple(main, _retrieve_citations=retrieve, stream_answer_with_openai=fake_stream, embed_texts=embed, answer_cache=None):
+      return asyncio.run(collect())
+
+  def test_streams_citations_then_tokens_then_final_frame(self):
+    frames = self._frames(main.AskRequest(question="How did revenue change?"))
+    types = [f["type"] for f in frames]
+    self.assertEqual(types[0], "citations")
+    self.assertEqual(types[-1], "done")
+    self.assertEqual(frames[0]["citations"][0]["doc_id"], "d1")
+    self.assertEqual("".join(f["text"] for f in frames if f["type"] == "token"), "Revenue rose 18% [S1].")
+    cite_frames = [f for f in frames if f["type"] == "citation"]
+    self.assertEqual([f["id"] for f in cite_frames], ["S1"])
+    self.assertLess(types.index("citation"), types.index("done"))
+    done = frames[-1]
+    self.assertEqual(done["citations_used"], ["S1"])
+    self.assertEqual(done["blocks"], [{"type": "bullets", "items": ["18% growth"]}])
+    self.assertEqual(len(done["all_citations"]), 1)
+
+  def test_without_sources_sends_no_citation_frames(self):
+    frames = self._frames(main.AskRequest(question="How did revenue change?", with_sources=False))
+    self.assertEqual(frames[0], {"type": "citations", "citations": []})
+    self.assertNotIn("citation", [f["type"] for f in frames])
+    self.assertEqual("".join(f["text"] for f in frames if f["type"] == "token"), "Revenue rose 18% [S1].")
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,100 @@
+import io
+import unittest
+from unittest import mock
+
+from ai_engine import tokens
+from ai_engine.chunking import chunk_document, iter_blocks, iter_lines
+from ai_engine.tokens import count_tokens, split_tokens
+
+
+DOC = """# Master Services Agreement
+
+## 1. Payment
+
+Invoices are payable within 30 days. Late payments accrue interest.
+
+## 2. Term
+
+2.1 Renewal
+The agreement renews every year unless cancelled.
+
+| Plan | Price |
+|------|-------|
+| Basic | 10 |
+"""
+
+
+class ChunkingTest(unittest.TestCase):
+  def test_blocks_follow_document_structure(self):
+    kinds = [(b.kind, b.level) for b in iter_blocks(iter_lines(DOC))]
+    self.assertEqual(kinds, [("heading", 1), ("heading", 2), ("paragraph", 0), ("heading", 2), ("heading", 7), ("paragraph", 0), ("table", 0)])
+    setext = list(iter_blocks(iter_lines("Overview\n========\nBody text.")))
+    self.assertEqual([(b.kind, b.text) for b in setext], [("heading", "Overview"), ("paragraph", "Body text.")])
+
+  def test_sections_become_chunks_with_heading_paths(self):
+    chunks = list(chunk_document(DOC, target_tokens=40, min_tokens=5))
+    self.assertEqual(len(chunks), 2)
+    self.assertEqual(chunks[0].heading_path, ["Master Services Agreement", "1. Payment"])
+    self.assertTrue(chunks[0].text.startswith("Master Services Agreement\n\n1. Payment"))
+    self.assertIn("Late payments accrue interest.", chunks[0].text)
+    self.assertEqual(chunks[1].heading_path, ["Master Services Agreement", "2. Term", "2.1 Renewal"])
+    self.assertIn("| Basic | 10 |", chunks[1].text)
+
+  def test_long_paragraphs_split_at_sentences_within_budget(self):
+    text = " ".join(f"Sentence number {i} explains one more detail of the policy." for i in range(80))
+    chunks = list(chunk_document(text, target_tokens=100, overlap_tokens=20))
+    self.assertGreater(len(chunks), 3)
+    for c in chunks:
+      self.assertLessEqual(c.tokens, 130)
+      self.assertTrue(c.text.endswith("policy."))
+      self.assertTrue(c.text.startswith("Sentence number"))
+    # Consecutive chunks share the last sentence
+    self.assertTrue(chunks[1].text.startswith(chunks[0].text.rsplit("policy. ", 1)[-1][:30]))
+
+  def test_split_tables_repeat_their_header_and_files_stream(self):
+    rows = "\n".join(f"| item {i} | {i * 3} |" for i in range(200))
+    text = "| Item | Qty |\n" + rows
+    chunks = list(chunk_document(io.StringIO(text), target_tokens=120))
+    self.assertGreater(len(chunks), 2)
+    for c in chunks:
+      self.assertTrue(c.text.startswith("| Item | Qty |"))
+    self.assertEqual(sum(c.text.count("| item ") for c in chunks), 200)
+    self.assertEqual(list(chunk_document("")), [])
+    self.assertLessEqual(max(count_tokens(c.text) for c in chunks), 160)
+
+  def test_heading_stack_carries_across_pages(self):
+    headings = []
+    list(chunk_document("# Report\n\n## Findings\n\nFirst page text.", headings=headings))
+    page2 = list(chunk_document("More findings on the next page.", headings=headings))
+    self.assertEqual(page2[0].heading_path, ["Report", "Findings"])
+
+
+class _ByteEncoder:
+  """Stand-in tokenizer: one token per 3 UTF-8 bytes, so tokens can end inside a character."""
+
+  def encode(self, text, disallowed_special=()):
+    data = text.encode("utf-8")
+    return [data[i : i + 3] for i in range(0, len(data), 3)]
+
+  def decode_single_token_bytes(self, token):
+    return token
+
+
+class SplitTokensTest(unittest.TestCase):
+  def test_unbroken_text_is_cut_at_token_offsets(self):
+    text = "x" * 5000 + " ünïcödé 日本語テキスト" * 50
+    with mock.patch.object(tokens, "_get_encoder", return_value=_ByteEncoder()):
+      parts = list(split_tokens(text, 10))
+    self.assertEqual("".join(parts).replace(" ", ""), text.replace(" ", ""))
+    self.assertTrue(all(len(p.encode("utf-8")) <= 32 for p in parts))
+    self.assertEqual(list(split_tokens("", 10)), [])
+
+  def test_estimated_split_stays_within_budget(self):
+    with mock.patch.object(tokens, "_get_encoder", return_value=None):
+      parts = list(split_tokens("a" * 10000, 100))
+    self.assertEqual(len(parts), 25)
+    self.assertTrue(all(count_tokens(p) <= 100 for p in parts))
+
+
+if __name__ == "__main__":
+  unittest.main()
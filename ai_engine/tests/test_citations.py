@@ -1,5 +1,10 @@
+import os
+import tempfile
 import unittest
 
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
 from ai_engine.main import _build_citations, _clean_snippet, _extract_markers
 
 
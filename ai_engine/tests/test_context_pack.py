@@ -0,0 +1,84 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
+from ai_engine import main
+from ai_engine.context_pack import count_tokens, join_overlapping, pack_context
+
+
+def _match(id_, content, score, page=1, chunk=None, doc="d1"):
+  meta = {"document_id": doc, "page": page}
+  if chunk is not None:
+    meta["chunk"] = chunk
+  return {"id": id_, "content": content, "score": score, "metadata": meta}
+
+
+def _windows(text, size, overlap):
+  """Fixed-size character windows sharing `overlap` characters with the previous one."""
+  return [text[i : i + size] for i in range(0, len(text), size - overlap)]
+
+
+def _position(match):
+  meta = match["metadata"]
+  return ((meta["document_id"], meta["page"]), meta["chunk"]) if "chunk" in meta else None
+
+
+class PackContextTest(unittest.TestCase):
+  def test_drops_near_duplicates_and_merges_page_neighbours(self):
+    page = " ".join(f"Sentence {i} describes clause {i} of the supply agreement." for i in range(60))
+    windows = _windows(page, 400, 80)
+    matches = [
+      _match("w1", windows[1], 0.9, chunk=1),
+      _match("dup", windows[1].upper(), 0.85, doc="d2"),
+      _match("other", "Payment is due within thirty days of the invoice date.", 0.8, page=2, chunk=0),
+      _match("w2", windows[2], 0.7, chunk=2),
+    ]
+    packed, stats = pack_context(matches, budget=2000, position=_position)
+    self.assertEqual(stats.duplicates, 1)
+    self.assertEqual([m["id"] for m in packed], ["w1", "other"])
+    self.assertEqual(packed[0]["merged_ids"], ["w1", "w2"])
+    self.assertEqual(packed[0]["content"], join_overlapping(windows[1], windows[2]))
+    self.assertEqual(stats.merged, 1)
+    # The window overlap is sent once
+    self.assertLess(count_tokens(packed[0]["content"]), count_tokens(windows[1]) + count_tokens(windows[2]))
+
+  def test_fills_budget_by_score_and_truncates_the_last_source(self):
+    long = "First point is key. " * 200
+    matches = [
+      _match("a", "Alpha " * 50, 0.9),
+      _match("b", long, 0.8, page=2),
+      _match("c", "Gamma " * 50, 0.7, page=3),
+    ]
+    packed, stats = pack_context(matches, budget=400, position=_position, per_source_tokens=10)
+    self.assertEqual([m["id"] for m in packed], ["a", "b"])
+    self.assertEqual(stats.truncated, 1)
+    self.assertTrue(packed[1]["content"].endswith("key."))
+    self.assertLessEqual(stats.tokens, 400)
+    packed, _ = pack_context(matches, budget=0, position=_position)
+    self.assertEqual(packed, [])
+
+
+class AskContextTest(unittest.TestCase):
+  def test_prompt_renders_packed_text_within_budget(self):
+    matches = [_match(f"m{i}", f"Fact number {i}. " + "filler words here " * 60, 1.0 - i / 100, page=i) for i in range(20)]
+
+    async def query_store(emb, **kwargs):
+      return matches
+
+    req = main.AskRequest(question="fact", top_k=5)
+    with mock.patch.multiple(main, query_store=query_store, RERANK_ENABLED=False, CONTEXT_TOKEN_BUDGET=600):
+      citations = asyncio.run(main._retrieve_citations(req, [1.0]))
+    self.assertLess(len(citations), 20)
+    self.assertLessEqual(sum(count_tokens(c.context) for c in citations), 600)
+    prompt = main._render_sources_for_prompt(citations)
+    self.assertIn(citations[0].context, prompt)
+    self.assertNotIn("context", main._serialize_citation(citations[0]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
+from ai_engine import main
+from ai_engine.diversify import cap_per_group, mmr_order
+
+
+class DiversifyTest(unittest.TestCase):
+  def test_mmr_skips_near_copies_of_earlier_picks(self):
+    vecs = np.array([[1.0, 0.0], [0.999, 0.045], [0.0, 1.0]], dtype=np.float32)
+    self.assertEqual(mmr_order([0.9, 0.89, 0.6], vecs, lambda_=0.5), [0, 2, 1])
+    # lambda 1.0 is plain relevance order
+    self.assertEqual(mmr_order([0.9, 0.89, 0.6], vecs, lambda_=1.0), [0, 1, 2])
+    self.assertEqual(mmr_order([0.9, 0.89, 0.6], vecs, k=1), [0])
+    self.assertEqual(mmr_order([], np.zeros((0, 2))), [])
+
+  def test_cap_per_group_keeps_order(self):
+    self.assertEqual(cap_per_group(["a", "a", "b", "a", "b", "c"], cap=1), [0, 2, 5])
+
+
+class _Store:
+  def __init__(self, vectors):
+    self._vectors = vectors
+
+  def vectors(self, ids):
+    return {i: self._vectors[i] for i in ids if i in self._vectors}
+
+
+class AskDiversityTest(unittest.TestCase):
+  def test_request_settings_reorder_and_cap_candidates(self):
+    def m(id_, doc, score):
+      return {"id": id_, "score": score, "content": id_, "metadata": {"document_id": doc}}
+
+    matches = [m("p1", "d1", 0.95), m("p1b", "d1", 0.94), m("p1c", "d1", 0.93), m("q", "d2", 0.7)]
+    store = _Store({
+      "p1": np.array([1.0, 0.0], dtype=np.float32),
+      "p1b": np.array([0.999, 0.045], dtype=np.float32),
+      "p1c": np.array([0.998, 0.063], dtype=np.float32),
+      "q": np.array([0.0, 1.0], dtype=np.float32),
+    })
+    ids = lambda out: [x["id"] for x in out]
+    with mock.patch.multiple(main, store=store, DIVERSITY_MODE="mmr", MAX_CHUNKS_PER_DOCUMENT=0):
+      self.assertEqual(ids(asyncio.run(main._diversify(main.AskRequest(question="x", mmr_lambda=0.5), matches)))[:2], ["p1", "q"])
+      self.assertEqual(ids(asyncio.run(main._diversify(main.AskRequest(question="x", diversity="none"), matches))), ["p1", "p1b", "p1c", "q"])
+      self.assertEqual(ids(asyncio.run(main._diversify(main.AskRequest(question="x", diversity="none", max_per_document=2), matches))), ["p1", "p1b", "q"])
+
+
+if __name__ == "__main__":
+  unittest.main()
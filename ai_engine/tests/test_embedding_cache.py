@@ -0,0 +1,90 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
+from ai_engine import main
+from ai_engine.embedding_cache import EmbeddingCache, QueryEmbeddingCache, cache_key
+from ai_engine.embeddings import EmbedResult
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, "vs", "store.sqlite3.embcache")
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_keys_depend_on_model_and_normalized_text(self):
+    self.assertEqual(cache_key("m", "Hello   world\n"), cache_key("m", "Hello world"))
+    self.assertNotEqual(cache_key("m", "Hello world"), cache_key("other", "Hello world"))
+    self.assertNotEqual(cache_key("m", "Hello world"), cache_key("m", "hello world"))
+
+  def test_round_trip_survives_reopen(self):
+    cache = EmbeddingCache(self.path)
+    cache.put_many("m", ["a", "b"], [[0.5, 1.0], None])
+    self.assertEqual(cache.get_many("m", ["a", "b", " a "]), [[0.5, 1.0], None, [0.5, 1.0]])
+    self.assertEqual((cache.hits, cache.misses), (2, 1))
+    self.assertEqual(EmbeddingCache(self.path).get_many("m", ["a"]), [[0.5, 1.0]])
+    self.assertEqual(EmbeddingCache(self.path).get_many("other", ["a"]), [None])
+
+  def test_evicts_least_recently_used_over_budget(self):
+    # Each entry is 4 floats = 16 bytes; the budget holds three
+    cache = EmbeddingCache(self.path, max_bytes=48)
+    cache.put_many("m", ["a", "b", "c"], [[1.0] * 4, [2.0] * 4, [3.0] * 4])
+    cache.get_many("m", ["a"])
+    cache.put_many("m", ["d"], [[4.0] * 4])
+    got = cache.get_many("m", ["a", "b", "c", "d"])
+    self.assertIsNone(got[1])
+    self.assertEqual(got[0], [1.0] * 4)
+    self.assertEqual(got[3], [4.0] * 4)
+    self.assertLessEqual(cache.stats()["bytes"], 48)
+
+  def test_refresh_bypasses_and_rewrites_the_cache(self):
+    calls = []
+
+    async def provider(texts, model=None):
+      calls.append(list(texts))
+      return EmbedResult(vectors=[[float(len(calls))] for _ in texts])
+
+    with mock.patch.multiple(main, embed_texts_partial=provider, embed_cache=EmbeddingCache(self.path)):
+      self.assertEqual(asyncio.run(main.embed_texts_cached(["a"])).vectors, [[1.0]])
+      self.assertEqual(asyncio.run(main.embed_texts_cached(["a"])).vectors, [[1.0]])
+      self.assertEqual(asyncio.run(main.embed_texts_cached(["a"], refresh=True)).vectors, [[2.0]])
+      self.assertEqual(asyncio.run(main.embed_texts_cached(["a"])).vectors, [[2.0]])
+    self.assertEqual(calls, [["a"], ["a"]])
+
+
+class QueryEmbeddingCacheTest(unittest.TestCase):
+  def test_lru_ttl_and_counters(self):
+    cache = QueryEmbeddingCache(max_entries=2, ttl=60)
+    cache.put_many("m", ["q1", "q2"], [[1.0], [2.0]])
+    self.assertEqual(cache.get_many("m", ["q1 ", "q3"]), [[1.0], None])
+    cache.put_many("m", ["q3"], [[3.0]])
+    self.assertEqual(cache.get_many("m", ["q2", "q1", "q3"]), [None, [1.0], [3.0]])
+    self.assertEqual(cache.stats(), {"entries": 2, "hits": 3, "misses": 2})
+    with mock.patch("ai_engine.embedding_cache.time.monotonic", return_value=time.monotonic() + 61):
+      self.assertEqual(cache.get_many("m", ["q1"]), [None])
+
+  def test_repeated_questions_skip_the_provider(self):
+    sent = []
+
+    async def provider(texts, model=None):
+      sent.extend(texts)
+      return EmbedResult(vectors=[[float(len(t))] for t in texts])
+
+    with mock.patch.multiple(main, embed_texts_partial=provider, query_embed_cache=QueryEmbeddingCache()):
+      self.assertEqual(asyncio.run(main.embed_texts(["What is revenue?"])), [[16.0]])
+      self.assertEqual(asyncio.run(main.embed_texts(["What is  revenue?"])), [[16.0]])
+      self.assertEqual(sent, ["What is revenue?"])
+      self.assertEqual(main.cache_stats()["query_embeddings"]["hits"], 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+
+from ai_engine.embeddings import EmbeddingBatcher, plan_batches
+from ai_engine.limits import UpstreamLimiter
+
+
+class _RateLimited(Exception):
+  status_code = 429
+
+
+class _BadRequest(Exception):
+  status_code = 400
+
+
+async def _no_sleep(_delay):
+  return None
+
+
+class EmbeddingBatcherTest(unittest.TestCase):
+  def test_plan_batches_respects_item_and_token_limits(self):
+    texts = ["a" * 40, "b" * 40, "c" * 40, "d" * 400, "e"]
+    self.assertEqual(plan_batches(texts, max_items=2, max_tokens=1000), [[0, 1], [2, 3], [4]])
+    # 10 estimated tokens each; the oversized text gets a batch of its own
+    self.assertEqual(plan_batches(texts, max_items=10, max_tokens=25), [[0, 1], [2], [3], [4]])
+    self.assertEqual(plan_batches([], max_items=2, max_tokens=10), [])
+
+  def test_batches_run_concurrently_and_keep_input_order(self):
+    state = {"in_flight": 0, "peak": 0}
+
+    async def create(texts):
+      state["in_flight"] += 1
+      state["peak"] = max(state["peak"], state["in_flight"])
+      await asyncio.sleep(0.01)
+      state["in_flight"] -= 1
+      return [[float(t)] for t in texts]
+
+    batcher = EmbeddingBatcher(create, max_items=2, concurrency=3)
+    res = asyncio.run(batcher.embed([str(i) for i in range(12)]))
+    self.assertEqual(res.vectors, [[float(i)] for i in range(12)])
+    self.assertEqual(res.failed, 0)
+    self.assertEqual(state["peak"], 3)
+
+  def test_rate_limits_back_off_and_bad_batches_fail_alone(self):
+    calls = {"n": 0}
+    delays = []
+
+    async def create(texts):
+      if "bad" in texts:
+        raise _BadRequest("invalid input")
+      calls["n"] += 1
+      if calls["n"] <= 2:
+        raise _RateLimited("slow down")
+      return [[1.0] for _ in texts]
+
+    async def sleep(delay):
+      delays.append(delay)
+
+    batcher = EmbeddingBatcher(create, max_items=1, concurrency=1, base_delay=1.0, sleep=sleep)
+    res = asyncio.run(batcher.embed(["ok", "bad", "fine"]))
+    self.assertEqual(res.vectors, [[1.0], None, [1.0]])
+    self.assertEqual(res.failed, 1)
+    self.assertEqual(res.errors, ["invalid input"])
+    self.assertEqual(len(delays), 2)
+    self.assertTrue(0 <= delays[0] <= 1.0 and 0 <= delays[1] <= 2.0)
+
+  def test_gives_up_after_max_retries(self):
+    async def create(texts):
+      raise _RateLimited("still limited")
+
+    batcher = EmbeddingBatcher(create, max_retries=2, sleep=_no_sleep)
+    res = asyncio.run(batcher.embed(["x", "y"]))
+    self.assertEqual(res.vectors, [None, None])
+    self.assertEqual(res.errors, ["still limited"])
+
+
+class UpstreamLimiterTest(unittest.TestCase):
+  def test_caps_in_flight_calls_per_upstream(self):
+    limiter = UpstreamLimiter({"chat": 2}, default=5)
+    peak = {}
+
+    async def call(name):
+      async with limiter(name):
+        peak[name] = max(peak.get(name, 0), limiter.in_flight[name])
+        await asyncio.sleep(0.01)
+
+    async def main():
+      await asyncio.gather(*[call("chat") for _ in range(6)], *[call("other") for _ in range(8)])
+
+    asyncio.run(main())
+    # Semaphores are per event loop, so the limiter survives a second asyncio.run
+    asyncio.run(main())
+    self.assertEqual(peak, {"chat": 2, "other": 5})
+    self.assertEqual(limiter.in_flight, {"chat": 0, "other": 0})
+
+
+if __name__ == "__main__":
+  unittest.main()
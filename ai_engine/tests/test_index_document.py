@@ -0,0 +1,216 @@
+import asyncio
+import http.client
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import uvicorn
+
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
+from ai_engine import main
+from ai_engine.embeddings import EmbedResult
+from ai_engine.vector_store import VectorStore
+
+
+class IncrementalIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.store = VectorStore(os.path.join(self.tmp.name, "vs", "store.sqlite3"))
+    self.embedded = []
+    self.refreshed = []
+
+    async def fake_embed(texts, model=None, refresh=False):
+      self.embedded.extend(texts)
+      self.refreshed.append(refresh)
+      return EmbedResult(vectors=[[float(len(t)), 1.0] for t in texts])
+
+    patches = [
+      mock.patch.object(main, "store", self.store),
+      mock.patch.object(main, "embed_texts_cached", fake_embed),
+    ]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+
+  def tearDown(self):
+    self.store.close()
+    self.tmp.cleanup()
+
+  def _index(self, pages, **kwargs):
+    req = main.IndexDocumentRequest(
+      document_id="42",
+      title="Report",
+      pages=[main.PageChunk(page=i + 1, text=t) for i, t in enumerate(pages)],
+      **kwargs,
+    )
+    self.embedded = []
+    return asyncio.run(main.index_document(req))
+
+  def test_only_changed_chunks_are_embedded_and_vanished_ones_removed(self):
+    out = self._index(["alpha page", "beta page", "gamma page"])
+    self.assertEqual((out["chunks"], out["added"], out["updated"], out["removed"]), (3, 3, 0, 0))
+
+    out = self._index(["alpha page", "beta page, edited"])
+    self.assertEqual(self.embedded, ["beta page, edited"])
+    self.assertEqual(
+      {k: out[k] for k in ("chunks", "added", "updated", "removed", "unchanged")},
+      {"chunks": 2, "added": 0, "updated": 1, "removed": 1, "unchanged": 1},
+    )
+    contents = sorted(r[0] for r in self.store.conn.execute("SELECT content FROM items WHERE document_id = '42'"))
+    self.assertEqual(contents, ["alpha page", "beta page, edited"])
+
+  def test_metadata_changes_update_without_embedding(self):
+    self._index(["alpha page"])
+    out = self._index(["alpha page"], metadata={"organization": "7"})
+    self.assertEqual(self.embedded, [])
+    self.assertEqual((out["updated"], out["unchanged"]), (1, 0))
+    self.assertEqual(self.store.query([10.0, 1.0], top_k=1, filters={"organization": "7"})[0]["content"], "alpha page")
+
+  def test_full_mode_re_embeds_everything(self):
+    self._index(["alpha page", "beta page"])
+    self.refreshed = []
+    out = self._index(["alpha page", "beta page"], incremental=False)
+    self.assertEqual(len(self.embedded), 2)
+    self.assertEqual(self.refreshed, [True])
+    self.assertEqual((out["added"], out["updated"], out["unchanged"]), (0, 2, 0))
+
+
+class StreamIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.store = VectorStore(os.path.join(self.tmp.name, "vs", "store.sqlite3"))
+    self.batches = []
+
+    async def fake_embed(texts, model=None, refresh=False):
+      self.batches.append(list(texts))
+      return EmbedResult(vectors=[[float(len(t)), 1.0] for t in texts])
+
+    patches = [
+      mock.patch.object(main, "store", self.store),
+      mock.patch.object(main, "embed_texts_cached", fake_embed),
+      mock.patch.object(main, "INDEX_STREAM_BATCH", 2),
+    ]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+
+  def tearDown(self):
+    self.store.close()
+    self.tmp.cleanup()
+
+  def _stream(self, *records, split=7):
+    body = b"".join(json.dumps(r).encode() + b"\n" for r in records)
+
+    async def chunks():
+      # Records arrive cut at arbitrary byte offsets
+      for i in range(0, len(body), split):
+        yield body[i : i + split]
+
+    async def run():
+      return [json.loads(line) async for line in main._index_stream(chunks())]
+
+    return asyncio.run(run())
+
+  def test_pages_are_committed_in_batches_with_progress(self):
+    header = {"type": "document", "document_id": "7", "title": "Manual"}
+    pages = [{"type": "page", "page": i, "text": f"page {i} text"} for i in range(1, 6)]
+    out = self._stream(header, *pages)
+    self.assertEqual([r["type"] for r in out], ["progress"] * 3 + ["done"])
+    self.assertEqual([len(b) for b in self.batches], [2, 2, 1])
+    self.assertEqual(out[-1]["chunks"], 5)
+    self.assertEqual(out[-1]["added"], 5)
+    self.assertEqual(len(self.store.document_chunks("7")), 5)
+
+    # Same ids as the one-shot endpoint, so re-indexing either way is incremental
+    self.batches = []
+    req = main.IndexDocumentRequest(
+      document_id="7", title="Manual", pages=[main.PageChunk(page=i, text=f"page {i} text") for i in range(1, 5)]
+    )
+    res = asyncio.run(main.index_document(req))
+    self.assertEqual(self.batches, [])
+    self.assertEqual((res["unchanged"], res["removed"]), (4, 1))
+
+  def test_text_records_continue_one_text(self):
+    out = self._stream(
+      {"type": "document", "document_id": "8"},
+      {"type": "text", "text": "# Intro\n\nfirst part"},
+      {"type": "text", "text": "second part"},
+    )
+    self.assertTrue(out[-1]["ok"])
+    rows = self.store.conn.execute("SELECT content, metadata FROM items WHERE document_id = '8'").fetchall()
+    metas = {content: json.loads(meta) for content, meta in rows}
+    self.assertEqual(sorted(m["chunk_id"] for m in metas.values()), ["8:c0", "8:c1"])
+    self.assertEqual(metas["second part"]["heading_path"], ["Intro"])
+
+  def test_bad_record_stops_without_removing_stored_chunks(self):
+    self._stream({"type": "document", "document_id": "9"}, {"type": "page", "page": 1, "text": "kept"})
+    out = self._stream({"type": "document", "document_id": "9"}, {"type": "chapter", "text": "?"})
+    self.assertEqual((out[-1]["type"], out[-1]["error"]), ("error", "bad_record"))
+    self.assertEqual(len(self.store.document_chunks("9")), 1)
+
+  def test_overlong_record_is_rejected(self):
+    with mock.patch.object(main, "INDEX_STREAM_MAX_LINE", 200):
+      out = self._stream(
+        {"type": "document", "document_id": "10"},
+        {"type": "page", "page": 1, "text": "short"},
+        {"type": "page", "page": 2, "text": "x" * 500},
+        split=50,
+      )
+    self.assertEqual((out[-1]["type"], out[-1]["error"]), ("error", "bad_record"))
+    self.assertIn("longer than 200 bytes", out[-1]["detail"])
+
+  def test_missing_header_is_an_error(self):
+    out = self._stream({"type": "page", "page": 1, "text": "x"})
+    self.assertEqual(out, [{"type": "error", "ok": False, "error": "bad_record", "detail": out[0]["detail"]}])
+
+
+class StreamIndexServerTest(StreamIndexTest):
+  """The stream tests again, through a real uvicorn server: its ASGI receive() is shared
+  between the request body and the response's disconnect listener."""
+
+  def setUp(self):
+    super().setUp()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    self.port = sock.getsockname()[1]
+    self.server = uvicorn.Server(uvicorn.Config(main.app, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=self.server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    self.addCleanup(thread.join, 10)
+    self.addCleanup(setattr, self.server, "should_exit", True)
+    deadline = time.monotonic() + 10
+    while not self.server.started:
+      self.assertLess(time.monotonic(), deadline)
+      time.sleep(0.01)
+
+  def _post(self, body):
+    conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+    try:
+      conn.request("POST", "/index_document/stream", body=body, headers={"Content-Type": "application/x-ndjson"})
+      resp = conn.getresponse()
+      self.assertEqual(resp.status, 200)
+      return [json.loads(line) for line in resp.read().splitlines()]
+    finally:
+      conn.close()
+
+  def _stream(self, *records, split=7):
+    body = b"".join(json.dumps(r).encode() + b"\n" for r in records)
+    # A generator body goes out chunked, one HTTP chunk per slice
+    return self._post(body[i : i + split] for i in range(0, len(body), split))
+
+  def test_one_shot_body(self):
+    header = {"type": "document", "document_id": "11"}
+    page = {"type": "page", "page": 1, "text": "only page"}
+    out = self._post(b"".join(json.dumps(r).encode() + b"\n" for r in (header, page)))
+    self.assertEqual((out[-1]["type"], out[-1]["chunks"]), ("done", 1))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# main opens its vector store and embedding cache on import; keep them out of the tree
+os.environ.setdefault("VECTOR_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="ai-engine-tests-"), "vector_store.sqlite3"))
+
+from ai_engine import main
+from ai_engine.rerank import Reranker, bm25_scores, tokenize
+
+
+class RerankerTest(unittest.TestCase):
+  def test_bm25_prefers_rare_matching_terms(self):
+    docs = [tokenize(t) for t in ["the invoice total is due", "payment terms and total", "weather report"]]
+    scores = bm25_scores(tokenize("invoice total"), docs)
+    self.assertGreater(scores[0], scores[1])
+    self.assertEqual(scores[2], 0.0)
+
+  def test_lexical_match_overtakes_slightly_closer_vector(self):
+    passages = ["Quarterly marketing plan overview", "Refund policy: refunds are issued within 30 days"]
+    ranked = Reranker().rerank("What is the refund policy?", passages, vector_scores=[0.82, 0.80])
+    self.assertEqual([i for i, _ in ranked], [1, 0])
+    # Without lexical signal the vector order is kept
+    ranked = Reranker().rerank("zzz", passages, vector_scores=[0.82, 0.80])
+    self.assertEqual([i for i, _ in ranked], [0, 1])
+    self.assertEqual(Reranker().rerank("q", []), [])
+
+  def test_missing_cross_encoder_falls_back_to_lexical(self):
+    r = Reranker(cross_encoder="no/such-model")
+    with mock.patch.dict("sys.modules", {"sentence_transformers": None}):
+      ranked = r.rerank("refund", ["nothing here", "refund rules"])
+    self.assertEqual(ranked[0][0], 1)
+    self.assertTrue(r._model_failed)
+
+
+class RetrieveRerankTest(unittest.TestCase):
+  def test_context_is_chosen_after_reranking_the_candidate_pool(self):
+    matches = [
+      {"id": f"c{i}", "score": 0.9 - i * 0.01, "content": f"filler text number {i}", "metadata": {"document_id": f"d{i}", "chunk": 0}}
+      for i in range(7)
+    ]
+    matches.append({"id": "c7", "score": 0.83, "content": "The warranty period is two years", "metadata": {"document_id": "d7", "chunk": 0}})
+
+    async def query_store(emb, **kwargs):
+      self.assertEqual(kwargs["top_k"], 8)
+      return matches
+
+    req = main.AskRequest(question="How long is the warranty period?", top_k=2)
+    with mock.patch.multiple(main, query_store=query_store, RERANK_ENABLED=True):
+      citations = asyncio.run(main._retrieve_citations(req, [1.0]))
+    self.assertEqual(len(citations), 8)
+    self.assertEqual(citations[0].chunk_id, "c7")
+    with mock.patch.multiple(main, query_store=query_store, RERANK_ENABLED=False):
+      citations = asyncio.run(main._retrieve_citations(req, [1.0]))
+    self.assertEqual([c.chunk_id for c in citations][:2], ["c0", "c1"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,387 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ai_engine import vector_store
+from ai_engine.vector_store import SCHEMA_VERSION, VectorStore
+
+# Writes, deletes, queries and compacts the store at argv[1] as worker argv[2]
+_WORKER = """
+import sys
+from vector_store import VectorStore
+path, name = sys.argv[1], sys.argv[2]
+store = VectorStore(path)
+for i in range(30):
+  store.add_many([
+    {"id": f"{name}-{i}-{j}", "content": "t", "metadata": {"document_id": f"{name}-{i}"}, "embedding": [1.0, float(j), float(i)]}
+    for j in range(3)
+  ])
+  if i % 3:
+    store.delete_by_document_id(f"{name}-{i - 1}")
+  store.query([1.0, 0.0, 0.0], top_k=5)
+  if i % 5 == 0:
+    store.compact()
+store.close()
+"""
+
+
+def _item(id_, doc_id, emb, content="text"):
+  return {"id": id_, "content": content, "metadata": {"document_id": doc_id}, "embedding": emb}
+
+
+class VectorStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, "vs", "vector_store.sqlite3")
+    self.stores = []
+
+  def tearDown(self):
+    for store in self.stores:
+      store.close()
+    self.tmp.cleanup()
+
+  def _open(self, **kwargs):
+    store = VectorStore(self.path, **kwargs)
+    self.stores.append(store)
+    return store
+
+  def test_embeddings_are_stored_in_segment_files(self):
+    store = self._open()
+    store.add_many([_item("a", "1", [3.0, 0.0, 4.0])])
+    cols = [r[1] for r in store.conn.execute("PRAGMA table_info(items)")]
+    self.assertNotIn("embedding", cols)
+    self.assertTrue(os.listdir(self.path + ".segments"))
+    found = store.vectors(["a"])
+    self.assertEqual(list(found), ["a"])
+    np.testing.assert_allclose(found["a"], [0.6, 0.0, 0.8], rtol=1e-6)
+
+  def test_query_ranks_by_cosine_similarity(self):
+    store = self._open()
+    store.add_many([
+      _item("a", "1", [1.0, 0.0], content="east"),
+      _item("b", "2", [0.0, 1.0], content="north"),
+      _item("c", "3", [0.7, 0.7], content="north-east"),
+    ])
+    out = store.query([1.0, 0.1], top_k=2)
+    self.assertEqual([m["id"] for m in out], ["a", "c"])
+    self.assertEqual(out[0]["metadata"]["document_id"], "1")
+    self.assertAlmostEqual(out[0]["score"], 0.995, places=3)
+
+  def test_legacy_json_store_is_migrated(self):
+    os.makedirs(os.path.dirname(self.path))
+    conn = sqlite3.connect(self.path)
+    conn.execute("CREATE TABLE items (id TEXT PRIMARY KEY, content TEXT NOT NULL, metadata TEXT, embedding TEXT NOT NULL)")
+    conn.executemany(
+      "INSERT INTO items VALUES (?,?,?,?)",
+      [
+        ("a", "alpha", json.dumps({"document_id": "1"}), json.dumps([0.25, 0.5])),
+        ("broken", "beta", "{}", "not json"),
+      ],
+    )
+    conn.commit()
+    conn.close()
+
+    store = self._open()
+    self.assertEqual(store.conn.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+    found = store.vectors(["a", "broken"])
+    self.assertEqual(list(found), ["a"])
+    np.testing.assert_allclose(found["a"], np.array([0.25, 0.5]) / np.hypot(0.25, 0.5), rtol=1e-6)
+    out = store.query([0.25, 0.5], top_k=1)
+    self.assertEqual(out[0]["content"], "alpha")
+    self.assertEqual(out[0]["metadata"], {"document_id": "1"})
+
+  def test_v1_store_gets_indexed_metadata_columns(self):
+    os.makedirs(os.path.dirname(self.path))
+    conn = sqlite3.connect(self.path)
+    conn.execute("CREATE TABLE items (id TEXT PRIMARY KEY, content TEXT NOT NULL, metadata TEXT, embedding BLOB NOT NULL)")
+    conn.executemany(
+      "INSERT INTO items VALUES (?,?,?,?)",
+      [
+        ("a", "alpha", json.dumps({"document_id": 7, "source_type": "pdf", "organization": "3"}), b"\x00\x00\x80\x3f"),
+        ("b", "beta", "garbage", b"\x00\x00\x80\x3f"),
+      ],
+    )
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    store = self._open()
+    rows = store.conn.execute("SELECT id, document_id, source_type, organization FROM items ORDER BY id").fetchall()
+    self.assertEqual(rows, [("a", "7", "pdf", "3"), ("b", None, None, None)])
+    plan = " ".join(str(r) for r in store.conn.execute("EXPLAIN QUERY PLAN DELETE FROM items WHERE document_id = '7'"))
+    self.assertIn("idx_items_document_id", plan)
+    self.assertEqual(store.delete_by_document_id(7), 1)
+    self.assertEqual([m["id"] for m in store.query([2.0], top_k=5)], ["b"])
+
+  def test_delete_and_clear(self):
+    store = self._open()
+    store.add_many([_item("a", "1", [1.0, 0.0]), _item("b", "1", [0.0, 1.0]), _item("c", "2", [1.0, 1.0])])
+    self.assertEqual(store.delete_by_document_id("1"), 2)
+    self.assertEqual([m["id"] for m in store.query([1.0, 0.0], top_k=5)], ["c"])
+    self.assertEqual(store.clear_all(), 1)
+    self.assertEqual(store.query([1.0, 0.0], top_k=5), [])
+
+  def test_delete_many_documents(self):
+    store = self._open()
+    store.add_many([_item(str(i), str(i % 3), [1.0, float(i)]) for i in range(9)])
+    self.assertEqual(store.delete_by_document_ids(["0", "2", 2, "missing"]), 6)
+    self.assertEqual(sorted(m["id"] for m in store.query([1.0, 0.0], top_k=9)), ["1", "4", "7"])
+
+  def test_matrix_cache_tracks_writes_after_first_query(self):
+    store = self._open()
+    store.add_many([_item("a", "1", [1.0, 0.0])])
+    self.assertEqual([m["id"] for m in store.query([0.0, 1.0], top_k=5)], ["a"])
+    store.add_many([_item("b", "2", [0.0, 2.0]), _item("a", "1", [0.0, -1.0])])
+    out = store.query([0.0, 1.0], top_k=5)
+    self.assertEqual([m["id"] for m in out], ["b", "a"])
+    self.assertAlmostEqual(out[0]["score"], 1.0, places=5)
+    store.delete_by_document_id("2")
+    self.assertEqual([m["id"] for m in store.query([0.0, 1.0], top_k=5)], ["a"])
+    store.clear_all()
+    store.add_many([_item("c", "3", [3.0, 4.0, 0.0])])
+    self.assertEqual([m["id"] for m in store.query([3.0, 4.0, 0.0], top_k=5)], ["c"])
+
+  def test_filters_restrict_rows_before_scoring(self):
+    store = self._open()
+
+    def meta_item(id_, emb, **meta):
+      return {"id": id_, "content": id_, "metadata": meta, "embedding": emb}
+
+    store.add_many([
+      meta_item("a", [1.0, 0.0], document_id="1", organization="10", uploader="5", source_type="pdf", created_at="2025-01-10T08:00:00+00:00"),
+      meta_item("b", [0.9, 0.1], document_id="2", organization="10", uploader="6", source_type="web", created_at="2025-02-01T08:00:00+00:00"),
+      meta_item("c", [1.0, 0.0], document_id="3", organization="20", uploader="7", source_type="pdf", created_at="2025-03-01T08:00:00+00:00"),
+    ])
+    q = [1.0, 0.0]
+    self.assertEqual([m["id"] for m in store.query(q, top_k=5, filters={"organization": "10"})], ["a", "b"])
+    self.assertEqual([m["id"] for m in store.query(q, top_k=5, filters={"uploader": "6"})], ["b"])
+    self.assertEqual([m["id"] for m in store.query(q, top_k=5, filters={"document_ids": ["2", "3"]})], ["c", "b"])
+    self.assertEqual([m["id"] for m in store.query(q, top_k=5, filters={"source_type": "pdf", "organization": "20"})], ["c"])
+    self.assertEqual([m["id"] for m in store.query(q, top_k=5, filters={"date_from": "2025-02-01", "date_to": "2025-02-01"})], ["b"])
+    self.assertEqual(store.query(q, top_k=5, filters={"document_ids": []}), [])
+    # The cached slot set follows writes
+    store.add_many([meta_item("d", [1.0, 0.0], document_id="4", organization="10")])
+    self.assertEqual(len(store.query(q, top_k=5, filters={"organization": "10"})), 3)
+    store.delete_by_document_id("1")
+    self.assertEqual(sorted(m["id"] for m in store.query(q, top_k=5, filters={"organization": "10"})), ["b", "d"])
+
+  def test_date_filters_compare_in_utc(self):
+    store = self._open()
+
+    def dated(id_, created_at):
+      return {"id": id_, "content": id_, "metadata": {"created_at": created_at}, "embedding": [1.0, 0.0]}
+
+    store.add_many([
+      dated("late", "2025-02-01T23:30:00-02:00"),
+      dated("zulu", "2025-02-01T08:00:00Z"),
+      dated("naive", "2025-02-01T12:00:00"),
+    ])
+
+    def ids(**filters):
+      return sorted(m["id"] for m in store.query([1.0, 0.0], top_k=5, filters=filters))
+
+    self.assertEqual(ids(date_from="2025-02-01", date_to="2025-02-01"), ["naive", "zulu"])
+    self.assertEqual(ids(date_from="2025-02-02T00:00:00+00:00"), ["late"])
+    self.assertEqual(ids(date_to="2025-02-01T10:00:00+02:00"), ["zulu"])
+
+  def test_v5_store_gets_created_at_in_utc(self):
+    self._open().add_many([_item("a", "1", [1.0, 0.0])])
+    conn = sqlite3.connect(self.path)
+    conn.execute("UPDATE items SET created_at = '2025-02-01T08:00:00Z'")
+    conn.execute("PRAGMA user_version = 5")
+    conn.commit()
+    conn.close()
+    store = self._open()
+    self.assertEqual(store.conn.execute("SELECT created_at FROM items").fetchone()[0], "2025-02-01T08:00:00.000000")
+
+  def test_filtered_scoring_runs_outside_the_store_lock(self):
+    store = self._open()
+    store.add_many([_item("a", "1", [1.0, 0.0]), _item("b", "2", [0.0, 1.0])])
+    search = vector_store.SegmentMatrix.search
+    free = []
+
+    def probe(view, *args, **kwargs):
+      def try_lock():
+        if store._lock.acquire(timeout=1):
+          store._lock.release()
+          free.append(True)
+      t = threading.Thread(target=try_lock)
+      t.start()
+      t.join()
+      return search(view, *args, **kwargs)
+
+    with mock.patch.object(vector_store.SegmentMatrix, "search", probe):
+      self.assertEqual([m["id"] for m in store.query([1.0, 0.0], top_k=5, filters={"document_ids": ["1"]})], ["a"])
+    self.assertEqual(free, [True])
+
+  def test_hybrid_query_finds_exact_terms_and_tracks_writes(self):
+    store = self._open()
+    store.add_many([
+      _item("a", "1", [1.0, 0.0], content="Quarterly revenue grew strongly"),
+      _item("b", "1", [0.9, 0.1], content="Revenue outlook for next year"),
+      _item("c", "2", [0.0, 1.0], content="Invoice INV-2023-0042 was paid in March"),
+    ])
+    q = [1.0, 0.0]
+    self.assertNotIn("c", [m["id"] for m in store.query(q, top_k=2)])
+    out = store.query(q, top_k=2, text="status of INV-2023-0042?")
+    self.assertEqual(out[0]["id"], "c")
+    self.assertAlmostEqual(out[0]["score"], 0.0, places=5)
+    self.assertGreater(out[0]["bm25"], 0)
+    self.assertIn("rrf_score", out[0])
+    self.assertEqual([m["id"] for m in store.query(q, top_k=2, text="INV-2023-0042", filters={"document_ids": ["1"]})], ["a", "b"])
+    # Replaced and deleted rows leave the full-text index as well
+    store.add_many([_item("c", "2", [0.0, 1.0], content="Credit note CN-7")])
+    self.assertEqual(store.lexical_query("INV-2023-0042", top_k=5), [])
+    self.assertEqual([m["id"] for m in store.lexical_query("cn-7", top_k=5, embedding=[0.0, 2.0])], ["c"])
+    self.assertAlmostEqual(store.lexical_query("cn-7", embedding=[0.0, 2.0])[0]["score"], 1.0, places=5)
+    store.delete_by_document_id("2")
+    self.assertEqual(store.lexical_query("CN-7"), [])
+    self.assertEqual(store.lexical_query('"); DROP TABLE items; --'), [])
+
+  def test_vectors_by_id(self):
+    store = self._open()
+    store.add_many([_item("a", "1", [3.0, 4.0]), _item("b", "1", [0.0, 2.0]), _item("c", "1", [1.0, 0.0, 0.0])])
+    out = store.vectors(["b", "a", "c", "missing"])
+    self.assertEqual(sorted(out), ["a", "b"])
+    np.testing.assert_allclose(out["a"], [0.6, 0.8], rtol=1e-6)
+
+  def test_v4_store_gets_full_text_index(self):
+    self._open().add_many([_item("a", "1", [1.0, 0.0], content="purchase order PO-991")])
+    conn = sqlite3.connect(self.path)
+    conn.executescript("DROP TABLE items_fts; DROP TRIGGER items_fts_ai; DROP TRIGGER items_fts_ad; DROP TRIGGER items_fts_au; PRAGMA user_version = 4;")
+    conn.close()
+    store = self._open()
+    self.assertEqual([m["id"] for m in store.lexical_query("po-991")], ["a"])
+
+  def test_stream_mode_matches_matrix_mode(self):
+    rng = np.random.default_rng(3)
+    items = [
+      {"id": f"id{i}", "content": f"c{i}", "metadata": {"document_id": str(i % 5), "organization": str(i % 2)}, "embedding": rng.normal(size=8).tolist()}
+      for i in range(300)
+    ]
+    self._open().add_many(items)
+    matrix = self._open(mode="matrix")
+    stream = self._open(mode="stream")
+    stream.stream_batch_size = 64
+    q = rng.normal(size=8).tolist()
+    for filters in (None, {"organization": "1"}, {"document_ids": ["2", "4"]}):
+      expected = matrix.query(q, top_k=7, filters=filters)
+      got = stream.query(q, top_k=7, filters=filters)
+      self.assertEqual([m["id"] for m in got], [m["id"] for m in expected])
+      self.assertAlmostEqual(got[0]["score"], expected[0]["score"], places=5)
+      self.assertEqual(got[0]["content"], expected[0]["content"])
+
+  def test_segments_are_shared_compacted_and_survive_restart(self):
+    store = self._open()
+    for i in range(10):
+      store.add_many([_item(f"id{i}", str(i), [1.0, float(i)]), _item(f"x{i}", "x", [0.0, 1.0])])
+    # A second handle (another worker) sees writes through the shared files
+    other = self._open()
+    store.delete_by_document_id("x")
+    store.add_many([_item("id3", "3", [0.0, -1.0])])
+    self.assertTrue(store.wait_idle(timeout=30))
+    store.compact()
+    self.assertLessEqual(len([f for f in os.listdir(self.path + ".segments") if f.endswith(".vec")]), 2)
+    for s in (store, other, self._open()):
+      out = s.query([0.0, -1.0], top_k=3)
+      self.assertEqual(out[0]["id"], "id3")
+      self.assertNotIn("x0", [m["id"] for m in s.query([0.0, 1.0], top_k=20)])
+      self.assertEqual(len(s.query([1.0, 1.0], top_k=20)), 10)
+
+  def test_concurrent_processes_keep_rows_and_vectors_in_step(self):
+    self._open()
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(vector_store.__file__))
+    procs = [
+      subprocess.Popen([sys.executable, "-c", _WORKER, self.path, f"w{n}"], env=env, stderr=subprocess.PIPE, text=True)
+      for n in range(3)
+    ]
+    for p in procs:
+      _, err = p.communicate(timeout=120)
+      self.assertEqual(p.returncode, 0, err)
+      self.assertNotIn("Traceback", err)
+
+    store = self._open()
+    kept = [i for i in range(30) if (i + 1) % 3 == 0 or i == 29]
+    expected = {f"w{n}-{i}-{j}" for n in range(3) for i in kept for j in range(3)}
+    self.assertEqual({r[0] for r in store.conn.execute("SELECT id FROM items")}, expected)
+    found = store.vectors(expected)
+    self.assertEqual(set(found), expected)
+    np.testing.assert_allclose(found["w1-29-2"], np.array([1.0, 2.0, 29.0]) / np.linalg.norm([1.0, 2.0, 29.0]), rtol=1e-5)
+    with store._lock:
+      self.assertEqual(len(store._vectors()), len(expected))
+    names = os.listdir(self.path + ".segments")
+    self.assertFalse([f for f in names if f.endswith(".tmp")])
+    self.assertFalse([f for f in names if f.endswith(".del") and f[: -len(".del")] + ".vec" not in names])
+
+
+class IVFIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, "vector_store.sqlite3")
+    rng = np.random.default_rng(7)
+    centers = rng.normal(size=(4, 16))
+    self.items = []
+    for i in range(400):
+      vec = centers[i % 4] + 0.05 * rng.normal(size=16)
+      self.items.append(_item(f"id{i}", str(i % 4), vec.tolist()))
+
+    self.stores = []
+
+  def tearDown(self):
+    for store in self.stores:
+      store.close()
+    self.tmp.cleanup()
+
+  def _open(self, ann_min_size=100):
+    store = VectorStore(self.path, index="ivf")
+    store.ann_min_size = ann_min_size
+    self.stores.append(store)
+    return store
+
+  def test_builds_index_in_background_and_matches_exact_top_hit(self):
+    store = self._open()
+    store.add_many(self.items)
+    probe = self.items[5]["embedding"]
+    exact = store.query(probe, top_k=1)
+    self.assertTrue(store.wait_idle(timeout=30))
+    self.assertTrue(store._ann.ready)
+    approx = store.query(probe, top_k=1, nprobe=1)
+    self.assertEqual(approx[0]["id"], exact[0]["id"])
+
+  def test_index_tracks_inserts_and_deletes_and_survives_restart(self):
+    store = self._open()
+    store.add_many(self.items)
+    store.query(self.items[0]["embedding"], top_k=1)
+    self.assertTrue(store.wait_idle(timeout=30))
+    store.add_many([_item("new", "9", self.items[2]["embedding"])])
+    hits = store.query(self.items[2]["embedding"], top_k=3, nprobe=1)
+    self.assertIn("new", [h["id"] for h in hits])
+    store.delete_by_document_id("9")
+    hits = store.query(self.items[2]["embedding"], top_k=3, nprobe=1)
+    self.assertNotIn("new", [h["id"] for h in hits])
+    store.flush()
+    self.assertTrue(os.path.exists(self.path + ".ivf.npz"))
+
+    reopened = self._open()
+    reopened.query(self.items[1]["embedding"], top_k=1)
+    self.assertTrue(reopened.wait_idle(timeout=30))
+    self.assertTrue(reopened._ann.ready)
+    self.assertEqual(reopened.query(self.items[1]["embedding"], top_k=1, nprobe=1)[0]["metadata"]["document_id"], "1")
+
+  def test_small_store_uses_exact_scan(self):
+    store = self._open(ann_min_size=50000)
+    store.add_many(self.items[:10])
+    self.assertEqual(store.query(self.items[3]["embedding"], top_k=1)[0]["id"], "id3")
+    self.assertFalse(store._ann.ready)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,98 @@
+"""Local token counting for prompt and chunk budgets.
+
+Counts with tiktoken's o200k_base encoding. tiktoken is a dependency, and the
+Docker image fetches the encoding into TIKTOKEN_CACHE_DIR at build time, so it
+is loaded from local disk and never downloaded at runtime. If it still cannot
+be loaded (e.g. a local run without the cache or network access), counts fall
+back to the UTF-8 length estimate (embeddings.estimate_tokens) with a warning.
+"""
+import logging
+import re
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Iterator, List
+
+from embeddings import estimate_tokens
+
+logger = logging.getLogger("ai_engine")
+
+_SENTENCE_END = re.compile(r"[.!?](?=\s)")
+
+_encoder = None
+_encoder_lock = threading.Lock()
+_encoder_failed = False
+
+
+def _get_encoder():
+    global _encoder, _encoder_failed
+    if _encoder is not None or _encoder_failed:
+        return _encoder
+    with _encoder_lock:
+        if _encoder is None and not _encoder_failed:
+            try:
+                import tiktoken
+
+                _encoder = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                # Encoding neither in TIKTOKEN_CACHE_DIR nor fetchable (or a bare dev environment)
+                logger.warning("tokens tokenizer_unavailable error=%s; estimating tokens", e)
+                _encoder_failed = True
+    return _encoder
+
+
+def count_tokens(text: str) -> int:
+    enc = _get_encoder()
+    if enc is None:
+        return estimate_tokens(text)
+    return len(enc.encode(text or "", disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Prefix of text within max_tokens, ending at a sentence boundary when one falls in its second half."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    enc = _get_encoder()
+    if enc is not None:
+        cut = enc.decode(enc.encode(text, disallowed_special=())[:max_tokens])
+    else:
+        cut = text.encode("utf-8")[: max_tokens * 4].decode("utf-8", errors="ignore")
+    ends = [m.end() for m in _SENTENCE_END.finditer(cut)]
+    if ends and ends[-1] >= len(cut) // 2:
+        cut = cut[: ends[-1]]
+    return cut.rstrip()
+
+
+def _token_ends(text: str, data: bytes) -> List[int]:
+    """UTF-8 byte offset where each token of text ends (one encode for the whole text)."""
+    enc = _get_encoder()
+    if enc is None:
+        # The estimate counts 4 bytes per token
+        return list(range(4, len(data), 4)) + [len(data)] if data else []
+    return list(accumulate(len(enc.decode_single_token_bytes(t)) for t in enc.encode(text, disallowed_special=())))
+
+
+def split_tokens(text: str, max_tokens: int) -> Iterator[str]:
+    """Consecutive pieces of text of at most max_tokens each, cut at token boundaries.
+    Tokenizes once and slices by token offsets, so the cost is linear in the text length.
+    """
+    data = (text or "").encode("utf-8")
+    ends = _token_ends(text, data)
+    step = max(1, max_tokens)
+    start = 0
+    while start < len(data):
+        cut = ends[min(bisect_right(ends, start) + step - 1, len(ends) - 1)]
+        # A token may end inside a multi-byte character: cut before the character, or
+        # after it when that would leave the piece empty
+        back = cut
+        while back > start and back < len(data) and data[back] & 0xC0 == 0x80:
+            back -= 1
+        cut = back if back > start else cut
+        while cut < len(data) and data[cut] & 0xC0 == 0x80:
+            cut += 1
+        piece = data[start:cut].decode("utf-8").strip()
+        if piece:
+            yield piece
+        start = cut
@@ -1,93 +1,784 @@
-import os, json, sqlite3, math
-from typing import Iterable, List, Dict, Any
+import os, sys, json, re, sqlite3, threading, logging, hashlib
+import datetime
+from array import array
+from typing import Iterable, List, Dict, Any, Optional, Tuple
 
+import numpy as np
 
-def _ensure_db(conn: sqlite3.Connection):
+from ann_index import IVFIndex, assign_lists, default_nlist, train_centroids, training_sample_size
+from segments import Segment, SegmentMatrix, claim_seq, file_lock, normalize_rows, publish_segment, segment_path, write_segment
+
+# PRAGMA user_version of the current on-disk layout.
+#   0: embeddings stored as JSON text
+#   1: embeddings stored as little-endian float32 blobs
+#   2: document_id / source_type / organization promoted to indexed columns
+#   3: uploader / created_at columns for retrieval filters
+#   4: embeddings moved out of SQLite into memory-mapped segment files (segments.py)
+#   5: items_fts full-text (BM25) index over items.content, kept in sync by triggers
+#   6: created_at rewritten in one UTC form (see _iso_utc)
+SCHEMA_VERSION = 6
+
+# Reciprocal rank fusion constant for hybrid queries; larger values flatten the head of each ranking
+RRF_K = 60
+_FTS_TERM = re.compile(r"\w[\w.\-/]*", re.UNICODE)
+
+# Metadata keys copied into real columns so deletes and filters can use an index
+_META_COLUMNS = ("document_id", "source_type", "organization", "uploader", "created_at")
+
+
+def _create_items(conn: sqlite3.Connection):
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS items (
             id TEXT PRIMARY KEY,
             content TEXT NOT NULL,
             metadata TEXT,
-            embedding TEXT NOT NULL -- JSON array of floats
+            document_id TEXT,
+            source_type TEXT,
+            organization TEXT,
+            uploader TEXT,
+            created_at TEXT, -- UTC ISO 8601 from _iso_utc, compared lexically
+            seg INTEGER, -- segment holding the vector, NULL when the item has none
+            row INTEGER -- row within that segment
         )
         """
     )
+    for col in _META_COLUMNS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_items_{col} ON items ({col})")
+
+
+def _create_fts(conn: sqlite3.Connection, rebuild: bool = False) -> bool:
+    """External-content FTS5 index over items.content. Returns False when SQLite lacks FTS5.
+    The index refers to items by rowid, so it is rebuilt after migrations (which VACUUM)
+    and whenever it is created for an existing table.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'").fetchone() is not None
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5("
+            "content, content='items', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')"
+        )
+    except sqlite3.OperationalError as e:
+        logging.getLogger("ai_engine").warning("vector_store fts5_unavailable error=%s", e)
+        return False
+    conn.executescript(
+        """
+        CREATE TRIGGER IF NOT EXISTS items_fts_ai AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, content) VALUES (new.rowid, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_ad AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_au AFTER UPDATE OF content ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+            INSERT INTO items_fts (rowid, content) VALUES (new.rowid, new.content);
+        END;
+        """
+    )
+    if rebuild or not exists:
+        conn.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+    return True
+
+
+def _ensure_db(conn: sqlite3.Connection, segment_dir: str) -> bool:
+    """Bring the file up to SCHEMA_VERSION. Returns whether full-text search is available."""
+    version = int(conn.execute("PRAGMA user_version").fetchone()[0] or 0)
+    if version < 1:
+        _migrate_json_embeddings(conn)
+    if version < 3:
+        _backfill_meta_columns(conn)
+    if version < 4:
+        _move_embeddings_to_segments(conn, segment_dir)
+    _create_items(conn)
+    if version < 6:
+        _normalize_created_at(conn)
+    fts = _create_fts(conn, rebuild=version < SCHEMA_VERSION)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
+    return fts
+
+
+def _migrate_json_embeddings(conn: sqlite3.Connection, batch_size: int = 1000):
+    """Rewrite a legacy store (JSON text embeddings) into float32 blobs.
+    Rows whose embedding cannot be parsed are dropped, as query() skipped them anyway.
+    """
+    cols = {row[1]: (row[2] or "").upper() for row in conn.execute("PRAGMA table_info(items)")}
+    if not cols or cols.get("embedding") == "BLOB":
+        return
+    try:
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE items RENAME TO items_json")
+        # The v1 layout; later migrations take it from here
+        conn.execute("CREATE TABLE items (id TEXT PRIMARY KEY, content TEXT NOT NULL, metadata TEXT, embedding BLOB NOT NULL)")
+        cur = conn.execute("SELECT id, content, metadata, embedding FROM items_json")
+        while True:
+            batch = cur.fetchmany(batch_size)
+            if not batch:
+                break
+            rows = []
+            for _id, content, meta_json, emb_json in batch:
+                try:
+                    emb = json.loads(emb_json) if isinstance(emb_json, str) else emb_json
+                    rows.append((_id, content, meta_json, _pack(emb)))
+                except Exception:
+                    continue
+            conn.executemany("INSERT OR REPLACE INTO items (id, content, metadata, embedding) VALUES (?,?,?,?)", rows)
+        conn.execute("DROP TABLE items_json")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # Give the space taken by the JSON text back to the filesystem
+    conn.execute("VACUUM")
+
+
+def _move_embeddings_to_segments(conn: sqlite3.Connection, segment_dir: str, batch_size: int = 65536):
+    """Copy the float32 blobs into segment files and drop the embedding column.
+    Segments left behind by an interrupted run are unreferenced, so they are cleared first.
+    """
+    cols = {row[1] for row in conn.execute("PRAGMA table_info(items)")}
+    if "embedding" not in cols:
+        return
+    SegmentMatrix(segment_dir).clear()
+    try:
+        conn.execute("BEGIN")
+        for col in ("seg", "row"):
+            if col not in cols:
+                conn.execute(f"ALTER TABLE items ADD COLUMN {col} INTEGER")
+        seq, last = 0, -1
+        while True:
+            batch = conn.execute(
+                "SELECT rowid, id, embedding FROM items WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, batch_size)
+            ).fetchall()
+            if not batch:
+                break
+            last = batch[-1][0]
+            by_dim: Dict[int, List[Tuple[int, str, bytes]]] = {}
+            for rowid, _id, blob in batch:
+                if blob and len(blob) >= 4:
+                    by_dim.setdefault(len(blob) // 4, []).append((rowid, _id, blob[: len(blob) // 4 * 4]))
+            for dim, group in by_dim.items():
+                seq = claim_seq(segment_dir, seq + 1)
+                vecs = np.frombuffer(b"".join(g[2] for g in group), dtype="<f4").reshape(len(group), dim)
+                write_segment(segment_dir, seq, [g[1] for g in group], normalize_rows(vecs))
+                conn.executemany("UPDATE items SET seg = ?, row = ? WHERE rowid = ?", [(seq, r, g[0]) for r, g in enumerate(group)])
+        # Rebuild instead of DROP COLUMN, which older SQLite builds lack
+        for col in _META_COLUMNS:
+            conn.execute(f"DROP INDEX IF EXISTS idx_items_{col}")
+        conn.execute("ALTER TABLE items RENAME TO items_v3")
+        _create_items(conn)
+        keep = ", ".join(("id", "content", "metadata", *_META_COLUMNS, "seg", "row"))
+        conn.execute(f"INSERT INTO items ({keep}) SELECT {keep} FROM items_v3")
+        conn.execute("DROP TABLE items_v3")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.execute("VACUUM")
+
+
+def _backfill_meta_columns(conn: sqlite3.Connection):
+    """Add the v2 columns to an existing table and fill them from the metadata JSON."""
+    cols = {row[1] for row in conn.execute("PRAGMA table_info(items)")}
+    if not cols:
+        return
+    try:
+        conn.execute("BEGIN")
+        for col in _META_COLUMNS:
+            if col not in cols:
+                conn.execute(f"ALTER TABLE items ADD COLUMN {col} TEXT")
+        assignments = ", ".join(f"{col} = CAST(json_extract(metadata, '$.{col}') AS TEXT)" for col in _META_COLUMNS)
+        conn.execute(f"UPDATE items SET {assignments} WHERE json_valid(metadata)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _meta_column_values(meta: Dict[str, Any]) -> Tuple[Optional[str], ...]:
+    return tuple(
+        None if meta.get(k) is None else _iso_utc(meta[k]) if k == "created_at" else str(meta[k])
+        for k in _META_COLUMNS
+    )
 
 
-def _norm(v: List[float]) -> float:
-    return math.sqrt(sum(x * x for x in v)) or 1.0
+def _iso_utc(value: Any, end: bool = False) -> str:
+    """An ISO date or datetime as "YYYY-MM-DDTHH:MM:SS.ffffff" in UTC, the one form stored
+    created_at values and date filter bounds are compared in. Naive datetimes are taken as
+    UTC; a bare date stands for the start of that day, or its last microsecond with `end`.
+    Values that do not parse are kept as given.
+    """
+    text = str(value).strip()
+    try:
+        if len(text) == 10:
+            day = datetime.date.fromisoformat(text)
+            dt = datetime.datetime.combine(day, datetime.time.max if end else datetime.time.min)
+        else:
+            # fromisoformat() before Python 3.11 rejects a "Z" suffix
+            dt = datetime.datetime.fromisoformat(text[:-1] + "+00:00" if text.endswith(("Z", "z")) else text)
+    except ValueError:
+        return text
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt.isoformat(timespec="microseconds")
 
 
-def _cosine(a: List[float], b: List[float]) -> float:
-    # assume same length
-    dot = sum(x * y for x, y in zip(a, b))
-    na = _norm(a)
-    nb = _norm(b)
-    return dot / (na * nb)
+def _normalize_created_at(conn: sqlite3.Connection):
+    """Rewrite stored created_at values (copied verbatim from metadata before v6) with _iso_utc."""
+    changed = []
+    for rowid, value in conn.execute("SELECT rowid, created_at FROM items WHERE created_at IS NOT NULL").fetchall():
+        normalized = _iso_utc(value)
+        if normalized != value:
+            changed.append((normalized, rowid))
+    if changed:
+        conn.executemany("UPDATE items SET created_at = ? WHERE rowid = ?", changed)
+        conn.commit()
+
+
+def _filter_clause(filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """SQL WHERE clause over the indexed columns for a retrieval filter dict.
+    Supported keys: organization, uploader, document_ids, source_type, date_from, date_to.
+    """
+    where, args = [], []
+    for col in ("organization", "uploader", "source_type"):
+        if filters.get(col) is not None:
+            where.append(f"{col} = ?")
+            args.append(str(filters[col]))
+    doc_ids = filters.get("document_ids")
+    if doc_ids is not None:
+        doc_ids = [str(d) for d in doc_ids]
+        where.append(f"document_id IN ({','.join('?' * len(doc_ids))})" if doc_ids else "0")
+        args.extend(doc_ids)
+    if filters.get("date_from"):
+        where.append("created_at >= ?")
+        args.append(_iso_utc(filters["date_from"]))
+    if filters.get("date_to"):
+        where.append("created_at <= ?")
+        args.append(_iso_utc(filters["date_to"], end=True))
+    return " AND ".join(where), args
+
+
+def fts_query(text: str) -> str:
+    """FTS5 MATCH expression: any of the words of `text`, each quoted as a phrase so codes
+    like INV-2023-001 or user@example.com match as written instead of as query syntax.
+    """
+    terms = dict.fromkeys(t.strip(".-/").lower() for t in _FTS_TERM.findall(text or ""))
+    return " OR ".join('"' + t.replace('"', '""') + '"' for t in terms if t)
+
+
+def rrf_fuse(rankings: Iterable[List[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Reciprocal rank fusion: each id scores sum(1 / (k + rank)) over the rankings it appears in."""
+    fused: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, _id in enumerate(ranking, start=1):
+            fused[_id] = fused.get(_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda kv: -kv[1])
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+def _pack(vec: Iterable[float]) -> bytes:
+    a = array("f", map(float, vec))
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tobytes()
 
 
 class VectorStore:
-    def __init__(self, path: str):
+    def __init__(self, path: str, index: Optional[str] = None, mode: Optional[str] = None):
         self.path = path
         os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.segment_dir = f"{path}.segments"
         self.conn = sqlite3.connect(self.path, check_same_thread=False)
-        _ensure_db(self.conn)
+        self.fts = _ensure_db(self.conn, self.segment_dir)
+        # Vectors are memory-mapped either way; the mode only bounds scratch memory per query.
+        # "matrix": score a whole segment at once
+        # "stream": score at most stream_batch_size rows at a time
+        self.mode = (mode or os.getenv("VECTOR_QUERY_MODE") or "matrix").strip().lower()
+        self.stream_batch_size = int(os.getenv("VECTOR_STREAM_BATCH", 2048))
+        self._lock = threading.RLock()
+        self._matrix = SegmentMatrix(self.segment_dir)
+        # Bumped by SQLite when another connection commits; tells us to re-scan the segments
+        self._data_version = self._read_data_version()
+        # Optional approximate index; below ann_min_size queries always use the exact scan
+        kind = (index or os.getenv("VECTOR_INDEX") or "exact").strip().lower()
+        self._ann: Optional[IVFIndex] = None
+        if kind == "ivf":
+            self._ann = IVFIndex(f"{path}.ivf.npz", nprobe=int(os.getenv("VECTOR_ANN_NPROBE", 8)))
+        self.ann_min_size = int(os.getenv("VECTOR_ANN_MIN_SIZE", 50000))
+        self._ann_building = False
+        self._ann_backlog: List[int] = []
+        self._compacting = False
+        # Matrix slots per filter, reset on every write
+        self._filter_slots: Dict[Tuple, np.ndarray] = {}
+        # ANN builds and compactions run one at a time on a single thread per store, started on first use
+        self._jobs: List[Any] = []
+        self._jobs_cv = threading.Condition()
+        self._job_running = False
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+
+    def _submit(self, job) -> bool:
+        """Queue `job` for the background thread; False once the store is closed."""
+        with self._jobs_cv:
+            if self._closed:
+                return False
+            self._jobs.append(job)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run_jobs, name="vector-store-worker", daemon=True)
+                self._worker.start()
+            self._jobs_cv.notify_all()
+        return True
+
+    def _run_jobs(self):
+        while True:
+            with self._jobs_cv:
+                self._jobs_cv.wait_for(lambda: self._jobs or self._closed)
+                if self._closed:
+                    self._jobs.clear()
+                    self._jobs_cv.notify_all()
+                    return
+                job = self._jobs.pop(0)
+                self._job_running = True
+            try:
+                job()
+            finally:
+                with self._jobs_cv:
+                    self._job_running = False
+                    self._jobs_cv.notify_all()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Wait until queued background work (ANN build, compaction) is done; False on timeout."""
+        with self._jobs_cv:
+            return self._jobs_cv.wait_for(lambda: not self._jobs and not self._job_running, timeout)
+
+    def close(self):
+        """Stop the background thread once its current job is done (queued jobs are dropped),
+        persist the index and close the database.
+        """
+        with self._jobs_cv:
+            self._closed = True
+            self._jobs_cv.notify_all()
+            worker = self._worker
+        if worker is not None:
+            worker.join()
+        self.flush()
+        self.conn.close()
+
+    def _read_data_version(self) -> int:
+        return int(self.conn.execute("PRAGMA data_version").fetchone()[0])
+
+    def _vectors(self) -> SegmentMatrix:
+        """The segment matrix, caught up with writes from other processes; callers must hold self._lock."""
+        m = self._matrix
+        version = self._read_data_version()
+        if version != self._data_version:
+            self._data_version = version
+            self._filter_slots.clear()
+            appended = m.refresh()
+            if self._ann is not None:
+                if appended is None:
+                    self._ann.reset()
+                elif len(appended):
+                    if self._ann_building:
+                        self._ann_backlog.extend(appended.tolist())
+                    self._ann.add(appended, m[appended])
+        return m
+
+    def _ann_stale(self, m: SegmentMatrix) -> bool:
+        if self._ann is None or len(m) < self.ann_min_size:
+            return False
+        return not self._ann.ready or len(m) > 4 * max(1, self._ann.trained_size)
+
+    def _build_ann(self):
+        """Load or (re)train the IVF index off the request path, then swap it in.
+        Rows written while the build runs are queued in _ann_backlog and assigned on install.
+        """
+        try:
+            with self._lock:
+                m = self._vectors()
+                generation = m.generation
+                size = m.size
+                layout = m.layout()
+                alive = m.alive_mask()
+                live = np.flatnonzero(alive)
+                self._ann_backlog = []
+            if not len(live):
+                return
+            ann = IVFIndex(self._ann.path, nprobe=self._ann.nprobe)
+            missing = None if self._ann.ready else ann.load(layout, m.dim)
+            if missing is None:
+                nlist = default_nlist(len(live))
+                rng = np.random.default_rng(0)
+                sample = m[np.sort(rng.choice(live, training_sample_size(len(live), nlist), replace=False))]
+                centroids = train_centroids(sample, nlist)
+                assign = np.full(size, -1, dtype=np.int32)
+                assign[live] = assign_lists(m, centroids, rows=live)
+                ann.install(centroids, assign, len(live))
+            else:
+                missing = missing[missing < size]
+                missing = missing[alive[missing]]
+                if len(missing):
+                    ann.add(missing, m[missing])
+            with self._lock:
+                if m.generation != generation:
+                    return
+                backlog = np.unique(np.asarray(self._ann_backlog + list(range(size, m.size)), dtype=np.int64))
+                if len(backlog):
+                    ann.add(backlog, m[backlog])
+                dead = np.flatnonzero(~m.alive_mask())
+                ann.discard(dead.tolist())
+                self._ann = ann
+                if ann.dirty:
+                    ann.save(m.layout())
+        except Exception:
+            logging.getLogger("ai_engine").exception("vector_store ann build failed path=%s", self.path)
+        finally:
+            self._ann_building = False
+
+    def _maybe_build_ann(self, m: SegmentMatrix):
+        if self._ann_building or not self._ann_stale(m):
+            return
+        self._ann_building = self._submit(self._build_ann)
+
+    def flush(self):
+        """Persist index state that is only kept in memory."""
+        with self._lock:
+            if self._ann is not None and self._ann.dirty:
+                self._ann.save(self._matrix.layout())
+
+    def _locations(self, ids: List[str]) -> Tuple[List[int], List[int]]:
+        """Segment and row currently recorded for each id that has a vector."""
+        seqs, rows = [], []
+        for i in range(0, len(ids), 500):
+            part = ids[i : i + 500]
+            sql = f"SELECT seg, row FROM items WHERE id IN ({','.join('?' * len(part))}) AND seg IS NOT NULL"
+            for seq, row in self.conn.execute(sql, part):
+                seqs.append(seq)
+                rows.append(row)
+        return seqs, rows
 
     def add_many(self, items: Iterable[Dict[str, Any]]):
-        rows = []
+        rows, vectors = [], []
         for it in items:
-            rows.append(
-                (
-                    it["id"],
-                    it.get("content") or "",
-                    json.dumps(it.get("metadata") or {}),
-                    json.dumps(list(map(float, it.get("embedding") or []))),
+            meta = it.get("metadata") or {}
+            rows.append([it["id"], it.get("content") or "", json.dumps(meta), *_meta_column_values(meta), None, None])
+            vectors.append(np.asarray(it.get("embedding") or [], dtype=np.float32).ravel())
+        if not rows:
+            return
+        by_dim: Dict[int, List[int]] = {}
+        for i, vec in enumerate(vectors):
+            if vec.size:
+                by_dim.setdefault(vec.shape[0], []).append(i)
+        with self._lock, self._matrix.write_lock():
+            m = self._vectors()
+            # Vectors are written (and fsynced) before SQLite points at them
+            written = []
+            for dim, idx in by_dim.items():
+                seq, slots = m.append([rows[i][0] for i in idx], np.stack([vectors[i] for i in idx]))
+                for r, i in enumerate(idx):
+                    rows[i][-2:] = [seq, r]
+                if dim == m.dim:
+                    written.append(slots)
+            with self.conn:
+                old_seqs, old_rows = self._locations([r[0] for r in rows])
+                # An upsert (not INSERT OR REPLACE) so the FTS triggers see replaced content
+                cols = ("content", "metadata", *_META_COLUMNS, "seg", "row")
+                self.conn.executemany(
+                    f"INSERT INTO items (id, {', '.join(cols)}) VALUES (?{',?' * len(cols)}) "
+                    f"ON CONFLICT (id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in cols)}",
+                    rows,
                 )
-            )
-        with self.conn:
-            self.conn.executemany("INSERT OR REPLACE INTO items (id, content, metadata, embedding) VALUES (?,?,?,?)", rows)
+            freed = self._tombstone(m, old_seqs, old_rows)
+            self._filter_slots.clear()
+            if self._ann is not None:
+                self._ann.discard(freed.tolist())
+                for slots in written:
+                    if self._ann_building:
+                        self._ann_backlog.extend(slots.tolist())
+                    self._ann.add(slots, m[slots])
+            self._maybe_compact(m)
 
-    def query(self, embedding: List[float], top_k: int = 5) -> List[Dict[str, Any]]:
-        # naive: load all vectors and score in python
-        cur = self.conn.cursor()
-        cur.execute("SELECT id, content, metadata, embedding FROM items")
-        scored = []
-        for _id, content, meta_json, emb_json in cur.fetchall():
+    def _slots_for(self, m: SegmentMatrix, filters: Dict[str, Any]) -> np.ndarray:
+        """Matrix slots of the rows matching a filter, resolved through the column indexes."""
+        key = tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple)) else v) for k, v in filters.items()))
+        slots = self._filter_slots.get(key)
+        if slots is None:
+            clause, args = _filter_clause(filters)
+            sql = "SELECT seg, row FROM items WHERE seg IS NOT NULL" + (f" AND {clause}" if clause else "")
+            found = np.asarray(self.conn.execute(sql, args).fetchall(), dtype=np.int64).reshape(-1, 2)
+            slots = np.sort(m.slots_of(found[:, 0], found[:, 1]))
+            if len(self._filter_slots) >= 256:
+                self._filter_slots.pop(next(iter(self._filter_slots)))
+            self._filter_slots[key] = slots
+        return slots
+
+    def query(
+        self,
+        embedding: List[float],
+        top_k: int = 5,
+        nprobe: Optional[int] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        text: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Top-k items by cosine similarity.
+        With an IVF index, stores of at least ann_min_size rows only score the rows in the
+        `nprobe` nearest partitions; a higher nprobe trades latency for recall.
+        `filters` (see _filter_clause) restrict the rows before anything is scored, so a
+        filtered query costs time proportional to the matching subset.
+        Given the query `text`, the vector ranking is fused with a BM25 ranking of the same
+        rows (hybrid mode, see hybrid_query).
+        """
+        filters = {k: v for k, v in (filters or {}).items() if v is not None}
+        if text and self.fts:
+            return self.hybrid_query(embedding, text, top_k=top_k, nprobe=nprobe, filters=filters)
+        return self._vector_query(embedding, top_k, nprobe, filters)
+
+    def _vector_query(self, embedding: List[float], top_k: int, nprobe: Optional[int], filters: Dict[str, Any]) -> List[Dict[str, Any]]:
+        q = np.asarray(embedding, dtype=np.float32).ravel()
+        for _ in range(3):
+            found = self._search(q, top_k or 5, nprobe, filters)
+            if found is None:
+                return []
+            hits, m, generation = found
+            out, complete = self._fetch_hits(hits)
+            # A compaction between scoring and the lookup moved rows; score the new layout
+            if complete or m.generation == generation:
+                break
+        return out
+
+    def lexical_query(self, text: str, top_k: int = 5, filters: Optional[Dict[str, Any]] = None, embedding: Optional[List[float]] = None) -> List[Dict[str, Any]]:
+        """Top-k items by FTS5 BM25 over their content (match["bm25"], higher is better).
+        With `embedding`, match["score"] is the cosine similarity of each hit, as in query();
+        hits without a vector of that dimension score 0.0.
+        """
+        expr = fts_query(text)
+        if not self.fts or not expr or top_k <= 0:
+            return []
+        clause, args = _filter_clause({k: v for k, v in (filters or {}).items() if v is not None})
+        sql = (
+            "SELECT items.id, items.content, items.metadata, items.seg, items.row, -bm25(items_fts) "
+            "FROM items_fts JOIN items ON items.rowid = items_fts.rowid WHERE items_fts MATCH ?"
+            + (f" AND {clause}" if clause else "")
+            + " ORDER BY bm25(items_fts) LIMIT ?"
+        )
+        q = np.asarray(embedding if embedding is not None else [], dtype=np.float32).ravel()
+        with self._lock:
+            try:
+                rows = self.conn.execute(sql, [expr, *args, int(top_k)]).fetchall()
+            except sqlite3.OperationalError as e:
+                logging.getLogger("ai_engine").warning("vector_store fts_query_failed error=%s", e)
+                return []
+            scores = np.zeros(len(rows), dtype=np.float32)
+            m = self._vectors()
+            if q.size and q.shape[0] == m.dim:
+                same_dim = {seg.seq for seg in m.segments if seg.dim == m.dim}
+                located = [i for i, r in enumerate(rows) if r[3] in same_dim]
+                if located:
+                    # Read under the lock, before compaction can move these rows
+                    slots = m.slots_of([rows[i][3] for i in located], [rows[i][4] for i in located])
+                    scores[located] = m[slots] @ normalize_rows(q.reshape(1, -1))[0]
+        out = []
+        for (_id, content, meta_json, _seg, _row, bm25), score in zip(rows, scores):
             try:
-                emb = json.loads(emb_json)
+                meta = json.loads(meta_json or "{}")
             except Exception:
+                meta = {}
+            out.append({"id": _id, "content": content, "metadata": meta, "score": float(score), "bm25": float(bm25)})
+        return out
+
+    def hybrid_query(
+        self,
+        embedding: List[float],
+        text: str,
+        top_k: int = 5,
+        nprobe: Optional[int] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        depth: Optional[int] = None,
+        rrf_k: int = RRF_K,
+    ) -> List[Dict[str, Any]]:
+        """Vector and BM25 rankings (each `depth` deep) fused by reciprocal rank.
+        Exact terms such as invoice numbers or SKUs are found by the lexical side even when
+        their embedding is not close. match["score"] stays the cosine similarity;
+        match["rrf_score"] holds the fused score the results are ordered by.
+        """
+        filters = {k: v for k, v in (filters or {}).items() if v is not None}
+        top_k = top_k or 5
+        depth = max(top_k, depth or 2 * top_k, 20)
+        vector = self._vector_query(embedding, depth, nprobe, filters)
+        lexical = self.lexical_query(text, depth, filters, embedding=embedding)
+        by_id = {m["id"]: m for m in lexical}
+        for m in vector:
+            bm25 = by_id.get(m["id"], {}).get("bm25")
+            by_id[m["id"]] = m if bm25 is None else {**m, "bm25": bm25}
+        out = []
+        for _id, fused in rrf_fuse([[m["id"] for m in vector], [m["id"] for m in lexical]], k=rrf_k)[:top_k]:
+            match = dict(by_id[_id])
+            match["rrf_score"] = fused
+            out.append(match)
+        return out
+
+    def _search(self, q: np.ndarray, top_k: int, nprobe: Optional[int], filters: Dict[str, Any]):
+        with self._lock:
+            m = self._vectors()
+            generation = m.generation
+            if not q.size or q.shape[0] != m.dim:
+                return None
+            q = normalize_rows(q.reshape(1, -1))[0]
+            allowed = self._slots_for(m, filters) if filters else None
+            candidates = allowed
+            scan_size = len(m) if allowed is None else len(allowed)
+            if self._ann is not None and scan_size >= self.ann_min_size:
+                if self._ann.ready:
+                    candidates = self._ann.candidates(q, nprobe)
+                    if allowed is not None:
+                        candidates = candidates[np.isin(candidates, allowed, assume_unique=True)]
+                self._maybe_build_ann(m)
+            # Candidate slots are only valid for the current layout: score them on a view
+            # pinned to it. A full scan reads an immutable snapshot of the segment list anyway.
+            view = m.snapshot()
+        batch = self.stream_batch_size if self.mode == "stream" else None
+        return view.search(q, top_k, candidates, batch=batch), m, generation
+
+    def _fetch_hits(self, hits: List[Tuple[str, float, int, int]]) -> Tuple[List[Dict[str, Any]], bool]:
+        """Read content and metadata for the winning ids only.
+        A hit whose (segment, row) SQLite no longer points at is either a leftover of an
+        interrupted write (tombstoned here) or a row moved by compaction. Returns
+        (matches, complete) where complete is False if any hit was skipped.
+        """
+        if not hits:
+            return [], True
+        rows = {}
+        ids = [h[0] for h in hits]
+        marks = ",".join("?" * len(ids))
+        sql = f"SELECT id, content, metadata, seg, row FROM items WHERE id IN ({marks})"
+        with self._lock:
+            for _id, content, meta_json, seq, row in self.conn.execute(sql, ids):
+                rows[_id] = (content, meta_json, seq, row)
+        out, stale = [], []
+        for _id, score, seq, row in hits:
+            found = rows.get(_id)
+            if found is None or (found[2], found[3]) != (seq, row):
+                stale.append((_id, seq, row))
                 continue
-            score = _cosine(embedding, emb)
+            content, meta_json = found[0], found[1]
             m = {}
             try:
                 m = json.loads(meta_json or "{}")
             except Exception:
                 m = {}
-            scored.append({"id": _id, "content": content, "metadata": m, "score": float(score)})
-        scored.sort(key=lambda x: x["score"], reverse=True)
-        return scored[: top_k or 5]
+            out.append({"id": _id, "content": content, "metadata": m, "score": score})
+        if stale:
+            self._drop_stale(stale)
+        return out, not stale
+
+    def _drop_stale(self, hits: List[Tuple[str, int, int]]):
+        with self._lock, self._matrix.write_lock():
+            # Re-check under the locks: a concurrent add_many may have just committed these rows,
+            # and another process may have compacted them into a segment we have not mapped yet
+            m = self._vectors()
+            dead = []
+            for _id, seq, row in hits:
+                if self.conn.execute("SELECT seg, row FROM items WHERE id = ?", (_id,)).fetchone() != (seq, row):
+                    dead.append((seq, row))
+            if not dead:
+                return
+            freed = self._tombstone(m, [p[0] for p in dead], [p[1] for p in dead])
+            if self._ann is not None:
+                self._ann.discard(freed.tolist())
+            self._filter_slots.clear()
+
+    def vectors(self, ids: Iterable[str]) -> Dict[str, np.ndarray]:
+        """id -> unit vector for the given ids; ids without a vector of the store's dimension are left out."""
+        ids = list(dict.fromkeys(ids))
+        out: Dict[str, np.ndarray] = {}
+        with self._lock:
+            m = self._vectors()
+            same_dim = {seg.seq for seg in m.segments if seg.dim == m.dim}
+            for i in range(0, len(ids), 500):
+                part = ids[i : i + 500]
+                sql = f"SELECT id, seg, row FROM items WHERE id IN ({','.join('?' * len(part))}) AND seg IS NOT NULL"
+                found = [r for r in self.conn.execute(sql, part) if r[1] in same_dim]
+                if found:
+                    rows = m[m.slots_of([r[1] for r in found], [r[2] for r in found])]
+                    out.update({r[0]: rows[j] for j, r in enumerate(found)})
+        return out
 
     def delete_by_document_id(self, document_id: str) -> int:
         """Delete all items whose metadata.document_id matches.
         Returns number of rows deleted.
         """
-        cur = self.conn.cursor()
-        cur.execute("SELECT id, metadata FROM items")
-        ids = []
-        for _id, meta_json in cur.fetchall():
-            try:
-                m = json.loads(meta_json or "{}")
-            except Exception:
-                m = {}
-            if str(m.get('document_id')) == str(document_id):
-                ids.append(_id)
-        if not ids:
+        return self._delete_where("document_id = ?", [str(document_id)])
+
+    def delete_by_document_ids(self, document_ids: Iterable[str]) -> int:
+        """Delete all items of many documents, 500 ids per statement. Returns number of rows deleted."""
+        ids = list(dict.fromkeys(str(d) for d in document_ids))
+        n = 0
+        for i in range(0, len(ids), 500):
+            part = ids[i : i + 500]
+            n += self._delete_where(f"document_id IN ({','.join('?' * len(part))})", part)
+        return n
+
+    def delete_ids(self, ids: Iterable[str]) -> int:
+        """Delete items by id. Returns number of rows deleted."""
+        ids = list(ids)
+        n = 0
+        for i in range(0, len(ids), 500):
+            part = ids[i : i + 500]
+            n += self._delete_where(f"id IN ({','.join('?' * len(part))})", part)
+        return n
+
+    def _tombstone(self, m: SegmentMatrix, seqs: List[int], rows: List[int]) -> np.ndarray:
+        """Mark rows dead after SQLite stopped pointing at them; call with the write lock held.
+        Never raises: the rows are already gone from SQLite, and a vector whose sidecar write
+        failed is dropped by _fetch_hits the next time it surfaces in a query.
+        """
+        try:
+            return m.tombstone(seqs, rows)
+        except OSError:
+            logging.getLogger("ai_engine").exception("vector_store tombstone write failed path=%s", self.path)
+            return np.zeros(0, dtype=np.int64)
+
+    def _delete_where(self, clause: str, args: List[Any]) -> int:
+        # The write lock keeps other processes from compacting the rows away between the
+        # DELETE and the tombstone write
+        with self._lock, self._matrix.write_lock():
+            m = self._vectors()
+            with self.conn:
+                found = self.conn.execute(f"SELECT seg, row FROM items WHERE {clause}", args).fetchall()
+                if not found:
+                    return 0
+                self.conn.execute(f"DELETE FROM items WHERE {clause}", args)
+            located = [(s, r) for s, r in found if s is not None]
+            freed = self._tombstone(m, [p[0] for p in located], [p[1] for p in located])
+            self._filter_slots.clear()
+            if self._ann is not None:
+                self._ann.discard(freed.tolist())
+            self._maybe_compact(m)
+        return len(found)
+
+    def document_chunks(self, document_id: str) -> Dict[str, Tuple[str, str]]:
+        """id -> (content_hash, metadata JSON) of every item stored for a document."""
+        with self._lock:
+            rows = self.conn.execute("SELECT id, content, metadata FROM items WHERE document_id = ?", (str(document_id),)).fetchall()
+        return {_id: (content_hash(content), meta_json) for _id, content, meta_json in rows}
+
+    def update_metadata(self, items: Iterable[Dict[str, Any]]) -> int:
+        """Rewrite the metadata of existing items, keeping their vectors. Returns rows updated."""
+        assignments = ", ".join(f"{col} = ?" for col in ("metadata", *_META_COLUMNS))
+        rows = []
+        for it in items:
+            meta = it.get("metadata") or {}
+            rows.append((json.dumps(meta), *_meta_column_values(meta), it["id"]))
+        if not rows:
             return 0
-        with self.conn:
-            cur.executemany("DELETE FROM items WHERE id = ?", [(i,) for i in ids])
-        return len(ids)
+        with self._lock:
+            with self.conn:
+                n = self.conn.executemany(f"UPDATE items SET {assignments} WHERE id = ?", rows).rowcount
+            self._filter_slots.clear()
+        return n
 
     def clear_all(self) -> int:
         """Delete all items in the vector store. Returns number of rows removed."""
@@ -97,20 +788,88 @@ class VectorStore:
             n = int(cur.fetchone()[0] or 0)
         except Exception:
             n = 0
-        with self.conn:
-            self.conn.execute("DELETE FROM items")
+        with self._lock, self._matrix.write_lock():
+            with self.conn:
+                self.conn.execute("DELETE FROM items")
+            self._matrix.clear()
+            self._filter_slots.clear()
+            if self._ann is not None:
+                self._ann.reset()
+                try:
+                    os.remove(self._ann.path)
+                except FileNotFoundError:
+                    pass
         return n
 
+    def _maybe_compact(self, m: SegmentMatrix):
+        if self._compacting or not m.compaction_candidates():
+            return
+        self._compacting = self._submit(self.compact)
 
-def chunk_text(text: str, target_chars: int = 1200, overlap: int = 120) -> Iterable[str]:
-    text = text or ""
-    n = max(200, target_chars)
-    o = max(0, min(overlap, n // 3))
-    i = 0
-    L = len(text)
-    while i < L:
-        j = min(L, i + n)
-        yield text[i:j]
-        if j >= L:
-            break
-        i = j - o
+    def compact(self):
+        """Merge small and mostly-deleted segments into one new segment.
+        The copy runs without the store lock; rows deleted or replaced meanwhile are
+        dropped when SQLite is repointed. A file lock keeps other processes from
+        compacting the same segments at once, and the swap runs under the write lock.
+        """
+        try:
+            with file_lock(os.path.join(self.segment_dir, ".compact.lock"), blocking=False) as acquired:
+                if acquired:
+                    self._compact()
+        except Exception:
+            logging.getLogger("ai_engine").exception("vector_store compaction failed path=%s", self.path)
+        finally:
+            self._compacting = False
+
+    def _compact(self):
+        with self._lock:
+            m = self._vectors()
+            picked = set(m.compaction_candidates())
+            plan = [(seg, np.flatnonzero(seg.alive)) for seg in m.segments if seg.seq in picked and seg.dim == m.dim]
+            if not plan:
+                return
+            generation = m.generation
+            top = max(s.seq for s in m.segments)
+        # Claim a number above every current segment so existing slots keep their order
+        seq = claim_seq(self.segment_dir, top + 1)
+        ids = [seg.id_at(int(r)) for seg, rows in plan for r in rows]
+        sources = [(seg.seq, int(r)) for seg, rows in plan for r in rows]
+        if ids:
+            write_segment(self.segment_dir, seq, ids, np.concatenate([seg.vecs[rows] for seg, rows in plan]), publish=False)
+        with self._lock, self._matrix.write_lock():
+            m = self._vectors()
+            if m.generation != generation:
+                self._discard_claim(seq)
+                return
+            new_seg = None
+            moved_from = np.zeros(0, dtype=np.int64)
+            if ids:
+                publish_segment(self.segment_dir, seq)
+                new_seg = Segment(segment_path(self.segment_dir, seq), seq)
+                with self.conn:
+                    for row, (_id, (src_seq, src_row)) in enumerate(zip(ids, sources)):
+                        cur = self.conn.execute(
+                            "UPDATE items SET seg = ?, row = ? WHERE id = ? AND seg = ? AND row = ?",
+                            (seq, row, _id, src_seq, src_row),
+                        )
+                        if cur.rowcount != 1:
+                            new_seg.alive[row] = False
+                if new_seg.live != int(new_seg.alive.sum()):
+                    new_seg.save_tombstones()
+                moved_from = m.slots_of([s for s, _ in sources], [r for _, r in sources])
+            else:
+                self._discard_claim(seq)
+            remap = m.replace([seg.seq for seg, _ in plan], new_seg, moved_from)
+            m.remove_orphans()
+            self._filter_slots.clear()
+            if self._ann is not None:
+                self._ann.remap(remap)
+                if new_seg is not None:
+                    self._ann.discard(np.flatnonzero(~m.alive_mask()).tolist())
+
+    def _discard_claim(self, seq: int):
+        for p in (segment_path(self.segment_dir, seq), segment_path(self.segment_dir, seq) + ".tmp"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
@@ -81,6 +81,10 @@ MEDIA_URL = '/media/'
 # Our code is mounted at /app (BASE_DIR), so put media alongside it.
 # This avoids writing to container root (/media) which breaks across services.
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Uploads above this size are spooled to a temp file instead of held in memory;
+# FileSystemStorage then moves that file into MEDIA_ROOT without reading it.
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.environ.get('FILE_UPLOAD_MAX_MEMORY_SIZE', 2621440))
+FILE_UPLOAD_TEMP_DIR = os.environ.get('FILE_UPLOAD_TEMP_DIR') or None
 
 # ----- Logging -----
 # Log file directory configurable via LOG_DIR; defaults to /app/logs
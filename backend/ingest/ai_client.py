@@ -0,0 +1,190 @@
+"""Shared HTTP client for calls from the backend to the AI engine.
+
+One pooled keep-alive session per process (re-created after a fork, so Celery
+prefork children do not share sockets), a (connect, read) timeout per
+operation, retries with exponential backoff for idempotent calls, and a
+circuit breaker: after AI_BREAKER_FAILURES consecutive failures calls fail fast
+with AIEngineUnavailable for AI_BREAKER_RESET seconds, then one trial call is
+let through. AI_MAX_INFLIGHT bounds the calls a process has open at once, so
+a slow engine makes callers give up instead of queueing threads behind it.
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+AI_URL = os.environ.get('AI_ENGINE_URL') or os.environ.get('AI_URL') or 'http://ai:9000'
+AI_CONNECT_TIMEOUT = float(os.environ.get('AI_CONNECT_TIMEOUT', 3))
+# Read timeouts per operation; for streamed indexing this bounds silence between progress lines
+TIMEOUTS = {
+    'index': float(os.environ.get('AI_INDEX_TIMEOUT', 300)),
+    'unindex': float(os.environ.get('AI_UNINDEX_TIMEOUT', 10)),
+    'clear': float(os.environ.get('AI_CLEAR_TIMEOUT', 15)),
+}
+AI_RETRIES = int(os.environ.get('AI_RETRIES', 2))
+AI_RETRY_BACKOFF = float(os.environ.get('AI_RETRY_BACKOFF', 0.5))
+AI_POOL_SIZE = int(os.environ.get('AI_POOL_SIZE', 10))
+AI_MAX_INFLIGHT = int(os.environ.get('AI_MAX_INFLIGHT', 32))
+AI_INFLIGHT_WAIT = float(os.environ.get('AI_INFLIGHT_WAIT', 5))
+AI_BREAKER_FAILURES = int(os.environ.get('AI_BREAKER_FAILURES', 5))
+AI_BREAKER_RESET = float(os.environ.get('AI_BREAKER_RESET', 30))
+
+RETRY_STATUSES = {502, 503, 504}
+
+
+class AIEngineUnavailable(requests.RequestException):
+    """The call was not attempted: the circuit is open or too many calls are in flight."""
+
+
+class CircuitBreaker:
+    def __init__(self, failures=AI_BREAKER_FAILURES, reset_after=AI_BREAKER_RESET):
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self.opened_at >= self.reset_after else 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial:
+                # Exactly one caller probes the engine; the others keep failing fast
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.max_failures:
+                if self.opened_at is None or self._trial:
+                    logger.warning("ai_client circuit open failures=%s", self.failures)
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class AIEngineClient:
+    def __init__(self, base_url=AI_URL, breaker=None, pool_size=AI_POOL_SIZE, max_inflight=AI_MAX_INFLIGHT):
+        self.base_url = base_url.rstrip('/')
+        self.breaker = breaker or CircuitBreaker()
+        self.pool_size = pool_size
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    s = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    s.mount('http://', adapter)
+                    s.mount('https://', adapter)
+                    self._session = s
+                    self._pid = os.getpid()
+        return self._session
+
+    def post(self, path, op, idempotent=False, **kwargs):
+        """POST to the engine with the timeout of `op`; idempotent calls are retried on
+        connection errors, timeouts and 502/503/504. Raises AIEngineUnavailable when the
+        circuit is open and requests exceptions when every attempt failed. Any exception
+        and any 5xx count as a failure for the circuit breaker. A streamed response
+        (stream=True) keeps its in-flight slot until it is closed.
+        """
+        kwargs.setdefault('timeout', (AI_CONNECT_TIMEOUT, TIMEOUTS[op]))
+        attempts = 1 + (AI_RETRIES if idempotent else 0)
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(AI_RETRY_BACKOFF * (2 ** (attempt - 1)))
+            # The slot comes first: allow() may hand out the half-open trial, which only a
+            # call that is then attempted can settle
+            if not self._inflight.acquire(timeout=AI_INFLIGHT_WAIT):
+                raise AIEngineUnavailable(f'too many AI engine calls in flight ({op})')
+            if not self.breaker.allow():
+                self._inflight.release()
+                raise AIEngineUnavailable(f'AI engine circuit open ({op})')
+            release = True
+            try:
+                r = self.session.post(f'{self.base_url}{path}', **kwargs)
+                if r.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if r.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+                    r.close()
+                    logger.warning("ai_client %s status=%s attempt=%s", op, r.status_code, attempt + 1)
+                    continue
+                if kwargs.get('stream'):
+                    self._release_on_close(r)
+                    release = False
+                return r
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.record_failure()
+                logger.warning("ai_client %s failed attempt=%s error=%s", op, attempt + 1, e)
+                if attempt + 1 >= attempts:
+                    raise
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            finally:
+                if release:
+                    self._inflight.release()
+
+    def _release_on_close(self, r):
+        """Hold the in-flight slot of a streamed response until r.close() (or leaving `with r:`)."""
+        close = r.close
+        released = threading.Lock()
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if released.acquire(blocking=False):
+                    self._inflight.release()
+
+        r.close = close_and_release
+
+    def index_document_stream(self, records):
+        """Stream NDJSON `records` (an iterable of bytes) to /index_document/stream; the
+        response is streamed too (use it as a context manager). Not retried: the body is
+        consumed as it is sent.
+        """
+        return self.post(
+            '/index_document/stream', 'index',
+            data=records, headers={ 'Content-Type': 'application/x-ndjson' }, stream=True,
+        )
+
+    def unindex_document(self, document_id):
+        return self.post('/unindex_document', 'unindex', idempotent=True, json={ 'document_id': str(document_id) })
+
+    def unindex_documents(self, document_ids):
+        return self.post('/unindex_documents', 'unindex', idempotent=True, json={ 'document_ids': [str(d) for d in document_ids] })
+
+    def clear_all(self):
+        return self.post('/admin/clear_all', 'clear', idempotent=True)
+
+
+# Shared by every caller in the process
+ai_engine = AIEngineClient()
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:15
+
+from django.db import migrations, models
+
+
+BATCH = 1000
+
+
+def backfill(apps, schema_editor):
+    """source_url from steps_json; job-file links from payload file_ids/file_id/url."""
+    IngestFile = apps.get_model('ingest', 'IngestFile')
+    IngestJob = apps.get_model('ingest', 'IngestJob')
+    Link = IngestJob.files.through
+
+    urls = {}
+    pending = []
+    for file_id, owner_id, steps in IngestFile.objects.values_list('id', 'uploaded_by_id', 'steps_json').iterator(chunk_size=BATCH):
+        url = (steps or {}).get('source_url') if isinstance(steps, dict) else None
+        if not url:
+            continue
+        urls.setdefault((owner_id, url), []).append(file_id)
+        pending.append(IngestFile(id=file_id, source_url=url[:2048]))
+        if len(pending) >= BATCH:
+            IngestFile.objects.bulk_update(pending, ['source_url'])
+            pending = []
+    if pending:
+        IngestFile.objects.bulk_update(pending, ['source_url'])
+
+    owned = {}
+    for file_id, owner_id in IngestFile.objects.values_list('id', 'uploaded_by_id').iterator(chunk_size=BATCH):
+        owned[file_id] = owner_id
+    links = []
+    for job_id, owner_id, payload in IngestJob.objects.values_list('id', 'created_by_id', 'payload').iterator(chunk_size=BATCH):
+        p = payload if isinstance(payload, dict) else {}
+        refs = list(p.get('file_ids') or []) if isinstance(p.get('file_ids'), list) else []
+        if p.get('file_id'):
+            refs.append(p.get('file_id'))
+        ids = set()
+        for ref in refs:
+            try:
+                ref = int(ref)
+            except (TypeError, ValueError):
+                continue
+            if ref in owned and owned[ref] == owner_id:
+                ids.add(ref)
+        for key in ('url', 'start_url'):
+            ids.update(urls.get((owner_id, p.get(key)), ()))
+        links.extend(Link(ingestjob_id=job_id, ingestfile_id=f) for f in ids)
+        if len(links) >= BATCH:
+            Link.objects.bulk_create(links, ignore_conflicts=True)
+            links = []
+    if links:
+        Link.objects.bulk_create(links, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ingest', '0004_alter_ingestfile_options_alter_ingestjob_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestfile',
+            name='source_url',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=2048),
+        ),
+        migrations.AddField(
+            model_name='ingestjob',
+            name='files',
+            field=models.ManyToManyField(blank=True, related_name='jobs', to='ingest.ingestfile'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
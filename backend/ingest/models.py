@@ -33,10 +33,33 @@ class IngestJob(models.Model):
     state = models.CharField(max_length=24, default='QUEUED', db_index=True)
     error_text = models.TextField(blank=True, null=True)
     totals_json = models.JSONField(default=dict, blank=True)
+    # Files this job imported or re-processed (indexed link table, both directions)
+    files = models.ManyToManyField('IngestFile', blank=True, related_name='jobs')
 
     class Meta:
         ordering = ('-id',)
 
+    def link_payload_files(self):
+        """Link the creator's files named by payload file_ids/file_id or, for web jobs, by url."""
+        p = self.payload if isinstance(self.payload, dict) else {}
+        refs = list(p.get('file_ids') or []) if isinstance(p.get('file_ids'), list) else []
+        if p.get('file_id'):
+            refs.append(p.get('file_id'))
+        ids = set()
+        for ref in refs:
+            try:
+                ids.add(int(ref))
+            except (TypeError, ValueError):
+                pass
+        q = models.Q(id__in=ids)
+        urls = [u for u in (p.get('url'), p.get('start_url')) if u]
+        if urls:
+            q |= models.Q(source_url__in=urls)
+        if not ids and not urls:
+            return
+        files = IngestFile.objects.filter(q, uploaded_by_id=self.created_by_id).values_list('id', flat=True)
+        self.files.add(*files)
+
 
 class IngestFile(models.Model):
     file = models.FileField(upload_to='ingest/%Y/%m/%d/', null=True, blank=True)
@@ -54,6 +77,8 @@ class IngestFile(models.Model):
     error_text = models.TextField(null=True, blank=True)
     steps_json = models.JSONField(default=dict, blank=True)
     indexed_bool = models.BooleanField(default=False)
+    # Page a web import was fetched from (mirrors steps_json.source_url, indexed for lookups)
+    source_url = models.CharField(max_length=2048, blank=True, default='', db_index=True)
 
     class Meta:
         ordering = ('-id',)
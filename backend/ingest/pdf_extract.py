@@ -0,0 +1,136 @@
+"""Per-page PDF text extraction for the ingest pipeline.
+
+The page tree is read once to count pages; the pages are then laid out by
+pdfminer in page-range tasks on a process pool (bounded by the worker's cores
+and PDF_EXTRACT_WORKERS). Page texts are yielded in page order as soon as
+their task finishes. The pool is billiard's (Celery's fork of
+multiprocessing): Celery prefork children are daemonic, and multiprocessing
+refuses to start children from a daemonic process while billiard does not.
+Small documents, or hosts where a pool cannot be started, are handled
+in-process. Whole-document extraction (extract_pdf_text) is only
+meant as a fallback when per-page extraction fails.
+"""
+import io
+import logging
+import math
+import os
+import tempfile
+
+from billiard.pool import Pool
+
+try:
+    from pdfminer.high_level import extract_text as pdf_extract_text, extract_pages
+    from pdfminer.pdfpage import PDFPage
+except ModuleNotFoundError:  # pragma: no cover - fallback during tests
+    pdf_extract_text = extract_pages = PDFPage = None
+
+logger = logging.getLogger(__name__)
+
+PDF_EXTRACT_WORKERS = int(os.environ.get('PDF_EXTRACT_WORKERS') or 0) or (os.cpu_count() or 1)
+# Below this many pages the pool start-up costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 16))
+
+
+def _layout_text(layout):
+    parts = []
+    for el in layout:
+        try:
+            if hasattr(el, 'get_text'):
+                parts.append(el.get_text())
+        except Exception:
+            pass
+    return "\n".join([t for t in parts if t and t.strip()])
+
+
+def _open(source):
+    """A binary file object for a path, bytes or an open (seekable) file."""
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    source.seek(0)
+    return source
+
+
+def count_pages(fp):
+    fp.seek(0)
+    n = sum(1 for _ in PDFPage.get_pages(fp))
+    fp.seek(0)
+    return n
+
+
+def _extract_range(path, first, last):
+    """(page number, text) for pages first..last-1 (0-based); runs in a pool process."""
+    with open(path, 'rb') as fp:
+        return [(first + i + 1, _layout_text(layout)) for i, layout in enumerate(extract_pages(fp, page_numbers=range(first, last)))]
+
+
+def _iter_serial(fp):
+    fp.seek(0)
+    for i, layout in enumerate(extract_pages(fp), start=1):
+        yield i, _layout_text(layout)
+
+
+def iter_pdf_pages(source, workers=None):
+    """Yield (page number, text) for every page of a PDF, in order.
+    `source` is a path, bytes or a seekable binary file. Raises if the PDF cannot be read.
+    """
+    if extract_pages is None:
+        return
+    workers = max(1, min(workers or PDF_EXTRACT_WORKERS, os.cpu_count() or 1))
+    fp = _open(source)
+    spooled = None
+    try:
+        pages = count_pages(fp)
+        if workers == 1 or pages < PDF_PARALLEL_MIN_PAGES:
+            yield from _iter_serial(fp)
+            return
+        path = source if isinstance(source, (str, os.PathLike)) else None
+        if path is None:
+            # Pool processes open the PDF themselves; hand them a file, not a pickled copy
+            spooled = tempfile.NamedTemporaryFile(prefix='docuiq-pdf-', suffix='.pdf', delete=False)
+            fp.seek(0)
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                spooled.write(block)
+            spooled.close()
+            path = spooled.name
+        # About two tasks per process keeps the pool busy when page costs differ
+        size = max(1, math.ceil(pages / (workers * 2)))
+        tasks = [(path, first, min(pages, first + size)) for first in range(0, pages, size)]
+        yielded = False
+        try:
+            with Pool(processes=min(workers, len(tasks))) as pool:
+                # One async result per range: billiard credits an imap's results to a single
+                # worker, and the others then wait out its exit handshake
+                results = [pool.apply_async(_extract_range, task) for task in tasks]
+                for batch in (r.get() for r in results):
+                    for page in batch:
+                        yielded = True
+                        yield page
+        except (OSError, AssertionError, RuntimeError) as e:
+            # e.g. no /dev/shm for the pool's semaphores
+            if yielded:
+                raise
+            logger.warning("pdf_extract pool unavailable, extracting in-process: %s", e)
+            yield from _iter_serial(fp)
+    finally:
+        if fp is not source:
+            fp.close()
+        if spooled is not None:
+            try:
+                os.remove(spooled.name)
+            except OSError:
+                pass
+
+
+def extract_pdf_text(source):
+    """Whole-document text; the fallback when per-page extraction fails."""
+    if pdf_extract_text is None:
+        return ''
+    fp = _open(source)
+    try:
+        fp.seek(0)
+        return pdf_extract_text(fp) or ''
+    finally:
+        if fp is not source:
+            fp.close()
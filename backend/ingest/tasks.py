@@ -12,15 +12,9 @@ from urllib.parse import urlsplit, unquote, quote
 import re
 from .models import IngestFile, IngestJob, IngestSource
 from .status import set_status
-import os, requests, os as _os, hashlib, random, io
-try:
-    from pdfminer.high_level import extract_text as pdf_extract_text, extract_pages
-except ModuleNotFoundError:  # pragma: no cover - fallback during tests
-    def pdf_extract_text(*_args, **_kwargs):
-        return ""
-
-    def extract_pages(*_args, **_kwargs):
-        return []
+from .pdf_extract import extract_pdf_text, iter_pdf_pages
+from .ai_client import ai_engine
+import os, requests, os as _os, hashlib, random, codecs, json, time
 import logging
 
 # Quiet noisy pdfminer warnings (e.g., invalid color values in malformed PDFs)
@@ -38,7 +32,6 @@ for _ln in (
         pass
 
 logger = logging.getLogger(__name__)
-AI_URL = os.environ.get('AI_ENGINE_URL') or os.environ.get('AI_URL') or 'http://ai:9000'
 CRAWL_UA = os.environ.get('CRAWL_UA', 'DocuIQBot/1.0 (+https://docuiq.local)')
 SCRAPER_URL = os.environ.get('SCRAPER_URL')  # optional external render/fetch service
 
@@ -99,6 +92,135 @@ def _fetch_url(url, *, headers=None, timeout=20):
         return last
     raise requests.HTTPError('fetch_failed')
 
+def _local_path(item):
+    """Filesystem path of the stored file, when the storage backend has one."""
+    try:
+        path = item.file.path
+    except Exception:
+        return None
+    return path if path and _os.path.exists(path) else None
+
+READ_BLOCK = 1024 * 1024
+
+def _iter_text(fp, block=READ_BLOCK):
+    """Decode a binary file as UTF-8 one block at a time (invalid bytes dropped)."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    for data in iter(lambda: fp.read(block), b''):
+        piece = decoder.decode(data)
+        if piece:
+            yield piece
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+TEXT_RECORD_CHARS = 64 * 1024
+INDEX_PROGRESS_INTERVAL = float(os.environ.get('AI_INDEX_PROGRESS_INTERVAL', 2))
+
+def _text_records(pieces, limit=TEXT_RECORD_CHARS):
+    """Cut decoded text into records of about `limit` chars, at blank lines where possible."""
+    buf = ''
+    for piece in pieces:
+        buf += piece
+        while len(buf) >= limit:
+            cut = buf.rfind('\n\n', 0, limit - 1)
+            cut = cut + 2 if cut > 0 else buf.rfind('\n', 0, limit) + 1
+            if cut <= 0:
+                cut = limit
+            yield buf[:cut]
+            buf = buf[cut:]
+    if buf:
+        yield buf
+
+def _ndjson(record):
+    return (json.dumps(record) + '\n').encode('utf-8')
+
+EXTRACT_STATS = ('mode', 'pages', 'text_len', 'error', 'records_sent')
+
+def _normalizing_step(item, stats):
+    """The item's "normalizing" step with the extraction stats merged in."""
+    step = dict((getattr(item, 'steps_json', {}) or {}).get('normalizing') or {})
+    step.update({ k: v for k, v in stats.items() if k in EXTRACT_STATS })
+    return step
+
+def _iter_index_records(payload, item, is_pdf, stats):
+    """NDJSON body for /index_document/stream, produced while the stored file is read.
+    requests sends the whole body before it reads the reply, so the records sent so far
+    are the item's progress meanwhile (saved at most every INDEX_PROGRESS_INTERVAL
+    seconds, and kept in stats['records_sent']).
+    """
+    last = time.monotonic()
+    for n, line in enumerate(_index_records(payload, item, is_pdf, stats), 1):
+        yield line
+        stats['records_sent'] = n
+        now = time.monotonic()
+        if now - last >= INDEX_PROGRESS_INTERVAL:
+            last = now
+            set_status(item, 'EMBEDDING', patch={ 'normalizing': _normalizing_step(item, stats) })
+
+def _index_records(payload, item, is_pdf, stats):
+    """A "document" header carries `payload` (everything but the content); the file follows
+    as "page" records (PDFs, one per page as it is extracted) or "text" records, so the
+    AI engine embeds the first pages while later ones are still being extracted.
+    Extraction stats are recorded in `stats`.
+    """
+    yield _ndjson({ 'type': 'document', **payload })
+    with item.file.storage.open(item.file.name, 'rb') as fp:
+        if is_pdf:
+            pages = iter_pdf_pages(_local_path(item) or fp)
+            first = None
+            try:
+                first = next(pages, None)
+            except Exception as e:
+                logger.warning("process_item pdf per-page extraction failed file_id=%s error=%s", item.id, e)
+            if first is not None:
+                stats.update(mode='pages', pages=1, text_len=len(first[1]))
+                yield _ndjson({ 'type': 'page', 'page': first[0], 'text': first[1] })
+                try:
+                    for i, txt in pages:
+                        stats['pages'] += 1
+                        stats['text_len'] += len(txt)
+                        yield _ndjson({ 'type': 'page', 'page': i, 'text': txt })
+                except Exception as e:
+                    # Pages already sent cannot be taken back; index them and flag the rest
+                    stats['error'] = str(e)
+                    logger.warning("process_item pdf extraction stopped file_id=%s after pages=%s error=%s", item.id, stats['pages'], e)
+                return
+            # Whole-doc text only when per-page extraction yielded nothing
+            try:
+                pieces = [extract_pdf_text(fp)]
+            except Exception:
+                pieces = []
+        else:
+            # Naive utf-8 decode (handles txt/html minimally)
+            fp.seek(0)
+            pieces = _iter_text(fp)
+        stats.update(mode='text', text_len=0)
+        for text in _text_records(pieces):
+            stats['text_len'] += len(text)
+            yield _ndjson({ 'type': 'text', 'text': text })
+
+def _read_index_stream(r, item):
+    """Follow the NDJSON reply of /index_document/stream; progress lines update the
+    item's indexing step (at most every INDEX_PROGRESS_INTERVAL seconds). Returns the
+    final "done" or "error" record, or None when the stream ended without one.
+    """
+    last = 0.0
+    for line in r.iter_lines():
+        if not line:
+            continue
+        record = json.loads(line)
+        if record.get('type') != 'progress':
+            return record
+        now = time.monotonic()
+        if now - last >= INDEX_PROGRESS_INTERVAL:
+            last = now
+            set_status(item, 'INDEXING', patch={ 'indexing': {
+                'records': int(record.get('records') or 0),
+                'vectors_written': int(record.get('stored') or 0),
+                'failed_chunks': int(record.get('failed_chunks') or 0),
+            } })
+    return None
+
 @shared_task(bind=True, max_retries=3, default_retry_delay=15)
 def process_item(self, file_id: int, job_id: int = None):
     logger.info("process_item start file_id=%s job_id=%s", file_id, job_id)
@@ -117,14 +239,14 @@ def process_item(self, file_id: int, job_id: int = None):
 
     # FETCHING
     set_status(item, 'FETCHING', patch={ 'fetching': { 'started_at': timezone.now().isoformat() } })
-    content = b''
+    bytes_in = 0
     try:
+        # The file is streamed from storage while indexing; only check that it is there
         fh = getattr(item, 'file', None)
-        if fh and hasattr(fh, 'open'):
-            with fh.open('rb') as f:
-                content = f.read()
-        bytes_in = len(content)
-        logger.info("process_item fetched bytes file_id=%s bytes=%s", item.id, len(content))
+        if not fh:
+            raise FileNotFoundError('no stored file')
+        bytes_in = fh.size
+        logger.info("process_item fetched bytes file_id=%s bytes=%s", item.id, bytes_in)
     except Exception as e:
         set_status(item, 'FAILED', error_code='FETCH_ERROR', error_text=str(e))
         logger.exception("process_item fetch failed file_id=%s error=%s", item.id, e)
@@ -141,40 +263,10 @@ def process_item(self, file_id: int, job_id: int = None):
     # NORMALIZING (extract text)
     mime = (getattr(item, 'content_type', '') or '').lower()
     filename = (getattr(item, 'filename', '') or '').lower()
-    set_status(item, 'NORMALIZING', patch={ 'normalizing': { 'mime': mime, 'bytes_in': len(content) } })
-    text = ''
-    pages_payload = None
-    try:
-        if 'pdf' in mime or filename.endswith('.pdf'):
-            # Extract text per-page for precise page mapping
-            pages = []
-            try:
-                for i, layout in enumerate(extract_pages(io.BytesIO(content)), start=1):
-                    parts = []
-                    for el in layout:
-                        try:
-                            if hasattr(el, 'get_text'):
-                                parts.append(el.get_text())
-                        except Exception:
-                            pass
-                    txt = "\n".join([t for t in parts if t and t.strip()])
-                    pages.append({ 'page': i, 'text': txt })
-            except Exception:
-                pages = []
-            # Fallback to whole-doc text as well
-            try:
-                text = pdf_extract_text(io.BytesIO(content)) or ''
-            except Exception:
-                text = ''
-            pages_payload = pages if pages else None
-            logger.info("process_item pdf extracted file_id=%s pages=%s text_len=%s", item.id, len(pages_payload or []), len(text or ''))
-        else:
-            # Fallback: naive utf-8 decode (handles txt/html minimally)
-            text = content.decode('utf-8', errors='ignore')
-            logger.info("process_item text extracted file_id=%s text_len=%s", item.id, len(text or ''))
-    except Exception as e:
-        text = ''
-        logger.exception("process_item normalize failed file_id=%s error=%s", item.id, e)
+    set_status(item, 'NORMALIZING', patch={ 'normalizing': { 'mime': mime, 'bytes_in': bytes_in } })
+    # Text is extracted while the index request body is sent (see _iter_index_records)
+    is_pdf = 'pdf' in mime or filename.endswith('.pdf')
+    extract_stats = {}
 
     # CHUNKING (handled by AI for now; record placeholder)
     set_status(item, 'CHUNKING', patch={ 'chunking': { 'chunk_count': 0, 'avg_tokens': 0 } })
@@ -206,6 +298,13 @@ def process_item(self, file_id: int, job_id: int = None):
             source_type = 'document'
         payload['source_type'] = source_type
         base_metadata = { 'source_type': source_type }
+        # Tenant/owner keys; the AI engine indexes them for retrieval filters
+        if getattr(item, 'organization_id', None):
+            base_metadata['organization'] = str(item.organization_id)
+        if getattr(item, 'uploaded_by_id', None):
+            base_metadata['uploader'] = str(item.uploaded_by_id)
+        if getattr(item, 'uploaded_at', None):
+            base_metadata['created_at'] = item.uploaded_at.isoformat()
         # Origin URL (if imported from web/source)
         origin_url = None
         try:
@@ -262,16 +361,23 @@ def process_item(self, file_id: int, job_id: int = None):
             base_metadata['extra'] = extra
         if base_metadata:
             payload['metadata'] = base_metadata
-        if pages_payload:
-            payload['pages'] = pages_payload
-        else:
-            payload['text'] = text
-        r = requests.post(f"{AI_URL}/index_document", json=payload, timeout=30)
-        if not r.ok:
+        # Streamed both ways: the AI engine commits batches while pages are still sent and
+        # reports progress, so the timeout only bounds silence, not the whole document.
+        # Its progress lines are read once the body is sent; until then _iter_index_records
+        # reports the records sent.
+        with ai_engine.index_document_stream(_iter_index_records(payload, item, is_pdf, extract_stats)) as r:
+            if r.ok:
+                data = _read_index_stream(r, item)
+                if data is None:
+                    data = { 'type': 'error', 'error': 'incomplete', 'detail': 'index stream ended early' }
+            else:
+                data = { 'type': 'error', 'error': r.status_code, 'detail': (r.text or '')[:200] }
+        logger.info("process_item extracted file_id=%s mode=%s pages=%s text_len=%s", item.id, extract_stats.get('mode'), extract_stats.get('pages', 0), extract_stats.get('text_len', 0))
+        if data.get('type') == 'error':
             # Surface AI error
-            snippet = (r.text or '')[:200]
-            set_status(item, 'FAILED', error_code='EMBED_ERROR', error_text=f'AI index failed {r.status_code}: {snippet}')
-            logger.error("process_item AI index failed file_id=%s status=%s snippet=%s", item.id, r.status_code, snippet)
+            snippet = f"{data.get('error')}: {data.get('detail') or ''}"[:200]
+            set_status(item, 'FAILED', error_code='EMBED_ERROR', error_text=f'AI index failed {snippet}')
+            logger.error("process_item AI index failed file_id=%s snippet=%s", item.id, snippet)
             if job_id:
                 try:
                     j = IngestJob.objects.filter(id=job_id).first()
@@ -280,7 +386,6 @@ def process_item(self, file_id: int, job_id: int = None):
                 except Exception:
                     pass
             return
-        data = r.json() if r.content else {}
     except Exception as e:
         set_status(item, 'FAILED', error_code='EMBED_ERROR', error_text=str(e))
         logger.exception("process_item AI error file_id=%s error=%s", item.id, e)
@@ -293,10 +398,19 @@ def process_item(self, file_id: int, job_id: int = None):
                 pass
         return
 
-    set_status(item, 'INDEXING', patch={ 'indexing': { 'vectors_written': int(data.get('chunks') or 0) } })
-    logger.info("process_item indexed file_id=%s chunks=%s", item.id, int(data.get('chunks') or 0))
+    failed_chunks = int(data.get('failed_chunks') or 0)
+    set_status(item, 'INDEXING', patch={ 'normalizing': _normalizing_step(item, extract_stats), 'indexing': {
+        'vectors_written': int(data.get('chunks') or 0),
+        'failed_chunks': failed_chunks,
+        # Incremental re-index: what changed against the previously stored chunks
+        'added': int(data.get('added') or 0),
+        'updated': int(data.get('updated') or 0),
+        'removed': int(data.get('removed') or 0),
+        'unchanged': int(data.get('unchanged') or 0),
+    } })
+    logger.info("process_item indexed file_id=%s chunks=%s failed=%s", item.id, int(data.get('chunks') or 0), failed_chunks)
     if int(data.get('chunks') or 0) > 0:
-        set_status(item, 'READY', patch={ 'partial': False })
+        set_status(item, 'READY', patch={ 'partial': failed_chunks > 0 or bool(extract_stats.get('error')) })
         logger.info("process_item success file_id=%s", item.id)
         if job_id:
             try:
@@ -390,7 +504,7 @@ def process_web_job(self, job_id: int):
         sha = hashlib.sha256(content).hexdigest()
         # Reuse existing file for same URL if present; else fallback to checksum
         rec = rec or (IngestFile.objects
-               .filter(uploaded_by=j.created_by, steps_json__contains={'source_url': url})
+               .filter(uploaded_by=j.created_by, source_url=url)
                .order_by('-uploaded_at')
                .first())
         if rec is None:
@@ -404,6 +518,7 @@ def process_web_job(self, job_id: int):
                 size=len(content),
                 checksum=sha,
                 steps_json={'source_url': url, **({'page_title': page_title} if page_title else {})},
+                source_url=url,
                 organization=j.organization
             )
             logger.info("process_web_job created file id=%s for url=%s", rec.id, url)
@@ -418,7 +533,8 @@ def process_web_job(self, job_id: int):
             if page_title:
                 sj['page_title'] = page_title
             rec.steps_json = sj
-            update_fields = ['filename','content_type','size','checksum','steps_json']
+            rec.source_url = url
+            update_fields = ['filename','content_type','size','checksum','steps_json','source_url']
             if j.organization and rec.organization_id != getattr(j.organization, 'id', None):
                 rec.organization = j.organization
                 update_fields.append('organization')
@@ -429,6 +545,7 @@ def process_web_job(self, job_id: int):
         except Exception:
             # Ignore file save issues; we still can index text
             logger.warning("process_web_job failed to save file blob id=%s", rec.id)
+        j.files.add(rec)
         # Persist back file_id/url into job payload for future re-runs
         try:
             new_payload = dict(j.payload or {})
@@ -452,3 +569,93 @@ def process_web_job(self, job_id: int):
         j.message = str(e)
         j.save(update_fields=['status','finished_at','message'])
         logger.exception("process_web_job failed job_id=%s error=%s", job_id, e)
+
+
+CLEANUP_BATCH = int(os.environ.get('CLEANUP_BATCH', 500))
+
+@shared_task(bind=True, max_retries=0)
+def admin_cleanup(self, job_id: int):
+    """Clear vectors and/or delete every document of the job's user, with its jobs and
+    orphaned sources (payload.action: clear_vectors | delete_documents | delete_all).
+    Documents are unindexed and deleted CLEANUP_BATCH at a time; progress and counts go
+    to job.progress and job.totals_json. A batch the AI engine could not unindex is kept
+    (totals 'unindex_failed' / 'unindex_error') together with the jobs linked to it, and
+    the job ends as failed, so the cleanup can be re-run without leaving vectors of
+    deleted documents behind.
+    """
+    j = IngestJob.objects.filter(id=job_id).first()
+    if j is None:
+        return
+    action = str((j.payload or {}).get('action') or '').lower()
+    user_id = j.created_by_id
+    logger.info("admin_cleanup start job_id=%s action=%s user=%s", job_id, action, user_id)
+    j.status = 'running'
+    j.started_at = timezone.now()
+    j.save(update_fields=['status','started_at'])
+    totals = { 'cleared_vectors': False, 'vectors_removed': 0, 'deleted_docs': 0, 'deleted_jobs': 0, 'deleted_sources': 0 }
+    try:
+        if action in ('clear_vectors','delete_all'):
+            try:
+                r = ai_engine.clear_all()
+                r.raise_for_status()
+                totals['cleared_vectors'] = True
+                data = r.json() if r.content else {}
+                totals['vectors_removed'] = int(data.get('removed') or 0)
+            except Exception as e:
+                logger.warning("admin_cleanup clear_all failed job_id=%s error=%s", job_id, e)
+                totals['clear_error'] = str(e)
+        if action in ('delete_documents','delete_all'):
+            ids = list(IngestFile.objects.filter(uploaded_by_id=user_id).order_by('-id').values_list('id', flat=True))
+            totals['total_docs'] = len(ids)
+            # Jobs are found through the job-file link table
+            jobs = IngestJob.objects.filter(created_by_id=user_id).exclude(id=j.id)
+            src_ids = set(jobs.filter(files__uploaded_by_id=user_id).exclude(source_id=None).values_list('source_id', flat=True))
+            for i in range(0, len(ids), CLEANUP_BATCH):
+                batch = ids[i:i + CLEANUP_BATCH]
+                if not totals['cleared_vectors']:
+                    try:
+                        ai_engine.unindex_documents(batch).raise_for_status()
+                    except Exception as e:
+                        # Keep the documents: deleting them would orphan their vectors
+                        logger.warning("admin_cleanup unindex failed job_id=%s docs=%s error=%s", job_id, len(batch), e)
+                        totals['unindex_failed'] = totals.get('unindex_failed', 0) + len(batch)
+                        totals['unindex_error'] = str(e)
+                        continue
+                batch_jobs = list(jobs.filter(files__id__in=batch).values_list('id', flat=True).distinct())
+                for rec in IngestFile.objects.filter(id__in=batch).only('id', 'file'):
+                    try:
+                        if rec.file:
+                            rec.file.delete(save=False)
+                    except Exception:
+                        pass
+                IngestFile.objects.filter(id__in=batch).delete()
+                totals['deleted_docs'] += len(batch)
+                # A job goes with its last document; one still linked to a kept document stays
+                done = IngestJob.objects.filter(id__in=batch_jobs, files__isnull=True)
+                totals['deleted_jobs'] += done.delete()[1].get('ingest.IngestJob', 0)
+                j.progress = min(99, (i + len(batch)) * 100 // max(1, len(ids)))
+                j.totals_json = dict(totals)
+                j.save(update_fields=['progress','totals_json'])
+            orphans = IngestSource.objects.filter(id__in=src_ids, created_by_id=user_id, jobs__isnull=True)
+            totals['deleted_sources'] = orphans.delete()[1].get('ingest.IngestSource', 0) if src_ids else 0
+        j.progress = 100
+        if totals.get('unindex_failed'):
+            j.status = 'failed'
+            j.message = (
+                f"Deleted {totals['deleted_docs']} document(s); kept {totals['unindex_failed']} "
+                f"the AI engine could not unindex: {totals['unindex_error']}"
+            )
+        elif action == 'clear_vectors' and not totals['cleared_vectors']:
+            j.status = 'failed'
+            j.message = f"Clearing vectors failed: {totals.get('clear_error')}"
+        else:
+            j.status = 'success'
+            j.message = f"Deleted {totals['deleted_docs']} document(s)" if action != 'clear_vectors' else 'Vectors cleared'
+    except Exception as e:
+        logger.exception("admin_cleanup failed job_id=%s error=%s", job_id, e)
+        j.status = 'failed'
+        j.message = str(e)
+    j.finished_at = timezone.now()
+    j.totals_json = totals
+    j.save(update_fields=['status','progress','message','finished_at','totals_json'])
+    logger.info("admin_cleanup done job_id=%s status=%s totals=%s", job_id, j.status, totals)
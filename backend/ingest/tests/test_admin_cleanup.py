@@ -0,0 +1,96 @@
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.contrib.auth import get_user_model
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from ingest import tasks
+from ingest.models import IngestFile, IngestJob, IngestSource
+
+
+class AdminCleanupTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(username="admin@example.com", email="admin@example.com", password="StrongPass123")
+        self.other = User.objects.create_user(username="other@example.com", email="other@example.com", password="StrongPass123")
+
+    def cleanup(self, action):
+        token = RefreshToken.for_user(self.user).access_token
+        # Run the queued task inline
+        with patch("ingest.views.admin_cleanup.delay", side_effect=tasks.admin_cleanup):
+            return self.client.post("/api/admin/cleanup/", {"action": action}, format="json", HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_delete_documents_runs_in_batches_and_follows_job_links(self):
+        files = [IngestFile.objects.create(filename=f"f{i}.txt", uploaded_by=self.user) for i in range(3)]
+        web = IngestFile.objects.create(filename="page.html", uploaded_by=self.user, source_url="https://example.com/a")
+        theirs = IngestFile.objects.create(filename="theirs.txt", uploaded_by=self.other)
+        orphaned = IngestSource.objects.create(kind="web", name="only deleted jobs", created_by=self.user)
+        shared = IngestSource.objects.create(kind="web", name="still used", created_by=self.user)
+        for payload, source, owner in (
+            ({"file_ids": [files[0].id, files[1].id]}, None, self.user),
+            ({"file_id": str(files[2].id)}, orphaned, self.user),
+            ({"url": "https://example.com/a"}, shared, self.user),
+            ({"url": "https://example.com/b"}, shared, self.user),
+            ({"file_ids": [theirs.id]}, None, self.other),
+        ):
+            IngestJob.objects.create(mode="web", payload=payload, source=source, created_by=owner).link_payload_files()
+
+        unindex = MagicMock()
+        with patch.object(tasks, "CLEANUP_BATCH", 3), patch.object(tasks.ai_engine, "unindex_documents", unindex), patch.object(tasks.ai_engine, "clear_all") as clear_all:
+            response = self.cleanup("delete_documents")
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        clear_all.assert_not_called()
+        self.assertEqual([len(c.args[0]) for c in unindex.call_args_list], [3, 1])
+        self.assertEqual(list(IngestFile.objects.values_list("id", flat=True)), [theirs.id])
+        remaining = IngestJob.objects.exclude(mode="cleanup")
+        self.assertEqual(sorted(j.payload.get("url") or "theirs" for j in remaining), ["https://example.com/b", "theirs"])
+        self.assertEqual(list(IngestSource.objects.values_list("id", flat=True)), [shared.id])
+
+        job = IngestJob.objects.get(id=response.data["job_id"])
+        self.assertEqual((job.mode, job.status, job.progress), ("cleanup", "success", 100))
+        self.assertEqual(
+            {k: job.totals_json[k] for k in ("deleted_docs", "deleted_jobs", "deleted_sources", "total_docs")},
+            {"deleted_docs": 4, "deleted_jobs": 3, "deleted_sources": 1, "total_docs": 4},
+        )
+        self.assertEqual(response.data["deleted_docs"], 4)
+
+    def test_delete_all_clears_vectors_once_instead_of_unindexing(self):
+        IngestFile.objects.create(filename="a.txt", uploaded_by=self.user)
+        cleared = MagicMock(ok=True, content=b"{}")
+        cleared.json.return_value = {"removed": 12}
+        with patch.object(tasks.ai_engine, "clear_all", return_value=cleared), patch.object(tasks.ai_engine, "unindex_documents") as unindex:
+            response = self.cleanup("delete_all")
+        unindex.assert_not_called()
+        self.assertEqual((response.data["cleared_vectors"], response.data["vectors_removed"], response.data["deleted_docs"]), (True, 12, 1))
+
+    def test_documents_the_engine_could_not_unindex_are_kept(self):
+        files = [IngestFile.objects.create(filename=f"f{i}.txt", uploaded_by=self.user) for i in range(4)]
+        jobs = {}
+        for name, linked in (("kept", [files[3]]), ("deleted", [files[0]]), ("spanning", [files[1], files[2]])):
+            jobs[name] = IngestJob.objects.create(mode="upload", payload={"file_ids": [f.id for f in linked]}, created_by=self.user)
+            jobs[name].link_payload_files()
+        refused = MagicMock()
+        refused.raise_for_status.side_effect = requests.HTTPError("500 Server Error")
+        unindex = MagicMock(side_effect=[refused, MagicMock()])
+        with patch.object(tasks, "CLEANUP_BATCH", 2), patch.object(tasks.ai_engine, "unindex_documents", unindex):
+            response = self.cleanup("delete_documents")
+
+        # Newest first: the first batch failed and stays, the second was deleted
+        self.assertEqual(sorted(IngestFile.objects.values_list("id", flat=True)), [files[2].id, files[3].id])
+        # Jobs of kept documents stay linked to them, even when their other documents went
+        remaining = IngestJob.objects.exclude(mode="cleanup")
+        self.assertEqual(sorted(remaining.values_list("id", flat=True)), [jobs["kept"].id, jobs["spanning"].id])
+        self.assertEqual(list(jobs["spanning"].files.values_list("id", flat=True)), [files[2].id])
+        job = IngestJob.objects.get(id=response.data["job_id"])
+        self.assertEqual(job.status, "failed")
+        self.assertIn("kept 2", job.message)
+        self.assertEqual(
+            {k: job.totals_json[k] for k in ("deleted_docs", "deleted_jobs", "unindex_failed", "unindex_error")},
+            {"deleted_docs": 2, "deleted_jobs": 1, "unindex_failed": 2, "unindex_error": "500 Server Error"},
+        )
+
+    def test_invalid_action(self):
+        self.assertEqual(self.cleanup("drop_everything").status_code, status.HTTP_400_BAD_REQUEST)
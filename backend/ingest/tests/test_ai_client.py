@@ -0,0 +1,111 @@
+from unittest.mock import MagicMock, patch
+
+import requests
+from django.test import SimpleTestCase
+
+from ingest import ai_client
+from ingest.ai_client import AIEngineClient, AIEngineUnavailable, CircuitBreaker
+
+
+def _response(status):
+    r = MagicMock()
+    r.status_code = status
+    r.ok = status < 400
+    return r
+
+
+class AIEngineClientTests(SimpleTestCase):
+    def setUp(self):
+        sleep = patch.object(ai_client.time, 'sleep')
+        self.sleeps = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def make_client(self, *outcomes, **breaker):
+        client = AIEngineClient('http://ai.test', breaker=CircuitBreaker(**breaker))
+        session = MagicMock()
+        session.post.side_effect = list(outcomes)
+        client._session = session
+        client._pid = ai_client.os.getpid()
+        return client, session
+
+    def test_idempotent_calls_are_retried_with_backoff(self):
+        client, session = self.make_client(requests.ConnectionError('refused'), _response(503), _response(200))
+        r = client.unindex_document(7)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(session.post.call_count, 3)
+        self.assertEqual(session.post.call_args.kwargs['json'], {'document_id': '7'})
+        self.assertEqual(session.post.call_args.kwargs['timeout'], (ai_client.AI_CONNECT_TIMEOUT, ai_client.TIMEOUTS['unindex']))
+        self.assertEqual([c.args[0] for c in self.sleeps.call_args_list], [ai_client.AI_RETRY_BACKOFF, ai_client.AI_RETRY_BACKOFF * 2])
+
+    def test_streamed_index_is_not_retried(self):
+        client, session = self.make_client(requests.ConnectionError('refused'), _response(200))
+        with self.assertRaises(requests.ConnectionError):
+            client.index_document_stream(iter([b'{}\n']))
+        self.assertEqual(session.post.call_count, 1)
+
+    def test_circuit_opens_then_lets_one_trial_through(self):
+        client, session = self.make_client(*[requests.Timeout('slow')] * 2, _response(200), failures=2, reset_after=30)
+        for _ in range(2):
+            with self.assertRaises(requests.Timeout):
+                client.index_document_stream(iter([]))
+        with self.assertRaises(AIEngineUnavailable):
+            client.clear_all()
+        self.assertEqual(session.post.call_count, 2)
+
+        client.breaker.opened_at -= 30
+        self.assertEqual(client.clear_all().status_code, 200)
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_session_is_recreated_after_fork(self):
+        client = AIEngineClient('http://ai.test')
+        first = client.session
+        self.assertIs(client.session, first)
+        client._pid = -1
+        self.assertIsNot(client.session, first)
+
+    def test_any_exception_in_a_trial_call_reopens_the_circuit(self):
+        client, session = self.make_client(requests.Timeout('slow'), ValueError('bad body'), _response(200), failures=1, reset_after=30)
+        with self.assertRaises(requests.Timeout):
+            client.index_document_stream(iter([]))
+        client.breaker.opened_at -= 30
+        with self.assertRaises(ValueError):
+            client.index_document_stream(iter([]))
+        self.assertEqual(client.breaker.state, 'open')
+        with self.assertRaises(AIEngineUnavailable):
+            client.clear_all()
+
+        client.breaker.opened_at -= 30
+        self.assertEqual(client.clear_all().status_code, 200)
+        self.assertEqual(client.breaker.state, 'closed')
+
+    def test_server_errors_count_as_failures(self):
+        client, session = self.make_client(_response(500), _response(500), failures=2)
+        for _ in range(2):
+            self.assertEqual(client.index_document_stream(iter([])).status_code, 500)
+        self.assertEqual(client.breaker.state, 'open')
+
+    def test_streamed_response_holds_its_slot_until_closed(self):
+        client, session = self.make_client(_response(200), _response(200))
+        client._inflight = ai_client.threading.BoundedSemaphore(1)
+        r = client.index_document_stream(iter([]))
+        with patch.object(ai_client, 'AI_INFLIGHT_WAIT', 0):
+            with self.assertRaises(AIEngineUnavailable):
+                client.unindex_document(1)
+        r.close()
+        r.close()
+        self.assertEqual(client.unindex_document(1).status_code, 200)
+
+    def test_trial_is_not_taken_when_no_slot_is_free(self):
+        client, session = self.make_client(requests.Timeout('slow'), _response(200), _response(200), failures=1, reset_after=30)
+        with self.assertRaises(requests.Timeout):
+            client.index_document_stream(iter([]))
+        client.breaker.opened_at -= 30
+        client._inflight = ai_client.threading.BoundedSemaphore(1)
+        client._inflight.acquire()
+        with patch.object(ai_client, 'AI_INFLIGHT_WAIT', 0):
+            with self.assertRaises(AIEngineUnavailable):
+                client.unindex_document(1)
+        self.assertEqual(client.breaker.state, 'half_open')
+        client._inflight.release()
+        self.assertEqual(client.unindex_document(1).status_code, 200)
+        self.assertEqual(client.breaker.state, 'closed')
@@ -6,7 +6,7 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from ingest.models import IngestSource, IngestJob
+from ingest.models import IngestFile, IngestSource, IngestJob
 
 
 class IngestApiTests(APITestCase):
@@ -83,3 +83,26 @@ class IngestApiTests(APITestCase):
             )
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         mocked_delay.assert_called_once()
+
+    def test_upload_job_links_payload_files_and_document_delete_follows_links(self):
+        mine = IngestFile.objects.create(filename="a.txt", uploaded_by=self.user)
+        other = get_user_model().objects.create_user(username="x@example.com", email="x@example.com", password="StrongPass123")
+        theirs = IngestFile.objects.create(filename="b.txt", uploaded_by=other)
+        source = IngestSource.objects.create(kind="upload", name="Files", created_by=self.user)
+        response = self.client.post(
+            "/api/ingest/jobs/",
+            {"mode": "upload", "source": source.id, "payload": {"file_ids": [mine.id, theirs.id]}},
+            format="json",
+            **self.auth_headers(),
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        job = IngestJob.objects.get(id=response.data["id"])
+        self.assertEqual(list(job.files.all()), [mine])
+
+        with patch("ingest.views.ai_engine.unindex_document") as unindex:
+            response = self.client.delete(f"/api/documents/{mine.id}/", **self.auth_headers())
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        unindex.assert_called_once_with(mine.id)
+        self.assertFalse(IngestJob.objects.filter(id=job.id).exists())
+        self.assertFalse(IngestSource.objects.filter(id=source.id).exists())
+        self.assertTrue(IngestFile.objects.filter(id=theirs.id).exists())
@@ -0,0 +1,95 @@
+import logging
+import os
+import signal
+from unittest.mock import patch
+
+import billiard
+from django.test import SimpleTestCase
+
+from ingest import pdf_extract
+from ingest.pdf_extract import extract_pdf_text, iter_pdf_pages
+
+
+def make_pdf(pages):
+    """A minimal PDF with one line of text per page."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for i in range(pages):
+        stream = f"BT /F1 12 Tf 72 720 Td (Page {i + 1} text) Tj ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_ref = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_ref
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), pages)
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (n, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _reap(child):
+    if child.is_alive():
+        os.kill(child.pid, signal.SIGKILL)
+        child.join()
+
+
+def _extract_in_child(pdf, conn):
+    """Run the parallel path as a Celery prefork child would: in a daemonic billiard process."""
+    warnings = []
+    handler = logging.Handler()
+    handler.emit = warnings.append
+    pdf_extract.logger.addHandler(handler)
+    pdf_extract.PDF_PARALLEL_MIN_PAGES = 2
+    try:
+        conn.send((list(iter_pdf_pages(pdf, workers=2)), [r.getMessage() for r in warnings]))
+    except Exception as e:
+        conn.send(([], [repr(e)]))
+
+
+class PdfExtractTests(SimpleTestCase):
+    def test_serial_extraction_keeps_page_order(self):
+        pages = list(iter_pdf_pages(make_pdf(3), workers=1))
+        self.assertEqual([n for n, _ in pages], [1, 2, 3])
+        self.assertIn("Page 2 text", pages[1][1])
+
+    def test_parallel_extraction_matches_serial(self):
+        pdf = make_pdf(20)
+        with patch.object(pdf_extract, "PDF_PARALLEL_MIN_PAGES", 4), patch.object(pdf_extract.os, "cpu_count", return_value=4):
+            pages = list(iter_pdf_pages(pdf, workers=4))
+        self.assertEqual(pages, list(iter_pdf_pages(pdf, workers=1)))
+        self.assertIn("Page 20 text", pages[-1][1])
+
+    def test_pool_failure_falls_back_to_in_process(self):
+        with patch.object(pdf_extract, "PDF_PARALLEL_MIN_PAGES", 2), patch.object(pdf_extract.os, "cpu_count", return_value=2), patch.object(
+            pdf_extract, "Pool", side_effect=OSError("no /dev/shm")
+        ):
+            pages = list(iter_pdf_pages(make_pdf(4), workers=2))
+        self.assertEqual([n for n, _ in pages], [1, 2, 3, 4])
+
+    def test_parallel_extraction_works_in_daemonic_worker(self):
+        pdf = make_pdf(8)
+        ours, theirs = billiard.Pipe()
+        child = billiard.Process(target=_extract_in_child, args=(pdf, theirs), daemon=True)
+        with patch.object(pdf_extract.os, "cpu_count", return_value=2):
+            child.start()
+        # A stuck child must fail the test, not hang the run when it exits
+        self.addCleanup(_reap, child)
+        self.assertTrue(ours.poll(60))
+        pages, warnings = ours.recv()
+        child.join(10)
+        self.assertEqual(child.exitcode, 0)
+        self.assertEqual(warnings, [])
+        self.assertEqual(pages, list(iter_pdf_pages(pdf, workers=1)))
+
+    def test_broken_pdf_raises_and_whole_document_fallback_is_separate(self):
+        with self.assertRaises(Exception):
+            list(iter_pdf_pages(b"not a pdf"))
+        self.assertIn("Page 1 text", extract_pdf_text(make_pdf(1)))
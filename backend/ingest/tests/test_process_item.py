@@ -0,0 +1,97 @@
+import json
+from unittest.mock import patch
+
+from django.core.files.base import ContentFile
+from django.test import TestCase
+
+from ingest import tasks
+from ingest.models import IngestFile
+from ingest.tests.test_pdf_extract import make_pdf
+
+
+class _StreamResponse:
+    ok = True
+    status_code = 200
+    text = ''
+
+    def __init__(self, records):
+        self._lines = [json.dumps(r).encode() for r in records]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_lines(self):
+        return iter(self._lines)
+
+
+class ProcessItemStreamingTests(TestCase):
+    def run_item(self, name, content, content_type, reply=None, on_record=None):
+        item = IngestFile.objects.create(filename=name, content_type=content_type, size=len(content))
+        item.file.save(name, ContentFile(content), save=True)
+        sent = {}
+
+        def index_document_stream(records):
+            # Consume the streamed body the way requests would: all of it before the reply
+            lines = []
+            for line in records:
+                lines.append(line)
+                if on_record:
+                    on_record(item)
+            sent['records'] = [json.loads(line) for line in b''.join(lines).splitlines()]
+            return _StreamResponse(reply or [
+                {'type': 'progress', 'records': 1, 'stored': 1},
+                {'type': 'done', 'ok': True, 'chunks': 1, 'added': 1},
+            ])
+
+        with patch.object(tasks.ai_engine, 'index_document_stream', side_effect=index_document_stream):
+            tasks.process_item(item.id)
+        item.refresh_from_db()
+        return item, sent['records']
+
+    def test_text_is_decoded_incrementally(self):
+        text = 'café über naïve ' * 3
+        with patch.object(tasks, 'READ_BLOCK', 5):
+            item, records = self.run_item('notes.txt', text.encode('utf-8') + b'\xff', 'text/plain')
+        self.assertEqual(records[0]['type'], 'document')
+        self.assertEqual(records[0]['document_id'], str(item.id))
+        self.assertEqual(''.join(r['text'] for r in records[1:] if r['type'] == 'text'), text)
+        self.assertEqual(item.status, 'READY')
+        self.assertEqual(item.steps_json['normalizing']['mode'], 'text')
+        self.assertEqual(item.steps_json['indexing']['added'], 1)
+
+    def test_long_text_is_cut_at_blank_lines(self):
+        paragraphs = ['para %d %s' % (i, 'x' * 30) for i in range(20)]
+        records = list(tasks._text_records(iter(['\n\n'.join(paragraphs)]), limit=100))
+        self.assertEqual(''.join(records), '\n\n'.join(paragraphs))
+        self.assertTrue(all(r.endswith('\n\n') for r in records[:-1]))
+        self.assertTrue(all(len(r) <= 100 for r in records))
+
+    def test_pdf_pages_are_streamed_as_records(self):
+        item, records = self.run_item('report.pdf', make_pdf(3), 'application/pdf')
+        pages = [r for r in records if r['type'] == 'page']
+        self.assertEqual([p['page'] for p in pages], [1, 2, 3])
+        self.assertIn('Page 3 text', pages[2]['text'])
+        self.assertEqual(item.steps_json['normalizing']['pages'], 3)
+        self.assertEqual(item.status, 'READY')
+
+    def test_records_sent_are_progress_before_the_reply(self):
+        seen = []
+
+        def on_record(item):
+            step = IngestFile.objects.get(id=item.id).steps_json.get('normalizing') or {}
+            seen.append(step.get('records_sent'))
+
+        with patch.object(tasks, 'INDEX_PROGRESS_INTERVAL', 0):
+            item, records = self.run_item('report.pdf', make_pdf(3), 'application/pdf', on_record=on_record)
+        self.assertEqual(seen, [None, 1, 2, 3])
+        self.assertEqual(item.steps_json['normalizing']['records_sent'], len(records))
+
+    def test_error_record_fails_the_item(self):
+        item, _ = self.run_item('notes.txt', b'hello', 'text/plain', reply=[
+            {'type': 'error', 'ok': False, 'error': 'embed_failed', 'detail': 'quota'},
+        ])
+        self.assertEqual(item.status, 'FAILED')
+        self.assertIn('embed_failed', item.error_text)
@@ -9,13 +9,13 @@ from django.db.models import Q
 from django.utils import timezone
 from django.http import FileResponse, Http404
 from django.views.generic import TemplateView
-import os, requests
 import logging
 
 from .models import IngestSource, IngestJob, IngestFile
 from .serializers import SourceSerializer, IngestJobSerializer, DocumentSerializer
 from .status import set_status
-from .tasks import process_item, process_web_job
+from .tasks import process_item, process_web_job, admin_cleanup
+from .ai_client import ai_engine
 from accounts.plan import get_effective_plan, get_plan_limits
 
 class HealthView(APIView):
@@ -61,6 +61,7 @@ class JobListCreate(APIView):
         ser = IngestJobSerializer(data=data)
         ser.is_valid(raise_exception=True)
         obj = ser.save(created_by=request.user)
+        obj.link_payload_files()
         try:
             logging.getLogger(__name__).info("Job created id=%s mode=%s by user=%s", obj.id, obj.mode, getattr(request.user, 'id', None))
         except Exception:
@@ -93,7 +94,6 @@ class JobDetail(APIView):
             mode = str(j.mode or '').lower()
             if mode == 'web':
                 payload = j.payload or {}
-                file_id = payload.get('file_id')
                 url = payload.get('url') or payload.get('start_url')
                 # Fallback to source config url if payload empty
                 if not url and getattr(j, 'source_id', None):
@@ -108,8 +108,7 @@ class JobDetail(APIView):
                     if not rec:
                         return
                     try:
-                        AI_URL = os.environ.get('AI_ENGINE_URL') or os.environ.get('AI_URL') or 'http://ai:9000'
-                        requests.post(f"{AI_URL}/unindex_document", json={ 'document_id': str(rec.id) }, timeout=10)
+                        ai_engine.unindex_document(rec.id)
                     except Exception:
                         pass
                     try:
@@ -118,15 +117,11 @@ class JobDetail(APIView):
                     except Exception:
                         pass
                     rec.delete()
-                if file_id:
-                    _delete_file_obj(IngestFile.objects.filter(id=file_id, uploaded_by=request.user).first())
+                linked = Q(jobs=j)
                 if url:
-                    try:
-                        qs = IngestFile.objects.filter(uploaded_by=request.user, steps_json__contains={'source_url': url})
-                        for rec in qs[:10]:
-                            _delete_file_obj(rec)
-                    except Exception:
-                        pass
+                    linked |= Q(source_url=url)
+                for rec in list(IngestFile.objects.filter(linked, uploaded_by=request.user).distinct()[:10]):
+                    _delete_file_obj(rec)
             # finally delete the job itself
             extra_deleted = 0
             if mode == 'web':
@@ -201,7 +196,12 @@ class UploadView(APIView):
                 f.seek(0)
             except Exception:
                 pass
+            # Storage copies the upload in chunks (or moves the spooled temp file into place)
             doc.file.save(f.name, f, save=True)
+            try:
+                f.close()
+            except Exception:
+                pass
             # Queue processing (Celery)
             try:
                 process_item.delay(doc.id)
@@ -255,7 +255,7 @@ class DocumentDetail(APIView):
             if src_url:
                 try:
                     obj = (IngestFile.objects
-                           .filter(uploaded_by=request.user, steps_json__contains={'source_url': src_url})
+                           .filter(uploaded_by=request.user, source_url=src_url)
                            .order_by('-uploaded_at')
                            .first())
                 except Exception:
@@ -314,58 +314,17 @@ class DocumentDetail(APIView):
         jobs_deleted = 0
         sources_deleted = 0
         with transaction.atomic():
-            # Cascade delete related ingest jobs referencing this file
-            try:
-                jobs = list(IngestJob.objects.filter(created_by=request.user))
-                src_ids = set()
-                for j in jobs:
-                    try:
-                        p = j.payload or {}
-                        want = False
-                        # upload jobs: payload.file_ids contains pk
-                        if isinstance(p.get('file_ids'), list):
-                            try:
-                                if int(pk) in [int(x) for x in p.get('file_ids')]:
-                                    want = True
-                            except Exception:
-                                want = any(str(pk) == str(x) for x in p.get('file_ids'))
-                        # web jobs: payload.file_id equals pk or url matches source_url
-                        if not want:
-                            if (p.get('file_id') and str(p.get('file_id')) == str(pk)):
-                                want = True
-                            else:
-                                try:
-                                    src_url = (getattr(obj, 'steps_json', {}) or {}).get('source_url')
-                                except Exception:
-                                    src_url = None
-                                if src_url and (p.get('url') == src_url or p.get('start_url') == src_url):
-                                    want = True
-                        if want:
-                            if getattr(j, 'source_id', None):
-                                src_ids.add(j.source_id)
-                            j.delete()
-                            jobs_deleted += 1
-                    except Exception:
-                        # Ignore malformed payloads or casting errors per job
-                        pass
-                # Optionally delete orphan sources
-                for sid in list(src_ids):
-                    try:
-                        # Only delete if no other jobs reference it
-                        if not IngestJob.objects.filter(source_id=sid).exists():
-                            src = IngestSource.objects.filter(id=sid, created_by=request.user).first()
-                            if src:
-                                src.delete()
-                                sources_deleted += 1
-                    except Exception:
-                        pass
-            except Exception:
-                pass
+            # Cascade delete related ingest jobs (indexed job-file links) and orphaned sources
+            jobs = IngestJob.objects.filter(created_by=request.user, files=obj)
+            src_ids = set(jobs.exclude(source_id=None).values_list('source_id', flat=True))
+            jobs_deleted = IngestJob.objects.filter(id__in=list(jobs.values_list('id', flat=True))).delete()[1].get('ingest.IngestJob', 0)
+            if src_ids:
+                orphans = IngestSource.objects.filter(id__in=src_ids, created_by=request.user, jobs__isnull=True)
+                sources_deleted = orphans.delete()[1].get('ingest.IngestSource', 0)
 
             # Ask AI engine to unindex vectors for this document
             try:
-                AI_URL = os.environ.get('AI_ENGINE_URL') or os.environ.get('AI_URL') or 'http://ai:9000'
-                requests.post(f"{AI_URL}/unindex_document", json={ 'document_id': str(obj.id) }, timeout=10)
+                ai_engine.unindex_document(obj.id)
                 logger.info("Unindex requested for file_id=%s", obj.id)
             except Exception:
                 logger.warning("Failed to unindex file_id=%s", obj.id)
@@ -394,7 +353,7 @@ class DocumentFind(APIView):
         obj = None
         if url:
             try:
-                obj = qs.filter(steps_json__contains={'source_url': url}).order_by('-uploaded_at').first()
+                obj = qs.filter(source_url=url).order_by('-uploaded_at').first()
             except Exception:
                 obj = None
         if (not obj) and title:
@@ -522,6 +481,7 @@ class ContentRetry(APIView):
         job.started_at = None
         job.finished_at = None
         job.save(update_fields=['state','started_at','finished_at'])
+        job.files.add(obj)
         try:
             logging.getLogger(__name__).info("Retry queued for file_id=%s job_id=%s", obj.id, job.id)
         except Exception:
@@ -550,6 +510,10 @@ class SyncJobCancel(APIView):
 
 
 class AdminCleanup(APIView):
+    """Queue clearing vectors and/or deleting all of the user's documents.
+    The work runs in the admin_cleanup task; poll /api/sync-jobs/<job_id>/ for progress
+    and the final counts (totals_json).
+    """
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
 
@@ -557,95 +521,17 @@ class AdminCleanup(APIView):
         action = str((request.data or {}).get('action') or '').lower()
         if action not in ('clear_vectors','delete_documents','delete_all'):
             return Response({'detail': 'invalid_action'}, status=400)
-        cleared = False
-        vectors_removed = 0
-        deleted_docs = 0
-        deleted_jobs = 0
-        deleted_sources = 0
-        # Helper to cascade-delete a single file (reuse logic from DocumentDetail.delete)
-        def _delete_doc(obj: IngestFile):
-            nonlocal deleted_jobs, deleted_sources
-            if not obj:
-                return
-            with transaction.atomic():
-                try:
-                    jobs = list(IngestJob.objects.filter(created_by=request.user))
-                    src_ids = set()
-                    for j in jobs:
-                        try:
-                            p = j.payload or {}
-                            want = False
-                            if isinstance(p.get('file_ids'), list):
-                                try:
-                                    if int(obj.id) in [int(x) for x in p.get('file_ids')]:
-                                        want = True
-                                except Exception:
-                                    want = any(str(obj.id) == str(x) for x in p.get('file_ids'))
-                            if not want:
-                                if (p.get('file_id') and str(p.get('file_id')) == str(obj.id)):
-                                    want = True
-                                else:
-                                    try:
-                                        src_url = (getattr(obj, 'steps_json', {}) or {}).get('source_url')
-                                    except Exception:
-                                        src_url = None
-                                    if src_url and (p.get('url') == src_url or p.get('start_url') == src_url):
-                                        want = True
-                            if want:
-                                if getattr(j, 'source_id', None):
-                                    src_ids.add(j.source_id)
-                                j.delete(); deleted_jobs += 1
-                        except Exception:
-                            pass
-                    for sid in list(src_ids):
-                        try:
-                            if not IngestJob.objects.filter(source_id=sid).exists():
-                                src = IngestSource.objects.filter(id=sid, created_by=request.user).first()
-                                if src:
-                                    src.delete(); deleted_sources += 1
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-                try:
-                    AI_URL = os.environ.get('AI_ENGINE_URL') or os.environ.get('AI_URL') or 'http://ai:9000'
-                    requests.post(f"{AI_URL}/unindex_document", json={ 'document_id': str(obj.id) }, timeout=10)
-                except Exception:
-                    pass
-                try:
-                    if getattr(obj, 'file', None):
-                        obj.file.delete(save=False)
-                except Exception:
-                    pass
-                obj.delete()
-
-        # Clear vectors
-        if action in ('clear_vectors','delete_all'):
-            try:
-                AI_URL = os.environ.get('AI_ENGINE_URL') or os.environ.get('AI_URL') or 'http://ai:9000'
-                r = requests.post(f"{AI_URL}/admin/clear_all", timeout=15)
-                cleared = bool(r.ok)
-                try:
-                    data = r.json() if r.content else {}
-                    vectors_removed = int(data.get('removed') or 0)
-                except Exception:
-                    vectors_removed = 0
-            except Exception:
-                cleared = False
-        # Delete documents (+ cascade)
-        if action in ('delete_documents','delete_all'):
-            qs = IngestFile.objects.filter(uploaded_by=request.user).order_by('-id')
-            for obj in qs:
-                _delete_doc(obj)
-                deleted_docs += 1
-        return Response({
-            'ok': True,
-            'cleared_vectors': cleared,
-            'vectors_removed': vectors_removed,
-            'deleted_docs': deleted_docs,
-            'deleted_jobs': deleted_jobs,
-            'deleted_sources': deleted_sources,
-        })
+        job = IngestJob.objects.create(mode='cleanup', payload={'action': action}, status='queued', state='QUEUED', created_by=request.user)
+        try:
+            admin_cleanup.delay(job.id)
+            logging.getLogger(__name__).info("admin_cleanup queued job_id=%s action=%s user=%s", job.id, action, request.user.id)
+        except Exception as e:
+            logging.getLogger(__name__).exception("Failed to enqueue admin_cleanup job_id=%s", job.id)
+            job.status = 'failed'; job.finished_at = timezone.now(); job.message = str(e)
+            job.save(update_fields=['status','finished_at','message'])
+            return Response({'detail': 'enqueue_failed'}, status=503)
+        job.refresh_from_db()
+        return Response({'ok': True, 'job_id': job.id, 'status': job.status, **(job.totals_json or {})}, status=202)
 
 
 class OAuthStartView(TemplateView):